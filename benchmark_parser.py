@@ -0,0 +1,208 @@
+# benchmark_parser.py
+"""
+Офлайн-бенчмарк стратегий извлечения изображения на сохраненных страницах domens/*.html.
+
+Для каждой пары (фикстура, стратегия) выполняет заданное число повторов и выводит
+перцентили задержки, число блоков памяти, оставшихся после вызова (результат и кэши),
+и пиковую память вызова (tracemalloc).
+Сеть не используется.
+
+Примеры:
+    python benchmark_parser.py                          # таблица по всем фикстурам
+    python benchmark_parser.py --json bench.json        # сохранить результаты
+    python benchmark_parser.py --compare bench.json     # сравнить с сохраненными результатами
+    python benchmark_parser.py --against HEAD~3         # сравнить с image_parser.py из другого коммита
+"""
+import argparse
+import glob
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_FIXTURES = os.path.join(REPO_DIR, 'domens', '*.html')
+
+# Имя файла фикстуры -> домен, от имени которого страница разбирается
+FIXTURE_DOMAINS = {
+    'ktc': 'ktc.ua',
+    'moyo': 'moyo.ua',
+    'rozetka': 'rozetka.com.ua',
+    'storeinua': 'storeinua.com',
+    'stylus': 'stylus.ua',
+    'ti.ua': 'ti.ua',
+}
+
+
+def _quiet(message):
+    """status_callback, который ничего не выводит (логи не должны влиять на замеры)."""
+
+
+def load_fixtures(pattern):
+    """Читает фикстуры и готовит для них базовый URL и входные данные srcset/кандидатов."""
+    from bs4 import BeautifulSoup
+    fixtures = []
+    for path in sorted(glob.glob(pattern)):
+        name = os.path.splitext(os.path.basename(path))[0]
+        domain = FIXTURE_DOMAINS.get(name, name)
+        with open(path, encoding='utf-8', errors='replace') as f: html = f.read()
+        soup = BeautifulSoup(html, 'html.parser')
+        srcsets = [tag['srcset'] for tag in soup.find_all(srcset=True)]
+        candidates = [tag.get('src') for tag in soup.find_all('img') if tag.get('src')]
+        fixtures.append({'name': name, 'domain': domain, 'base_url': f"https://{domain}/product/", 'html': html,
+                         'srcsets': srcsets, 'candidates': candidates})
+    return fixtures
+
+
+def build_strategies(ip):
+    """
+    Возвращает {имя: функция(fixture)} для стратегий, доступных в загруженной версии image_parser
+    (в старых коммитах части функций может не быть — такие стратегии пропускаются).
+    """
+    strategies = {
+        'schema': lambda fx: ip.find_image_url_from_schema(fx['html'], fx['base_url']),
+        'og_image': lambda fx: ip.find_image_url_from_og_image(fx['html'], fx['base_url']),
+        'css_selectors': lambda fx: ip.find_image_url_from_css_selectors(fx['html'], fx['domain'], fx['base_url'], _quiet),
+        'parse_srcset': lambda fx: [ip.parse_srcset(srcset, fx['base_url']) for srcset in fx['srcsets']],
+        'select_best_image_url': lambda fx: ip.select_best_image_url(list(fx['candidates']), fx['base_url'], _quiet),
+    }
+    if hasattr(ip, 'find_image_url_from_embedded_state'):
+        strategies['embedded_state'] = lambda fx: ip.find_image_url_from_embedded_state(fx['html'], fx['base_url'])
+    if hasattr(ip, 'make_soup'):
+        strategies['make_soup'] = lambda fx: type(ip.make_soup(fx['html'])).__name__
+    if hasattr(ip, 'find_image_url_from_html'):
+        strategies['find_image_url_from_html'] = lambda fx: ip.find_image_url_from_html(fx['html'], fx['domain'], fx['base_url'], _quiet)
+    return strategies
+
+
+def _percentile(sorted_values, fraction):
+    """Перцентиль с линейной интерполяцией по отсортированному списку."""
+    if not sorted_values: return 0.0
+    position = (len(sorted_values) - 1) * fraction
+    lower = int(position); upper = min(lower + 1, len(sorted_values) - 1)
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (position - lower)
+
+
+def measure(func, fixture, iterations, warmup):
+    """
+    Замеряет одну стратегию на одной фикстуре. Время — в миллисекундах, память — в КиБ.
+    retained_blocks — блоки, которые пережили вызов (результат, кэши модуля), а не число выделений:
+    временные объекты, освобожденные до возврата, в него не попадают — их отражает peak_kib.
+    """
+    for _ in range(warmup): result = func(fixture)
+    timings = []
+    for _ in range(iterations):
+        started = time.perf_counter(); result = func(fixture)
+        timings.append((time.perf_counter() - started) * 1000)
+    timings.sort()
+
+    # Память меряем отдельным вызовом: tracemalloc сильно замедляет выполнение
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    tracemalloc.reset_peak()
+    retained_result = func(fixture)
+    _, peak = tracemalloc.get_traced_memory()
+    after = tracemalloc.take_snapshot() # Снимок до освобождения результата: он входит в удержанные блоки
+    tracemalloc.stop()
+    del retained_result
+
+    return {
+        'iterations': iterations,
+        'p50_ms': _percentile(timings, 0.50),
+        'p90_ms': _percentile(timings, 0.90),
+        'p99_ms': _percentile(timings, 0.99),
+        'mean_ms': sum(timings) / len(timings),
+        'retained_blocks': sum(max(stat.count_diff, 0) for stat in after.compare_to(before, 'filename')),
+        'peak_kib': peak / 1024,
+        'result': result if isinstance(result, (str, list, type(None))) else repr(result),
+    }
+
+
+def run_benchmark(module_dir, fixtures_pattern, iterations, warmup, only=None):
+    """Импортирует image_parser из module_dir и замеряет все стратегии. Возвращает словарь результатов."""
+    sys.path.insert(0, module_dir)
+    import image_parser as ip
+    fixtures = load_fixtures(fixtures_pattern)
+    strategies = build_strategies(ip)
+    results = {}
+    for fixture in fixtures:
+        for name, func in strategies.items():
+            if only and name not in only: continue
+            results[f"{fixture['name']}/{name}"] = measure(func, fixture, iterations, warmup)
+    report = {'module': os.path.abspath(ip.__file__), 'html_parser': getattr(ip, 'HTML_PARSER', 'html.parser'),
+              'python': sys.version.split()[0], 'results': results}
+    try:
+        import resource
+        report['max_rss_kib'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss # Linux: КиБ
+    except ImportError:
+        pass
+    return report
+
+
+def print_report(report):
+    print(f"Модуль: {report['module']} (парсер HTML: {report['html_parser']}, Python {report['python']})")
+    print(f"{'фикстура/стратегия':<40} {'p50 мс':>9} {'p90 мс':>9} {'p99 мс':>9} {'удерж. блоки':>12} {'пик КиБ':>9}")
+    for key, row in report['results'].items():
+        print(f"{key:<40} {row['p50_ms']:>9.3f} {row['p90_ms']:>9.3f} {row['p99_ms']:>9.3f} {row['retained_blocks']:>12} {row['peak_kib']:>9.1f}")
+    if 'max_rss_kib' in report: print(f"Пиковый RSS процесса: {report['max_rss_kib'] / 1024:.1f} МиБ")
+
+
+def print_comparison(baseline, current):
+    """Сравнивает два отчета: отношение p50 и пиковой памяти, отличия в найденных URL."""
+    print(f"\nСравнение: база = {baseline['module']}")
+    print(f"{'фикстура/стратегия':<40} {'p50 база':>9} {'p50 тек.':>9} {'x':>6} {'пик база':>9} {'пик тек.':>9}  результат")
+    for key, row in current['results'].items():
+        base = baseline['results'].get(key)
+        if not base:
+            print(f"{key:<40} {'—':>9} {row['p50_ms']:>9.3f}"); continue
+        ratio = row['p50_ms'] / base['p50_ms'] if base['p50_ms'] else 0.0
+        same = 'совпадает' if base.get('result') == row.get('result') else 'ОТЛИЧАЕТСЯ'
+        print(f"{key:<40} {base['p50_ms']:>9.3f} {row['p50_ms']:>9.3f} {ratio:>6.2f} {base['peak_kib']:>9.1f} {row['peak_kib']:>9.1f}  {same}")
+
+
+def benchmark_revision(revision, args):
+    """Запускает этот же бенчмарк в отдельном процессе на image_parser.py из указанного коммита."""
+    source = subprocess.run(['git', 'show', f"{revision}:image_parser.py"], cwd=REPO_DIR, capture_output=True, check=True).stdout
+    with tempfile.TemporaryDirectory(prefix='bench_') as tmp_dir:
+        with open(os.path.join(tmp_dir, 'image_parser.py'), 'wb') as f: f.write(source)
+        json_path = os.path.join(tmp_dir, 'report.json')
+        command = [sys.executable, os.path.abspath(__file__), '--module-dir', tmp_dir, '--json', json_path, '--quiet',
+                   '--fixtures', args.fixtures, '--iterations', str(args.iterations), '--warmup', str(args.warmup)]
+        for name in args.strategy or []: command += ['--strategy', name]
+        subprocess.run(command, check=True)
+        with open(json_path, encoding='utf-8') as f: report = json.load(f)
+    report['module'] = f"{revision}:image_parser.py"
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Офлайн-бенчмарк стратегий извлечения изображения на domens/*.html")
+    parser.add_argument('--fixtures', default=DEFAULT_FIXTURES, help="Glob-шаблон HTML-фикстур")
+    parser.add_argument('--iterations', type=int, default=30, help="Число замеров на пару фикстура/стратегия")
+    parser.add_argument('--warmup', type=int, default=3, help="Число прогревочных вызовов")
+    parser.add_argument('--strategy', action='append', help="Замерять только указанные стратегии (можно повторять)")
+    parser.add_argument('--json', help="Сохранить результаты в JSON")
+    parser.add_argument('--compare', help="Сравнить с ранее сохраненным JSON")
+    parser.add_argument('--against', help="Сравнить с image_parser.py из указанного git-коммита")
+    parser.add_argument('--module-dir', default=REPO_DIR, help=argparse.SUPPRESS)
+    parser.add_argument('--quiet', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    baseline = None
+    if args.against: baseline = benchmark_revision(args.against, args)
+    elif args.compare:
+        with open(args.compare, encoding='utf-8') as f: baseline = json.load(f)
+
+    report = run_benchmark(args.module_dir, args.fixtures, args.iterations, args.warmup, args.strategy)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f: json.dump(report, f, ensure_ascii=False, indent=2)
+    if args.quiet: return
+    print_report(report)
+    if baseline: print_comparison(baseline, report)
+
+
+if __name__ == '__main__':
+    main()
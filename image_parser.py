@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 import csv
 import requests
+from requests.adapters import HTTPAdapter
 from bs4 import BeautifulSoup
 import os
 from urllib.parse import urlparse, urljoin
@@ -9,11 +10,20 @@ import threading
 import json
 import sys
 import random
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 import io
 import re
 import subprocess
 import shutil
+import atexit
+import asyncio
+import sqlite3
+import hashlib
+import logging
+import contextvars
+from collections import namedtuple, OrderedDict, deque
+from urllib.parse import parse_qsl, urlencode
+from email.utils import parsedate_to_datetime
 
 # Try loading environment variables from a .env file if available
 try:
@@ -40,6 +50,27 @@ except ImportError:
     class TimeoutException(Exception): pass
     class SeleniumNoSuchElementException(Exception): pass
 
+# Асинхронный HTTP-клиент httpx (необязательная зависимость, нужен для PARSER_ENGINE=asyncio)
+try:
+    import httpx
+    _httpx_available = True
+except ImportError:
+    _httpx_available = False
+
+# Pillow для конвертации изображений в памяти (необязательная зависимость; без нее используется ImageMagick)
+try:
+    from PIL import Image
+    _pil_available = True
+except ImportError:
+    _pil_available = False
+
+# Быстрый HTML-парсер lxml (необязательная зависимость)
+try:
+    import lxml  # noqa: F401
+    _lxml_available = True
+except ImportError:
+    _lxml_available = False
+
 
 # --- Настройки ---
 DEFAULT_CSV_FILE_PATH = 'SuperGraContent Sheet1.csv' # Путь по умолчанию к вашему CSV
@@ -55,9 +86,59 @@ CHROME_ARGS = os.environ.get('CHROME_ARGS', '')
 
 MAX_WORKERS = 4 # Количество потоков по умолчанию
 
+# Движок обработки строк: 'threads' (ThreadPoolExecutor) или 'asyncio' (httpx, сотни запросов одновременно)
+PARSER_ENGINE = os.environ.get('PARSER_ENGINE', 'threads').lower()
+# Максимум строк/соединений одновременно на быстром пути asyncio-движка
+ASYNC_MAX_CONNECTIONS = int(os.environ.get('ASYNC_MAX_CONNECTIONS', '200'))
+# Сколько строк CSV одновременно в работе на быстром пути (полоса 'http' RowScheduler). CSV читается потоково,
+# поэтому память не растет с размером файла. 0 — по умолчанию: число потоков (threads) или 2 × ASYNC_MAX_CONNECTIONS (asyncio)
+ROW_WINDOW = int(os.environ.get('ROW_WINDOW', '0'))
+# Сколько прочитанных строк ждут в очередях планировщика (по хостам); 0 — 4 × строк в работе
+ROW_LOOKAHEAD = int(os.environ.get('ROW_LOOKAHEAD', '0'))
+# Потоков стадии скачивания (threads) и сколько найденных URL может ждать скачивания; 0 — число потоков и 2 × DOWNLOAD_WORKERS
+DOWNLOAD_WORKERS = int(os.environ.get('DOWNLOAD_WORKERS', '0'))
+DOWNLOAD_QUEUE_SIZE = int(os.environ.get('DOWNLOAD_QUEUE_SIZE', '0'))
+SCHEDULER_POLL_INTERVAL = 0.5 # Секунды: как часто планировщик перепроверяет хосты на паузе, если строки не завершаются
+# Манифест папки загрузки: JSON-строка на каждую завершенную строку CSV (статус, URL изображения, размер, хеш, файл).
+# По нему run_parser(resume=True) пропускает уже сохраненные строки
+MANIFEST_FILENAME = os.environ.get('MANIFEST_FILENAME', '.parser_manifest.jsonl')
+
 # Ограничение параллельного Selenium (по умолчанию 1, регулируется через переменную окружения)
+# Определяет размер пула браузеров SELENIUM_POOL
 SELENIUM_CONCURRENCY = int(os.environ.get('SELENIUM_CONCURRENCY', '1'))
-SELENIUM_SEMAPHORE = threading.BoundedSemaphore(SELENIUM_CONCURRENCY)
+# После стольких страниц браузер из пула пересоздается (защита от утечек памяти Chrome)
+SELENIUM_MAX_PAGES_PER_DRIVER = int(os.environ.get('SELENIUM_MAX_PAGES_PER_DRIVER', '50'))
+# Стратегия загрузки страницы: 'eager' (DOM готов), 'none' (сразу после навигации) или 'normal' (все ресурсы)
+SELENIUM_PAGE_LOAD_STRATEGY = os.environ.get('SELENIUM_PAGE_LOAD_STRATEGY', 'eager').lower()
+# Общее ожидание появления любого из селекторов домена после навигации (секунды)
+SELENIUM_CONTENT_WAIT = int(os.environ.get('SELENIUM_CONTENT_WAIT', '20'))
+# Сколько еще ждать более приоритетный селектор, если первым появился запасной (секунды)
+SELENIUM_PRIORITY_GRACE = float(os.environ.get('SELENIUM_PRIORITY_GRACE', '0.5'))
+# Блокировка ненужных для поиска изображения ресурсов через CDP (Network.setBlockedURLs):
+# байты картинок, шрифты, медиа и сторонняя аналитика. Атрибуты src/srcset в DOM при этом остаются.
+SELENIUM_BLOCK_RESOURCES = os.environ.get('SELENIUM_BLOCK_RESOURCES', 'true').lower() == 'true'
+SELENIUM_BLOCKED_URLS = [
+    '*.jpg', '*.jpeg', '*.png', '*.gif', '*.webp', '*.avif', '*.svg', '*.ico', '*.bmp',  # Изображения
+    '*.woff', '*.woff2', '*.ttf', '*.otf', '*.eot',  # Шрифты
+    '*.mp4', '*.webm', '*.m3u8', '*.mp3', '*.ogg',  # Медиа
+    '*googletagmanager.com*', '*google-analytics.com*', '*doubleclick.net*', '*googlesyndication.com*',
+    '*facebook.net*', '*connect.facebook.*', '*hotjar.com*', '*clarity.ms*', '*mc.yandex.*', '*criteo.*',
+    '*tiktok.com*', '*analytics.tiktok*', '*youtube.com/embed*', '*bing.com/bat*', '*onesignal.com*', '*esputnik.com*',
+] + [pattern for pattern in re.split(r'[\s,]+', os.environ.get('SELENIUM_EXTRA_BLOCKED_URLS', '')) if pattern]
+
+# Уровень логов: 'DEBUG' — все шаги поиска (кандидаты, причины отбраковки), 'INFO' — основные события строки,
+# 'WARNING' — только ошибки строк. События ниже уровня отбрасываются до форматирования сообщения.
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+LOG_LEVEL_NO = logging.getLevelName(LOG_LEVEL) if isinstance(logging.getLevelName(LOG_LEVEL), int) else logging.INFO
+DEBUG_LOGS = LOG_LEVEL_NO <= logging.DEBUG
+# Пакетная доставка событий в status_callback: пачка уходит при LOG_BATCH_SIZE событиях
+# или не реже раза в LOG_FLUSH_INTERVAL секунд.
+LOG_BATCH_SIZE = int(os.environ.get('LOG_BATCH_SIZE', '50'))
+LOG_FLUSH_INTERVAL = float(os.environ.get('LOG_FLUSH_INTERVAL', '0.25'))
+
+# Бэкенд BeautifulSoup: lxml, если установлен (заметно быстрее), иначе встроенный html.parser.
+# Можно переопределить через переменную окружения HTML_PARSER.
+HTML_PARSER = os.environ.get('HTML_PARSER') or ('lxml' if _lxml_available else 'html.parser')
 
 USER_AGENTS = [
     'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0.0.0 Safari/537.36',
@@ -79,6 +160,90 @@ BASE_HEADERS = {
     'Referer': 'https://www.google.com/', # Общий реферер
 }
 
+# Приведение изображений к целевому размеру из имени файла (например, "..._296х296") или 3-й колонки CSV
+RESIZE_TO_TARGET = os.environ.get('RESIZE_TO_TARGET', 'false').lower() == 'true'
+# Цвет полей при вписывании изображения в целевой размер
+RESIZE_BACKGROUND = (255, 255, 255)
+# Размер вида 296x296 / 296х296 (кириллическая «х») / 296×296 в конце имени файла
+_TARGET_SIZE_RE = re.compile(r'(\d{2,5})\s*[xXхХ×]\s*(\d{2,5})\s*$')
+
+# --- Кэш «URL товара -> URL изображения» между запусками ---
+RESOLUTION_CACHE_ENABLED = os.environ.get('RESOLUTION_CACHE_ENABLED', 'true').lower() == 'true'
+RESOLUTION_CACHE_PATH = os.environ.get('RESOLUTION_CACHE_PATH') or os.path.join(os.path.dirname(os.path.abspath(__file__)), '.cache', 'resolution_cache.sqlite3')
+RESOLUTION_CACHE_TTL = int(os.environ.get('RESOLUTION_CACHE_TTL', str(30 * 24 * 3600))) # Секунды (по умолчанию 30 дней)
+RESOLUTION_CACHE_MAX_ENTRIES = int(os.environ.get('RESOLUTION_CACHE_MAX_ENTRIES', '50000'))
+# Параметры запроса, которые не влияют на страницу товара и не должны попадать в ключ кэша:
+# все с префиксом TRACKING_QUERY_PREFIX и перечисленные имена (сравниваются целиком, чтобы не терять referrer, refid и т.п.)
+TRACKING_QUERY_PREFIX = 'utm_'
+TRACKING_QUERY_PARAMS = frozenset({'gclid', 'fbclid', 'yclid', '_gl', 'ref'})
+
+# --- Хранилище изображений по содержимому (дедупликация между строками и запусками) ---
+IMAGE_STORE_ENABLED = os.environ.get('IMAGE_STORE_ENABLED', 'true').lower() == 'true'
+IMAGE_STORE_DIR = os.environ.get('IMAGE_STORE_DIR') or os.path.join(os.path.dirname(os.path.abspath(__file__)), '.cache', 'images')
+IMAGE_STORE_MAX_AGE = int(os.environ.get('IMAGE_STORE_MAX_AGE', '86400')) # Секунды, в течение которых сохраненное изображение не перепроверяется (0 — проверять всегда)
+
+# --- Адаптивная маршрутизация по доменам (статистика прошлых запусков) ---
+DOMAIN_ROUTING_ENABLED = os.environ.get('DOMAIN_ROUTING_ENABLED', 'true').lower() == 'true'
+DOMAIN_STATS_PATH = os.environ.get('DOMAIN_STATS_PATH') or os.path.join(os.path.dirname(os.path.abspath(__file__)), '.cache', 'domain_stats.sqlite3')
+ROUTING_MIN_ATTEMPTS = int(os.environ.get('ROUTING_MIN_ATTEMPTS', '5')) # Попыток до того, как статистика влияет на маршрут
+ROUTING_FAST_MIN_SUCCESS = float(os.environ.get('ROUTING_FAST_MIN_SUCCESS', '0.2')) # Ниже этой доли успехов быстрый путь пропускается
+ROUTING_PROBE_RATE = float(os.environ.get('ROUTING_PROBE_RATE', '0.1')) # Доля строк, где быстрый путь проверяется несмотря на статистику
+HTML_STRATEGIES = ('schema', 'og_image', 'css') # Порядок стратегий по умолчанию
+
+# Пул потоков для конвертации изображений (не занимает сетевые потоки/event loop)
+CONVERSION_WORKERS = int(os.environ.get('CONVERSION_WORKERS', str(os.cpu_count() or 2)))
+CONVERSION_EXECUTOR = ThreadPoolExecutor(max_workers=max(1, CONVERSION_WORKERS), thread_name_prefix='convert')
+
+# --- Пул HTTP-соединений ---
+# Размер пула keep-alive соединений на хост по умолчанию (не меньше числа потоков run_parser)
+HTTP_POOL_MAXSIZE = int(os.environ.get('HTTP_POOL_MAXSIZE', '10'))
+# Индивидуальные размеры пула для хостов, куда идет основная нагрузка (страницы и CDN изображений)
+HTTP_HOST_POOL_SIZES = {
+    'rozetka.com.ua': 8,
+    'bt.rozetka.com.ua': 8,
+    'hard.rozetka.com.ua': 8,
+    'content.rozetka.com.ua': 8,
+    'content1.rozetka.com.ua': 8,
+    'content2.rozetka.com.ua': 8,
+    'moyo.ua': 6,
+    'i.moyo.ua': 6,
+    'www.ctrs.com.ua': 6,
+    'ti.ua': 6,
+    'stylus.ua': 6,
+}
+
+# --- Ограничение нагрузки на хосты (HostLimiter) ---
+# Скорость (запросов в секунду, 0 — без ограничения), запас токенов и максимум одновременных запросов на один хост
+HOST_RATE_LIMIT = float(os.environ.get('HOST_RATE_LIMIT', '5'))
+HOST_BURST = int(os.environ.get('HOST_BURST', '5'))
+HOST_MAX_CONCURRENCY = int(os.environ.get('HOST_MAX_CONCURRENCY', '6'))
+# Индивидуальные ограничения (скорость, одновременных запросов); действуют и на поддомены
+HOST_LIMITS = {
+    'rozetka.com.ua': (3, 4),
+    'moyo.ua': (3, 4),
+}
+HTTP_RETRY_STATUSES = {429, 503} # Повторяются с паузой (Retry-After или экспоненциальная)
+HOST_THROTTLE_STATUSES = {403, 429, 503} # Снижают скорость хоста и ставят его на паузу
+HTTP_MAX_RETRIES = int(os.environ.get('HTTP_MAX_RETRIES', '3'))
+HOST_BACKOFF_BASE = float(os.environ.get('HOST_BACKOFF_BASE', '1')) # Секунды, удваиваются при каждом подряд ответе-ограничении
+HOST_BACKOFF_MAX = float(os.environ.get('HOST_BACKOFF_MAX', '60')) # Предел паузы (и Retry-After)
+
+# Домены, для которых быстрый парсинг пропускается и сразу используется Selenium
+FORCE_SELENIUM_DOMAINS = ['rozetka.com.ua', 'bt.rozetka.com.ua', 'hard.rozetka.com.ua']
+
+# --- Легкий режим без браузера: встроенное состояние приложения и product API ---
+EMBEDDED_STATE_ENABLED = os.environ.get('EMBEDDED_STATE_ENABLED', 'true').lower() == 'true' # Для этих доменов Selenium — только если легкий режим не сработал
+ROZETKA_PRODUCT_API = 'https://product-api.rozetka.company/v4/goods/get-main?country=UA&lang=ru&goodsId={goods_id}'
+EMBEDDED_STATE_DOMAINS = { # Домен -> шаблон URL product API (тот же запрос, что делает сама страница)
+    'rozetka.com.ua': ROZETKA_PRODUCT_API,
+    'bt.rozetka.com.ua': ROZETKA_PRODUCT_API,
+    'hard.rozetka.com.ua': ROZETKA_PRODUCT_API,
+}
+PRODUCT_ID_RE = re.compile(r'/p(\d+)(?:/|$)') # rozetka.com.ua/<slug>/p385515906/
+EMBEDDED_IMAGE_SIZES = ('big', 'original', 'large', 'base_action', 'medium', 'url') # 'big' — то же, что показывает галерея
+# Экранирование строк в Angular TransferState (rz-client-state)
+TRANSFER_STATE_ESCAPES = (('$hs$', 'https://'), ('$ht$', 'http://'), ('$dt$', '.'), ('$sh$', '/'), ('$qr$', '?'), ('$ad$', '&'))
+
 # --- Обновленный словарь селекторов ---
 DOMAIN_SELECTORS = {
     'rozetka.com.ua': [
@@ -170,8 +335,177 @@ DOMAIN_SELECTORS = {
 
 # --- Функции ---
 
-def _log_status(message, status_callback=None):
-    """Логирует сообщение через callback (для GUI) или print (для консоли)."""
+def parse_retry_after(value):
+    """Retry-After в секундах (число секунд или HTTP-дата) или None."""
+    if not value: return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class _HostState:
+    __slots__ = ('rate', 'tokens', 'updated', 'in_flight', 'blocked_until', 'failures')
+
+    def __init__(self, rate, burst):
+        self.rate = rate; self.tokens = float(burst); self.updated = time.monotonic()
+        self.in_flight = 0; self.blocked_until = 0.0; self.failures = 0
+
+
+class HostLimiter:
+    """
+    Ограничение запросов по хостам на один запуск run_parser: token bucket (скорость и запас),
+    максимум одновременных запросов и пауза хоста после 429/403/503. На каждый ответ-ограничение
+    скорость хоста уменьшается вдвое, а пауза — Retry-After или экспоненциальная; успешные ответы
+    постепенно возвращают скорость к исходной (AIMD). Работает и из потоков, и из asyncio.
+    """
+    def __init__(self, rate=HOST_RATE_LIMIT, burst=HOST_BURST, max_concurrency=HOST_MAX_CONCURRENCY, host_limits=None, status_callback=None):
+        self.rate = rate; self.burst = max(1, burst); self.max_concurrency = max_concurrency
+        self.host_limits = HOST_LIMITS if host_limits is None else host_limits
+        self.status_callback = status_callback
+        self._hosts = {}; self._cond = threading.Condition()
+
+    def limits(self, host):
+        """(скорость, одновременных запросов) для хоста: из host_limits (с учетом поддоменов) или общие."""
+        for suffix, limits in self.host_limits.items():
+            if host == suffix or host.endswith('.' + suffix): return limits
+        return self.rate, self.max_concurrency
+
+    def _try_acquire(self, host):
+        """Под блокировкой: 0 — слот получен, иначе секунды ожидания (None — ждать освобождения слота)."""
+        rate, concurrency = self.limits(host)
+        state = self._hosts.get(host)
+        if state is None: state = self._hosts[host] = _HostState(rate, self.burst)
+        now = time.monotonic()
+        if now < state.blocked_until: return state.blocked_until - now
+        if concurrency and state.in_flight >= concurrency: return None
+        if state.rate:
+            state.tokens = min(self.burst, state.tokens + (now - state.updated) * state.rate); state.updated = now
+            if state.tokens < 1: return (1 - state.tokens) / state.rate
+            state.tokens -= 1
+        state.in_flight += 1
+        return 0
+
+    def acquire(self, host):
+        """Блокирует поток до получения слота хоста."""
+        with self._cond:
+            while True:
+                delay = self._try_acquire(host)
+                if delay == 0: return
+                self._cond.wait(1.0 if delay is None else delay)
+
+    async def acquire_async(self, host):
+        """То же для asyncio: ожидание не занимает event loop."""
+        while True:
+            with self._cond:
+                delay = self._try_acquire(host)
+            if delay == 0: return
+            await asyncio.sleep(0.02 if delay is None else delay)
+
+    def paused(self, host):
+        """True, если хост на паузе после ответа-ограничения."""
+        with self._cond:
+            state = self._hosts.get(host)
+            return state is not None and time.monotonic() < state.blocked_until
+
+    def release(self, host, status=None, retry_after=None):
+        """Освобождает слот и учитывает ответ хоста. Возвращает паузу хоста в секундах (0 — без паузы)."""
+        pause = 0.0
+        with self._cond:
+            state = self._hosts[host]; state.in_flight -= 1
+            base_rate = self.limits(host)[0]
+            if status in HOST_THROTTLE_STATUSES:
+                state.failures += 1
+                if state.rate: state.rate = max(base_rate / 16, state.rate / 2)
+                pause = parse_retry_after(retry_after) # Пауза, которую назвал сам хост, иначе экспоненциальная с разбросом
+                if pause is None: pause = HOST_BACKOFF_BASE * 2 ** (state.failures - 1) * random.uniform(1, 1.5)
+                pause = min(HOST_BACKOFF_MAX, pause)
+                state.blocked_until = max(state.blocked_until, time.monotonic() + pause)
+            elif status is not None and status < 400:
+                state.failures = 0
+                if state.rate and state.rate < base_rate: state.rate = min(base_rate, state.rate + base_rate / 10)
+            rate = state.rate
+            self._cond.notify_all()
+        if pause:
+            _log_warning(f"THROTTLE: {host} ответил {status}, пауза {pause:.1f} с, скорость {rate:.2f} запр./с", self.status_callback)
+        return pause
+
+
+class SharedHttpSession(requests.Session):
+    """
+    Потокобезопасная HTTP-сессия на весь запуск run_parser: keep-alive соединения
+    переиспользуются между строками и скачиваниями изображений, размер пула
+    настраивается по хостам (HTTP_HOST_POOL_SIZES). User-Agent выбирается из
+    USER_AGENTS случайно для каждого запроса. С limiter (HostLimiter) запросы идут
+    в пределах ограничений хоста, ответы 429/503 повторяются до HTTP_MAX_RETRIES раз.
+    """
+    def __init__(self, pool_maxsize=HTTP_POOL_MAXSIZE, host_pool_sizes=None, limiter=None):
+        super().__init__()
+        self.limiter = limiter
+        self.headers.update(BASE_HEADERS)
+        default_adapter = HTTPAdapter(pool_connections=32, pool_maxsize=pool_maxsize)
+        self.mount('http://', default_adapter); self.mount('https://', default_adapter)
+        for host, size in (HTTP_HOST_POOL_SIZES if host_pool_sizes is None else host_pool_sizes).items():
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(size, pool_maxsize))
+            self.mount(f'http://{host}/', adapter); self.mount(f'https://{host}/', adapter)
+
+    def request(self, method, url, **kwargs):
+        headers = dict(kwargs.pop('headers', None) or {})
+        headers.setdefault('User-Agent', random.choice(USER_AGENTS)) # Ротация UA на каждый запрос
+        if self.limiter is None: return super().request(method, url, headers=headers, **kwargs)
+        host = urlparse(url).hostname or ''
+        for attempt in range(HTTP_MAX_RETRIES + 1):
+            self.limiter.acquire(host); response = None
+            try:
+                response = super().request(method, url, headers=headers, **kwargs)
+            finally:
+                self.limiter.release(host, response.status_code if response is not None else None,
+                                     response.headers.get('Retry-After') if response is not None else None)
+            if response.status_code not in HTTP_RETRY_STATUSES or attempt == HTTP_MAX_RETRIES: return response
+            response.close() # Повтор после паузы хоста (ее выдерживает acquire)
+
+
+class LogEvent(namedtuple('LogEvent', 'ts level stage message row_id duration')):
+    """
+    Событие лога: время (time.time()), уровень (logging.DEBUG/INFO/WARNING), этап ('DOWNLOAD', 'SELENIUM', 'ROW'...),
+    текст, номер строки CSV (None вне строки) и длительность этапа в секундах (если измерялась).
+    """
+    __slots__ = ()
+
+    def format(self):
+        """Строка для вывода: текст и, если есть, длительность."""
+        return self.message if self.duration is None else f"{self.message} ({self.duration:.2f} с)"
+
+
+_STAGE_RE = re.compile(r'([A-Z][A-Z_]+)(?: \[[^\]]*\])?:')
+_CURRENT_ROW = contextvars.ContextVar('image_parser_row', default=None) # Номер строки CSV текущей задачи
+
+
+def _stage_of(message):
+    """Этап по префиксу сообщения ('DOWNLOAD: ...' -> 'DOWNLOAD')."""
+    match = _STAGE_RE.match(message)
+    return match.group(1) if match else ''
+
+
+def log_event(status_callback, level, stage, message, *args, duration=None, row_id=None):
+    """
+    Структурированный лог. Событие ниже LOG_LEVEL отбрасывается сразу: %-подстановка args не выполняется.
+    Если status_callback — EventLog (или другой объект с emit), ему уходит LogEvent, иначе — готовая строка.
+    """
+    if level < LOG_LEVEL_NO: return
+    if args: message = message % args
+    emit = getattr(status_callback, 'emit', None)
+    if emit is None:
+        _write_status(message if duration is None else f"{message} ({duration:.2f} с)", status_callback); return
+    emit(LogEvent(time.time(), level, stage, message, _CURRENT_ROW.get() if row_id is None else row_id, duration))
+
+
+def _write_status(message, status_callback=None):
+    """Передает строку в callback (для GUI) или print (для консоли)."""
     if status_callback:
         status_callback(message)
     else:
@@ -181,6 +515,95 @@ def _log_status(message, status_callback=None):
         sys.stdout.flush()
 
 
+def _log_status(message, status_callback=None):
+    """Логирует сообщение уровня INFO; этап берется из префикса сообщения."""
+    if LOG_LEVEL_NO > logging.INFO: return
+    if getattr(status_callback, 'emit', None) is None: _write_status(message, status_callback); return
+    log_event(status_callback, logging.INFO, _stage_of(message), message)
+
+
+def _log_debug(status_callback, message, *args):
+    """
+    Подробный лог (кандидаты, пропуски, промежуточные списки): пишется только при LOG_LEVEL=DEBUG.
+    Форматирование в стиле %-подстановки выполняется лишь тогда, когда сообщение действительно нужно.
+    """
+    if not DEBUG_LOGS: return
+    log_event(status_callback, logging.DEBUG, _stage_of(message), message, *args)
+
+
+def _log_warning(message, status_callback=None):
+    """Логирует ошибку уровня WARNING (видна и при LOG_LEVEL=WARNING)."""
+    log_event(status_callback, logging.WARNING, _stage_of(message), message)
+
+
+class EventLog:
+    """
+    Буфер событий поверх status_callback запуска. Сам вызывается как обычный callback и принимает LogEvent через emit.
+    Пачки уходят в callback.log_batch(events), если он есть, иначе — построчно в callback(message) (или print).
+    Отправку выполняет фоновый поток не реже раза в flush_interval; flush() / close() отдают остаток сразу.
+    """
+    def __init__(self, callback, batch_size=LOG_BATCH_SIZE, flush_interval=LOG_FLUSH_INTERVAL):
+        # Консольный запуск передает _log_status: события уже прошли фильтр уровня в log_event, и повторный
+        # INFO-фильтр _log_status скрыл бы WARNING при LOG_LEVEL=WARNING — печатаем их напрямую
+        if callback is _log_status: callback = None
+        self.callback = callback; self.batch_size = max(1, batch_size); self.flush_interval = flush_interval
+        self._batch_handler = getattr(callback, 'log_batch', None)
+        self._events = []; self._lock = threading.RLock(); self._closed = threading.Event()
+        self._flusher = threading.Thread(target=self._flush_loop, name='EventLogFlusher', daemon=True)
+        self._flusher.start()
+
+    def __call__(self, message):
+        _log_status(message, self)
+
+    def emit(self, event):
+        with self._lock:
+            self._events.append(event)
+            if len(self._events) >= self.batch_size: self.flush()
+
+    def flush(self):
+        with self._lock: # Доставка под блокировкой сохраняет порядок пачек между потоками
+            if not self._events: return
+            batch = self._events; self._events = []
+            if self._batch_handler: self._batch_handler(batch); return
+            for event in batch: _write_status(event.format(), self.callback)
+
+    def _flush_loop(self):
+        while not self._closed.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as flush_err:
+                print(f"LOG: Ошибка доставки логов: {flush_err}")
+
+    def close(self):
+        self._closed.set(); self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _call_with_row(row_id, row_info, func, *args):
+    """Выполняет func(*args) с номером строки в контексте логов; время обработки пишется в row_info['duration']."""
+    token = _CURRENT_ROW.set(row_id); started = time.perf_counter()
+    try:
+        return func(*args)
+    finally:
+        row_info['duration'] = time.perf_counter() - started
+        _CURRENT_ROW.reset(token)
+
+
+def _submit(executor, func, *args):
+    """executor.submit с переносом контекста (номера строки для логов) в рабочий поток."""
+    return executor.submit(contextvars.copy_context().run, func, *args)
+
+
+def _run_in_executor(loop, executor, func, *args):
+    """loop.run_in_executor с переносом контекста (номера строки для логов) в рабочий поток."""
+    return loop.run_in_executor(executor, contextvars.copy_context().run, func, *args)
+
+
 def get_domain(url):
     """Извлекает основной домен (и поддомены для известных случаев) из URL."""
     try:
@@ -194,6 +617,19 @@ def get_domain(url):
         else: return netloc
     except Exception: return None
 
+def make_soup(html_content):
+    """
+    Строит дерево BeautifulSoup один раз для всех стратегий поиска.
+    Если передано уже готовое дерево, возвращает его без повторного парсинга.
+    """
+    if isinstance(html_content, BeautifulSoup): return html_content
+    try:
+        return BeautifulSoup(html_content, HTML_PARSER)
+    except Exception:
+        # Например, HTML_PARSER указан, но бэкенд не установлен
+        return BeautifulSoup(html_content, 'html.parser')
+
+
 # --- Новая функция для парсинга srcset ---
 def parse_srcset(srcset_string, base_url):
     """Парсит атрибут srcset и возвращает URL для наибольшей ширины."""
@@ -214,8 +650,8 @@ def parse_srcset(srcset_string, base_url):
 
 
 def find_image_url_from_schema(html_content, base_url):
-    """Находит URL изображения в Schema.org (ld+json)."""
-    soup = BeautifulSoup(html_content, 'html.parser')
+    """Находит URL изображения в Schema.org (ld+json). Принимает HTML-строку или готовый soup."""
+    soup = make_soup(html_content)
     try:
         schema_tags = soup.find_all('script', type='application/ld+json')
         for tag in schema_tags:
@@ -273,9 +709,88 @@ def find_image_url_from_product_schema(schema_data, base_url):
     return None
 
 
+def _unescape_transfer_state(value):
+    for escaped, plain in TRANSFER_STATE_ESCAPES: value = value.replace(escaped, plain)
+    return value
+
+
+def _image_url_from_images(images):
+    """Берет URL первого изображения из списка вида [{'big': {'url': ...}, 'original': {...}}, ...] или ['url', ...]."""
+    first = images[0]
+    if isinstance(first, str): return first
+    if not isinstance(first, dict): return None
+    for size in EMBEDDED_IMAGE_SIZES:
+        value = first.get(size)
+        if isinstance(value, dict): value = value.get('url')
+        if isinstance(value, str) and value: return value
+    return None
+
+
+def _find_product_image_in_state(node, depth=0):
+    """
+    Рекурсивно ищет в разобранном JSON состояния объект товара со списком 'images'.
+    Строки-JSON (например, закэшированные тела ответов API в TransferState) разбираются на лету.
+    Записи, похожие на основной запрос товара (get-main), проверяются первыми.
+    """
+    if depth > 8: return None
+    if isinstance(node, str):
+        stripped = node.lstrip()
+        if not stripped.startswith(('{"data"', '{"images"')): return None
+        try: node = json.loads(stripped)
+        except ValueError: return None
+    if isinstance(node, dict):
+        images = node.get('images')
+        if isinstance(images, list) and images and ('id' in node or 'title' in node):
+            image_url = _image_url_from_images(images)
+            if image_url: return image_url
+        keys = sorted(node, key=lambda key: 'get-main' not in str(key))
+        for key in keys:
+            image_url = _find_product_image_in_state(node[key], depth + 1)
+            if image_url: return image_url
+    elif isinstance(node, list):
+        for item in node[:50]:
+            image_url = _find_product_image_in_state(item, depth + 1)
+            if image_url: return image_url
+    return None
+
+
+def find_image_url_from_embedded_state(html_content, base_url):
+    """
+    Находит главное изображение во встроенном состоянии приложения (<script type="application/json">,
+    например rz-client-state у Rozetka). Принимает HTML-строку или готовый soup.
+    """
+    soup = make_soup(html_content)
+    try:
+        for tag in soup.find_all('script', type='application/json'):
+            if not tag.string: continue
+            try: state = json.loads(tag.string)
+            except ValueError: continue
+            image_url = _find_product_image_in_state(state)
+            if image_url: return urljoin(base_url, _unescape_transfer_state(image_url))
+    except Exception: pass
+    return None
+
+
+def product_api_url(product_url):
+    """URL product API для товара (по EMBEDDED_STATE_DOMAINS и id из URL) или None."""
+    template = EMBEDDED_STATE_DOMAINS.get(get_domain(product_url)) if EMBEDDED_STATE_ENABLED else None
+    match = PRODUCT_ID_RE.search(urlparse(product_url).path) if template else None
+    return template.format(goods_id=match.group(1)) if match else None
+
+
+def find_image_url_from_product_api(payload, base_url):
+    """Находит главное изображение в ответе product API (JSON-строка или уже разобранный объект)."""
+    try:
+        data = json.loads(payload) if isinstance(payload, (str, bytes)) else payload
+        image_url = _find_product_image_in_state(data)
+        return urljoin(base_url, _unescape_transfer_state(image_url)) if image_url else None
+    except Exception:
+        return None
+
+
 def find_image_url_from_og_image(html_content, base_url):
-    """Находит URL изображения в Open Graph meta tag."""
-    soup = BeautifulSoup(html_content, 'html.parser')
+    """Находит URL изображения в Open Graph meta tag. Принимает HTML-строку или готовый soup."""
+    soup = make_soup(html_content)
     try:
         og_image_tag = soup.find('meta', property='og:image')
         if og_image_tag and og_image_tag.get('content'):
@@ -289,171 +804,159 @@ def find_image_url_from_og_image(html_content, base_url):
 
 
 # --- Функция для улучшения URL-адресов изображений ---
+# --- Правила улучшения URL по доменам: (подстрока хоста, регулярное выражение, замена) ---
+URL_IMPROVE_RULES = [
+    ('citrus.world', re.compile(r'size_\d+'), 'size_800'), # size_150 -> size_800
+]
+
+
 def improve_image_url(url, status_callback=None):
     """
-    Улучшает URL-адреса изображений, заменяя маленькие размеры на большие.
+    Улучшает URL-адреса изображений, заменяя маленькие размеры на большие (правила URL_IMPROVE_RULES).
     В частности, для домена citrus.world заменяет size_150 на size_800.
     """
     if not url or not isinstance(url, str):
         return url
-    
+
     try:
-        # Проверяем, содержит ли URL домен citrus.world и размер вида size_XXX
-        if 'citrus.world' in url.lower() and re.search(r'size_\d+', url):
-            # Используем re.sub для замены size_XXX на size_800
-            improved_url = re.sub(r'size_\d+', 'size_800', url)
-            if improved_url != url: # Логируем только если замена произошла
-                _log_status(f"URL_IMPROVE: Заменен размер в URL: {url} -> {improved_url}", status_callback)
-            return improved_url
-        
-        # Здесь можно добавить другие правила улучшения URL для других доменов
-        
+        lower_url = url.lower()
+        for host_part, pattern, replacement in URL_IMPROVE_RULES:
+            if host_part in lower_url and pattern.search(url):
+                improved_url = pattern.sub(replacement, url)
+                if improved_url != url: # Логируем только если замена произошла
+                    _log_status(f"URL_IMPROVE: Заменен размер в URL: {url} -> {improved_url}", status_callback)
+                return improved_url
         return url
     except Exception as e:
         _log_status(f"URL_IMPROVE: Ошибка при улучшении URL {url}: {e}", status_callback)
         return url  # В случае ошибки возвращаем исходный URL
 
+
+def _keyword_regex(keywords):
+    """Одно регулярное выражение «любая из подстрок» вместо any(kw in s for kw in keywords)."""
+    return re.compile('|'.join(re.escape(keyword) for keyword in keywords))
+
+
+class ImageUrlScorer:
+    """
+    Эвристики select_best_image_url, скомпилированные один раз: списки ключевых слов
+    превращаются в регулярные выражения, кандидаты фильтруются и оцениваются за один проход.
+    """
+    # Заведомо неподходящие URL (плейсхолдеры, иконки, трекеры)
+    SKIP_KEYWORDS = ['placeholder', 'stub', 'sprite', 'logo', 'icon', 'loader', 'spinner', 'avatar', 'dummy', 'blank', 'banner', 'ads', 'pixel', 'track', 'default', '/svg/']
+    IMAGE_EXTENSIONS = ['.jpg', '.jpeg', '.png', '.webp', '.gif', '.bmp', '.tif', '.tiff']
+    HIGH_RES_KEYWORDS = ['/original/', '/source/', '/big/', '/large/', '_xl.', '_large.', 'zoom', 'full', 'master', 'hires', 'maxres'] # +100
+    MEDIUM_RES_KEYWORDS = ['/medium/', '/med/', '_medium.', '_m.', '/product/', '/catalog/'] # +10
+    LOW_RES_KEYWORDS = ['/small/', '/thumb', '_small.', '_s.', '_thumb.', 'preview', 'mini', 'icon', 'logo', '/100x', '/200x', '/300x', 'tile'] # -50
+    PREFERRED_EXTENSIONS = ('.jpg', '.jpeg', '.png') # +1 при равном приоритете
+
+    def __init__(self):
+        self.skip_re = _keyword_regex(self.SKIP_KEYWORDS)
+        self.extension_re = _keyword_regex(self.IMAGE_EXTENSIONS)
+        self.image_extensions = tuple(self.IMAGE_EXTENSIONS)
+        self.high_res_re = _keyword_regex(self.HIGH_RES_KEYWORDS)
+        self.medium_res_re = _keyword_regex(self.MEDIUM_RES_KEYWORDS)
+        self.low_res_re = _keyword_regex(self.LOW_RES_KEYWORDS)
+        self.resolution_re = re.compile(r'(\d{3,})[xX](\d{3,})')
+
+    def rejection_reason(self, full_url, parsed_url, lower_url):
+        """Причина отбраковки кандидата или None, если URL похож на изображение товара."""
+        if not parsed_url.scheme or not parsed_url.netloc: return "невалидная структура URL"
+        if 'data:image' in lower_url: return "data URI"
+        if self.skip_re.search(lower_url): return "похож на плейсхолдер/иконку/трекер"
+        if not lower_url.endswith(self.image_extensions):
+            # Расширения нет в конце — ищем его в пути или параметрах запроса
+            if not (self.extension_re.search(parsed_url.path.lower()) or self.extension_re.search(parsed_url.query.lower())):
+                return "нет явного расширения изображения"
+        return None
+
+    def score(self, url):
+        """Приоритет кандидата: ключевые слова разрешения, размеры WxH в URL, формат."""
+        lower_url = url.lower(); priority = 0
+        if self.high_res_re.search(lower_url): priority += 100
+        if self.medium_res_re.search(lower_url): priority += 10
+        if self.low_res_re.search(lower_url): priority -= 50
+        resolution_match = self.resolution_re.search(url)
+        if resolution_match:
+            w, h = int(resolution_match.group(1)), int(resolution_match.group(2))
+            priority += min(40, (w * h) // 50000) # Бонус до 40 очков за площадь
+        if lower_url.endswith(self.PREFERRED_EXTENSIONS): priority += 1
+        return priority
+
+
+IMAGE_URL_SCORER = ImageUrlScorer()
+
+
 # --- Новая функция для выбора лучшего URL из кандидатов ---
 def select_best_image_url(candidates, base_url, status_callback=None):
-    """Фильтрует и выбирает лучший URL изображения из списка кандидатов, отдавая приоритет высокому разрешению."""
+    """
+    Фильтрует и выбирает лучший URL изображения из списка кандидатов, отдавая приоритет высокому разрешению.
+    Фильтрация и оценка — за один проход через IMAGE_URL_SCORER; подробности пишутся только при LOG_LEVEL=DEBUG.
+    """
     if not candidates:
-        _log_status("BEST_URL: Нет кандидатов для выбора.", status_callback)
+        _log_debug(status_callback, "BEST_URL: Нет кандидатов для выбора.")
         return None
 
-    valid_urls = []
-    _log_status(f"BEST_URL: Получены кандидаты: {candidates}", status_callback)
+    scorer = IMAGE_URL_SCORER
+    _log_debug(status_callback, "BEST_URL: Получены кандидаты: %s", candidates)
+    scored = {} # url -> приоритет; dict сохраняет порядок первого появления (дедупликация за O(n))
     for url in candidates:
         if not url or not isinstance(url, str):
             continue
         try:
             full_url = urljoin(base_url, url.strip())
-            # Базовая валидация и фильтрация
-            parsed_url = urlparse(full_url)
-            if not parsed_url.scheme or not parsed_url.netloc:
-                 _log_status(f"BEST_URL: Пропуск невалидной структуры URL: {full_url}", status_callback)
-                 continue
-            if 'data:image' in full_url.lower():
-                 _log_status(f"BEST_URL: Пропуск data URI: {full_url[:100]}...", status_callback)
-                 continue
             lower_url = full_url.lower()
-            # Исключаем заведомо неподходящие URL
-            skip_keywords = ['placeholder', 'stub', 'sprite', 'logo', 'icon', 'loader', 'spinner', 'avatar', 'dummy', 'blank', 'banner', 'ads', 'pixel', 'track', 'default', '/svg/']
-            if any(kw in lower_url for kw in skip_keywords):
-                 _log_status(f"BEST_URL: Пропуск URL, похожего на плейсхолдер/иконку/трекер: {full_url}", status_callback)
-                 continue
-            # Проверка на распространенные расширения изображений (в конце или как часть пути)
-            image_extensions = ['.jpg', '.jpeg', '.png', '.webp', '.gif', '.bmp', '.tif', '.tiff']
-            has_image_extension = any(lower_url.endswith(ext) for ext in image_extensions)
-            if not has_image_extension:
-                 # Дополнительная проверка, если расширения нет в конце
-                 path_part = parsed_url.path.lower()
-                 query_part = parsed_url.query.lower()
-                 if not any(ext in path_part or ext in query_part for ext in image_extensions):
-                      # Попытка угадать по Content-Type (если бы мы делали HEAD запрос, но это медленно)
-                      # Пока будем строже: если нет расширения, пропускаем, кроме известных CDN паттернов (сложно)
-                      _log_status(f"BEST_URL: Пропуск URL без явного расширения изображения: {full_url}", status_callback)
-                      continue
-
-            # Улучшаем URL перед добавлением в список валидных
+            reason = scorer.rejection_reason(full_url, urlparse(full_url), lower_url)
+            if reason:
+                _log_debug(status_callback, "BEST_URL: Пропуск (%s): %s", reason, full_url[:200])
+                continue
             improved_url = improve_image_url(full_url, status_callback)
-            valid_urls.append(improved_url)
+            if improved_url not in scored: scored[improved_url] = scorer.score(improved_url)
         except Exception as e:
-             _log_status(f"BEST_URL: Ошибка обработки кандидата '{url}': {e}", status_callback)
+             _log_debug(status_callback, "BEST_URL: Ошибка обработки кандидата '%s': %s", url, e)
              continue
 
-
-    if not valid_urls:
-        _log_status(f"BEST_URL: Не найдено валидных URL изображений после фильтрации.", status_callback)
+    if not scored:
+        _log_debug(status_callback, "BEST_URL: Не найдено валидных URL изображений после фильтрации.")
         return None
 
-    # Удаление дубликатов с сохранением порядка (примерно)
-    unique_urls = sorted(list(set(valid_urls)), key=valid_urls.index)
-    _log_status(f"BEST_URL: Уникальные валидные кандидаты: {unique_urls}", status_callback)
-
-    # Приоритезация на основе ключевых слов и разрешения в URL
-    prioritized = []
-    for url in unique_urls:
-        lower_url = url.lower()
-        priority = 0 # Базовый приоритет
-
-        # Ключевые слова высокого разрешения
-        high_res_keywords = ['/original/', '/source/', '/big/', '/large/', '_xl.', '_large.', 'zoom', 'full', 'master', 'hires', 'maxres']
-        if any(kw in lower_url for kw in high_res_keywords):
-            priority += 100 # Увеличен приоритет
-
-        # Ключевые слова среднего разрешения
-        medium_res_keywords = ['/medium/', '/med/', '_medium.', '_m.', '/product/', '/catalog/']
-        if any(kw in lower_url for kw in medium_res_keywords):
-            priority += 10 # Оставляем низким
-
-        # Ключевые слова низкого разрешения (штраф)
-        low_res_keywords = ['/small/', '/thumb', '_small.', '_s.', '_thumb.', 'preview', 'mini', 'icon', 'logo', '/100x', '/200x', '/300x', 'tile'] # Добавлен 'tile'
-        if any(kw in lower_url for kw in low_res_keywords):
-            priority -= 50 # Увеличен штраф
-
-        # Приоритет для определенных атрибутов (если бы передавали тип источника)
-        # Например, data-zoom-image мог бы дать +60
-
-        # Проверка разрешения в URL (например, 1200x1200)
-        resolution_match = re.search(r'(\d{3,})[xX](\d{3,})', url)
-        if resolution_match:
-             try:
-                 w, h = int(resolution_match.group(1)), int(resolution_match.group(2))
-                 # Даем больше очков за большие размеры
-                 area_bonus = min(40, (w * h) // 50000) # Бонус до 40 очков за площадь
-                 priority += area_bonus
-                 _log_status(f"BEST_URL: Найдены размеры {w}x{h} в URL '{url}', бонус {area_bonus}", status_callback)
-             except ValueError:
-                 pass # Не удалось преобразовать в числа
-
-        # Предпочтение JPG/PNG перед WEBP/GIF, если приоритет одинаковый
-        if lower_url.endswith('.jpg') or lower_url.endswith('.jpeg') or lower_url.endswith('.png'):
-             priority += 1
-
-        prioritized.append((priority, url))
-
     # Сортировка по приоритету (убывание), затем по длине URL (убывание, как доп. эвристика)
-    prioritized.sort(key=lambda x: (-x[0], -len(x[1])))
-
-    _log_status(f"BEST_URL: Отсортированный список: {prioritized}", status_callback)
-
-    if not prioritized:
-         _log_status("BEST_URL: Список приоритетов пуст.", status_callback)
-         return None
+    prioritized = sorted(((priority, url) for url, priority in scored.items()), key=lambda x: (-x[0], -len(x[1])))
+    _log_debug(status_callback, "BEST_URL: Отсортированный список: %s", prioritized)
 
-    best_url = prioritized[0][1]
+    best_priority, best_url = prioritized[0]
     # Финальное улучшение URL перед возвратом
     final_url = improve_image_url(best_url, status_callback)
     if final_url != best_url:
         _log_status(f"BEST_URL: Улучшен финальный URL: {best_url} -> {final_url}", status_callback)
     else:
-        _log_status(f"BEST_URL: Выбран лучший URL: {final_url} (Приоритет: {prioritized[0][0]})", status_callback)
+        _log_status(f"BEST_URL: Выбран лучший URL: {final_url} (Приоритет: {best_priority})", status_callback)
     return final_url
 
 
 # --- Обновленная функция find_image_url_from_css_selectors ---
 def find_image_url_from_css_selectors(html_content, domain, base_url, status_callback=None):
     """Находит URL изображения с использованием CSS селекторов, собирает кандидатов и выбирает лучший."""
-    _log_status(f"CSS_SELECTORS: Поиск для домена '{domain}' (URL: {base_url})", status_callback)
-    soup = BeautifulSoup(html_content, 'html.parser')
+    _log_debug(status_callback, "CSS_SELECTORS: Поиск для домена '%s' (URL: %s)", domain, base_url)
     current_domain = get_domain(base_url); selectors = DOMAIN_SELECTORS.get(current_domain)
     if not selectors:
-        _log_status(f"CSS_SELECTORS: Селекторы для домена '{current_domain}' не найдены.", status_callback)
+        _log_debug(status_callback, "CSS_SELECTORS: Селекторы для домена '%s' не найдены.", current_domain)
         return None
-    _log_status(f"CSS_SELECTORS: Используются селекторы: {selectors}", status_callback)
+    soup = make_soup(html_content) # Парсим только если для домена есть селекторы
+    _log_debug(status_callback, "CSS_SELECTORS: Используются селекторы: %s", selectors)
 
     candidates = [] # Список для сбора URL-кандидатов
 
     for selector in selectors:
-        _log_status(f"CSS_SELECTORS: Проверка селектора: '{selector}'", status_callback)
+        _log_debug(status_callback, "CSS_SELECTORS: Проверка селектора: '%s'", selector)
         try:
             img_tags = soup.select(selector) # Используем select для поиска всех совпадений
             if not img_tags:
-                 _log_status(f"CSS_SELECTORS: Теги по селектору '{selector}' не найдены.", status_callback)
+                 _log_debug(status_callback, "CSS_SELECTORS: Теги по селектору '%s' не найдены.", selector)
                  continue
 
             for img_tag in img_tags:
-                _log_status(f"CSS_SELECTORS: Найден тег по селектору '{selector}'. Сбор кандидатов...", status_callback)
+                _log_debug(status_callback, "CSS_SELECTORS: Найден тег по селектору '%s'. Сбор кандидатов...", selector)
                 # 1. Атрибуты с высоким приоритетом
                 high_priority_attrs = ['data-zoom-image', 'data-large-image', 'data-original']
                 for attr in high_priority_attrs:
@@ -489,271 +992,698 @@ def find_image_url_from_css_selectors(html_content, domain, base_url, status_cal
             _log_status(f"CSS_SELECTORS: Ошибка при обработке селектора '{selector}': {e}", status_callback)
             continue
 
-    _log_status(f"CSS_SELECTORS: Сбор кандидатов завершен для {base_url}.", status_callback)
+    _log_debug(status_callback, "CSS_SELECTORS: Сбор кандидатов завершен для %s.", base_url)
     return select_best_image_url(candidates, base_url, status_callback) # Выбираем лучший URL
 
-# --- Обновленная функция find_image_url_from_selenium_element ---
-def find_image_url_from_selenium_element(driver, domain, status_callback=None): # <-- Добавлен status_callback=None
+# --- Единый конвейер извлечения: один парсинг HTML на все стратегии ---
+def resolve_image_url_from_html(html_content, domain, base_url, status_callback=None, strategies=None):
+    """
+    Парсит HTML один раз и последовательно применяет стратегии к общему дереву:
+    по умолчанию Schema.org -> og:image -> CSS селекторы (HTML_STRATEGIES), либо в порядке strategies.
+    Возвращает (image_url, strategy), где strategy — 'state', 'schema', 'og_image', 'css' или None.
+    """
+    soup = make_soup(html_content)
+    for strategy in strategies or HTML_STRATEGIES:
+        if strategy == 'state': image_url = find_image_url_from_embedded_state(soup, base_url)
+        elif strategy == 'schema': image_url = find_image_url_from_schema(soup, base_url)
+        elif strategy == 'og_image': image_url = find_image_url_from_og_image(soup, base_url)
+        else: image_url = find_image_url_from_css_selectors(soup, domain, base_url, status_callback)
+        if image_url: return image_url, strategy
+    return None, None
+
+
+def find_image_url_from_html(html_content, domain, base_url, status_callback=None):
+    """То же, что resolve_image_url_from_html, но возвращает только URL изображения."""
+    return resolve_image_url_from_html(html_content, domain, base_url, status_callback)[0]
+
+
+# --- Поиск главного изображения в браузере: все селекторы домена одним скриптом ---
+# Проверяет селекторы в порядке приоритета и возвращает атрибуты первого элемента по каждому совпавшему.
+# Если совпадений нет, ждет их через MutationObserver (один таймер на весь набор селекторов);
+# при совпадении не первого селектора дает еще grace мс на появление более приоритетного.
+_RESOLVE_SELECTORS_SCRIPT = r"""
+var selectors = arguments[0], timeoutMs = arguments[1], graceMs = arguments[2], done = arguments[arguments.length - 1];
+var ATTRS = ['srcset', 'src', 'data-zoom-image', 'data-large-image', 'data-original', 'data-src'];
+function query(sel) { try { return document.querySelector(sel); } catch (e) { return null; } }
+function describe(img) {
+    var result = {};
+    ATTRS.forEach(function (attr) { if (img.hasAttribute(attr)) result[attr.replace(/-/g, '_')] = img.getAttribute(attr); });
+    if (img.currentSrc) result.currentSrc = img.currentSrc; // Свойство, а не атрибут: URL, выбранный браузером из srcset
+    if (img.parentElement && img.parentElement.tagName === 'A' && img.parentElement.href) {
+        var href = img.parentElement.href;
+        if (href && /\.(jpg|jpeg|png|webp|gif|bmp)$/i.test(href.split('?')[0])) result.parent_href = href;
+    }
+    return result;
+}
+function collect() {
+    var found = [];
+    selectors.forEach(function (sel, i) { var el = query(sel); if (el) found.push({index: i, selector: sel, attrs: describe(el)}); });
+    return found;
+}
+var found = collect();
+if ((found.length && found[0].index === 0) || timeoutMs <= 0) { done(found); return; }
+var finished = false, scheduled = false, observer = null, timer = null;
+function finish() {
+    if (finished) return; finished = true;
+    if (observer) observer.disconnect(); clearTimeout(timer); done(collect());
+}
+function check() {
+    scheduled = false;
+    if (query(selectors[0])) { finish(); return; }
+    if (!graceTimer && selectors.some(query)) graceTimer = setTimeout(finish, graceMs);
+}
+var graceTimer = found.length ? setTimeout(finish, graceMs) : null;
+observer = new MutationObserver(function () { if (!scheduled) { scheduled = true; setTimeout(check, 50); } });
+observer.observe(document.documentElement || document, {childList: true, subtree: true, attributes: true});
+timer = setTimeout(finish, timeoutMs);
+"""
+
+
+def _candidates_from_element_attrs(attrs_dict, base_url):
+    """Собирает URL-кандидатов из атрибутов элемента в порядке приоритета: srcset, zoom/large/original/ссылка, data-src, src."""
+    candidates = []
+    if 'srcset' in attrs_dict and attrs_dict['srcset']:
+        srcset_candidate = parse_srcset(attrs_dict['srcset'], base_url)
+        if srcset_candidate: candidates.append(srcset_candidate)
+
+    high_priority_keys = ['data_zoom_image', 'data_large_image', 'data_original', 'parent_href']
+    for key in high_priority_keys:
+        if key in attrs_dict and attrs_dict[key]: candidates.append(attrs_dict[key])
+
+    medium_priority_keys = ['data_src']
+    for key in medium_priority_keys:
+         if key in attrs_dict and attrs_dict[key]: candidates.append(attrs_dict[key])
+
+    low_priority_keys = ['currentSrc', 'src']
+    for key in low_priority_keys:
+         if key in attrs_dict and attrs_dict[key]: candidates.append(attrs_dict[key])
+    return candidates
+
+
+def find_image_url_from_selenium_element(driver, domain, status_callback=None, timeout=SELENIUM_CONTENT_WAIT):
     """
     Находит главный элемент изображения с помощью Selenium, собирает кандидатов URL и выбирает лучший.
+    Все селекторы домена разрешаются одним скриптом в странице (_RESOLVE_SELECTORS_SCRIPT): одно ожидание
+    до timeout секунд на весь набор вместо отдельного WebDriverWait на каждый селектор.
+    Совпадения перебираются в порядке приоритета селекторов.
     """
     if not _selenium_available: return None
     current_domain = get_domain(driver.current_url); selectors = DOMAIN_SELECTORS.get(current_domain)
     if not selectors:
-        _log_status(f"SELENIUM: Селекторы для домена '{current_domain}' не найдены.", status_callback)
+        _log_debug(status_callback, "SELENIUM: Селекторы для домена '%s' не найдены.", current_domain)
         return None
-    _log_status(f"SELENIUM: Используются селекторы: {selectors}", status_callback)
+    _log_debug(status_callback, "SELENIUM: Используются селекторы: %s", selectors)
 
     base_url = driver.current_url # Определяем base_url один раз
+    try:
+        driver.set_script_timeout(timeout + 5)
+        matches = driver.execute_async_script(_RESOLVE_SELECTORS_SCRIPT, selectors, int(timeout * 1000), int(SELENIUM_PRIORITY_GRACE * 1000)) or []
+    except TimeoutException:
+        matches = []
+    except WebDriverException as script_err:
+        _log_status(f"SELENIUM: Ошибка выполнения скрипта селекторов для {base_url}: {str(script_err)[:200]}", status_callback)
+        return None
 
-    # --- ИЗМЕНЕНО: Последовательная проверка селекторов с приоритетом первого ---
-    for i, selector in enumerate(selectors): # Итерация с индексом
-        _log_status(f"SELENIUM: Проверка селектора #{i+1}: '{selector}'", status_callback)
-        candidates = [] # Кандидаты для текущего шага
-        try:
-            img_element = None
-            if i == 0: # --- Для ПЕРВОГО селектора ищем только ПЕРВЫЙ элемент ---
-                try:
-                    _log_status(f"SELENIUM: Поиск ПЕРВОГО элемента по приоритетному селектору '{selector}'", status_callback)
-                    img_element = WebDriverWait(driver, 7).until(EC.presence_of_element_located((By.CSS_SELECTOR, selector))) # Увеличено ожидание
-                except (TimeoutException, SeleniumNoSuchElementException):
-                    _log_status(f"SELENIUM: ПЕРВЫЙ элемент по приоритетному селектору '{selector}' не найден.", status_callback)
-                    continue # Переходим к следующему селектору в списке
-            else: # --- Для ПОСЛЕДУЮЩИХ селекторов ищем первый из найденных ---
-                 try:
-                    _log_status(f"SELENIUM: Поиск ЛЮБОГО элемента по запасному селектору '{selector}'", status_callback)
-                    # Ищем все, но возьмем первый видимый/подходящий? Или просто первый? Возьмем просто первый.
-                    img_elements = WebDriverWait(driver, 3).until(EC.presence_of_all_elements_located((By.CSS_SELECTOR, selector))) # Меньшее ожидание
-                    if img_elements:
-                        img_element = img_elements[0] # Берем первый из найденных
-                    else:
-                         _log_status(f"SELENIUM: Элементы по запасному селектору '{selector}' не найдены.", status_callback)
-                         continue
-                 except (TimeoutException, SeleniumNoSuchElementException):
-                     _log_status(f"SELENIUM: Элементы по запасному селектору '{selector}' не найдены.", status_callback)
-                     continue
-
-            # --- Если элемент найден (либо первый по первому селектору, либо первый по запасному) ---
-            if img_element:
-                _log_status(f"SELENIUM: Найден элемент по селектору '{selector}'. Сбор кандидатов...", status_callback)
-                attrs_dict = driver.execute_script("""
-                    var img = arguments[0]; var result = {};
-                    var attrs = ['srcset', 'src', 'currentSrc', 'data-zoom-image', 'data-large-image', 'data-original', 'data-src'];
-                    attrs.forEach(attr => { if (img.hasAttribute(attr)) result[attr.replace(/-/g, '_')] = img.getAttribute(attr); });
-                    if (img.parentElement && img.parentElement.tagName === 'A' && img.parentElement.href) {
-                        let href = img.parentElement.href;
-                        // ИСПРАВЛЕНО: Экранируем \ в регулярном выражении
-                        if (href && /\\.(jpg|jpeg|png|webp|gif|bmp)$/i.test(href.split('?')[0])) {
-                             result.parent_href = href;
-                        }
-                    }
-                    return result;
-                """, img_element)
-
-                if attrs_dict:
-                    # Собираем кандидатов из атрибутов найденного элемента
-                    if 'srcset' in attrs_dict and attrs_dict['srcset']:
-                        srcset_candidate = parse_srcset(attrs_dict['srcset'], base_url)
-                        if srcset_candidate: candidates.append(srcset_candidate)
-
-                    high_priority_keys = ['data_zoom_image', 'data_large_image', 'data_original', 'parent_href']
-                    for key in high_priority_keys:
-                        if key in attrs_dict and attrs_dict[key]: candidates.append(attrs_dict[key])
-
-                    medium_priority_keys = ['data_src']
-                    for key in medium_priority_keys:
-                         if key in attrs_dict and attrs_dict[key]: candidates.append(attrs_dict[key])
-
-                    low_priority_keys = ['currentSrc', 'src']
-                    for key in low_priority_keys:
-                         if key in attrs_dict and attrs_dict[key]: candidates.append(attrs_dict[key])
-
-            # --- Выбираем лучший URL из кандидатов, собранных для ЭТОГО селектора ---
-            if candidates:
-                _log_status(f"SELENIUM: Выбор лучшего URL из кандидатов для селектора '{selector}': {candidates}", status_callback)
-                best_url = select_best_image_url(candidates, base_url, status_callback)
-                if best_url:
-                    _log_status(f"SELENIUM: Лучший URL найден по селектору '{selector}': {best_url}", status_callback)
-                    return best_url # Возвращаем первый найденный лучший URL
-                else:
-                     _log_status(f"SELENIUM: Не удалось выбрать лучший URL из кандидатов для селектора '{selector}'.", status_callback)
-            # Если кандидатов нет или лучший не выбран, цикл продолжается к следующему селектору
-
-        except Exception as e: # Ловим другие ошибки на всякий случай
-             _log_status(f"SELENIUM: Непредвиденная ошибка при обработке селектора '{selector}': {e}", status_callback)
-             continue # Переходим к следующему селектору
+    for match in matches:
+        selector = match.get('selector')
+        _log_debug(status_callback, "SELENIUM: Найден элемент по селектору #%d '%s'. Сбор кандидатов...", match.get('index', 0) + 1, selector)
+        candidates = _candidates_from_element_attrs(match.get('attrs') or {}, base_url)
+        if candidates:
+            _log_debug(status_callback, "SELENIUM: Выбор лучшего URL из кандидатов для селектора '%s': %s", selector, candidates)
+            best_url = select_best_image_url(candidates, base_url, status_callback)
+            if best_url:
+                _log_status(f"SELENIUM: Лучший URL найден по селектору '{selector}': {best_url}", status_callback)
+                return best_url # Возвращаем первый найденный лучший URL
+            _log_debug(status_callback, "SELENIUM: Не удалось выбрать лучший URL из кандидатов для селектора '%s'.", selector)
+        # Если кандидатов нет или лучший не выбран, переходим к следующему совпавшему селектору
 
     # Если ни один селектор не дал результата
     _log_status(f"SELENIUM: URL не найден ни по одному селектору для {base_url}", status_callback)
     return None
 
 
-def download_image(session, image_url, save_path_base, status_callback=None):
+def _detect_image_extension(content_type, image_url, status_callback=None):
+    """Определяет исходное расширение изображения: приоритет Content-Type, затем URL, иначе .jpg."""
+    initial_extension = None
+    known_extensions = ['.jpg', '.jpeg', '.png', '.gif', '.webp', '.bmp', '.avif', '.tif', '.tiff']
+    _log_debug(status_callback, "DOWNLOAD: URL=%s, Content-Type='%s'", image_url, content_type)
+
+    if 'jpeg' in content_type or 'jpg' in content_type: initial_extension = '.jpg'
+    elif 'png' in content_type: initial_extension = '.png'
+    elif 'gif' in content_type: initial_extension = '.gif'
+    elif 'webp' in content_type: initial_extension = '.webp'
+    elif 'bmp' in content_type: initial_extension = '.bmp'
+    elif 'avif' in content_type: initial_extension = '.avif'
+    elif 'tiff' in content_type: initial_extension = '.tiff'
+    elif content_type.startswith('image/'):
+         ext_part = content_type.split('/')[-1].split(';')[0]
+         if ext_part and len(ext_part) <= 4 and ext_part.isalnum() and ('.' + ext_part) in known_extensions:
+              initial_extension = '.' + ext_part
+         else: _log_status(f"DOWNLOAD: Content-Type '{content_type}' дал неизвестное/неподдерживаемое расширение '{ext_part}'.", status_callback)
+    else: _log_status(f"DOWNLOAD: Не удалось определить тип по Content-Type '{content_type}'.", status_callback)
+
+    # Если Content-Type не помог, пробуем URL
+    if not initial_extension:
+        _log_debug(status_callback, "DOWNLOAD: Попытка определить расширение по URL...")
+        try:
+            path_part = urlparse(image_url).path
+            _, parsed_ext = os.path.splitext(os.path.basename(path_part))
+            parsed_ext = parsed_ext.lower()
+            if parsed_ext in known_extensions:
+                initial_extension = parsed_ext
+                _log_debug(status_callback, "DOWNLOAD: Расширение взято из URL: %s", initial_extension)
+        except Exception: pass # Игнорируем ошибки парсинга URL
+
+    # Если совсем не удалось, fallback
+    if not initial_extension:
+        _log_status(f"DOWNLOAD: Не удалось определить исходное расширение. Используется fallback .jpg", status_callback)
+        initial_extension = '.jpg'
+    _log_debug(status_callback, "DOWNLOAD: Исходное расширение определено как: %s", initial_extension)
+    return initial_extension
+
+
+def _unique_save_path(save_path_base, extension):
+    """
+    Возвращает свободный путь save_path_base + extension, а при коллизии — с суффиксом _N.
+    Каталог читается только при коллизии (один os.listdir на вызов), следующий номер берется после максимального занятого.
+    """
+    save_dir = os.path.dirname(save_path_base); os.makedirs(save_dir, exist_ok=True)
+    candidate = save_path_base + extension
+    if not os.path.exists(candidate): return candidate
+    prefix = os.path.basename(save_path_base) + '_'
+    taken = [0]
+    for name in os.listdir(save_dir):
+        if name.startswith(prefix) and name.endswith(extension):
+            suffix = name[len(prefix):len(name) - len(extension)]
+            if suffix.isdigit(): taken.append(int(suffix))
+    return f"{save_path_base}_{max(taken) + 1}{extension}"
+
+
+def _prepare_image_paths(save_path_base, initial_extension, status_callback=None):
+    """
+    Определяет целевой формат, финальный путь (с обработкой коллизий) и временный путь.
+    Возвращает (needs_conversion, final_save_path, temp_save_path).
+    """
+    standard_formats = ['.jpg', '.jpeg', '.png']
+    needs_conversion = initial_extension not in standard_formats
+    target_extension = '.png' if needs_conversion else initial_extension # Конвертируем в PNG для сохранения качества
+    _log_debug(status_callback, "DOWNLOAD: Целевое расширение: %s (Конвертация: %s)", target_extension, 'Да' if needs_conversion else 'Нет')
+
+    # Определяем финальный путь (с обработкой коллизий)
+    final_save_path = _unique_save_path(save_path_base, target_extension)
+    _log_debug(status_callback, "DOWNLOAD: Финальный путь: %s", final_save_path)
+
+    # Определяем временный путь
+    temp_save_path = save_path_base + "_temp" + initial_extension
+    _log_debug(status_callback, "DOWNLOAD: Временный путь: %s", temp_save_path)
+    return needs_conversion, final_save_path, temp_save_path
+
+
+def _finalize_image_file(temp_save_path, final_save_path, needs_conversion, status_callback=None):
+    """Конвертирует временный файл в стандартный формат (ImageMagick) или просто переименовывает его."""
+    initial_extension = os.path.splitext(temp_save_path)[1]
+    target_extension = os.path.splitext(final_save_path)[1]
+    # --- Конвертация (если нужна) ---
+    if needs_conversion:
+        # Проверяем наличие ImageMagick: сначала 'magick', затем запасной вариант 'convert'
+        convert_path = shutil.which('magick') or shutil.which('convert')
+        if not convert_path:
+            _log_status(
+                f"DOWNLOAD: ImageMagick ('magick' или 'convert') не найден в PATH. Невозможно конвертировать {initial_extension} в {target_extension}.",
+                status_callback,
+            )
+            if os.path.exists(temp_save_path):
+                os.remove(temp_save_path)
+            return False, f"Ошибка: ImageMagick не найден для конвертации {initial_extension}"
+
+        exe_name = os.path.basename(convert_path)
+        _log_debug(status_callback, "DOWNLOAD: Запуск конвертации (%s): %s -> %s", exe_name, temp_save_path, final_save_path)
+        command = [convert_path, temp_save_path, final_save_path]
+        try:
+            result = subprocess.run(
+                command, check=True, capture_output=True, text=True, timeout=60
+            )  # Таймаут 60 сек
+            _log_debug(status_callback, "DOWNLOAD: Конвертация успешна. stdout:\n%s\nstderr:\n%s", result.stdout, result.stderr)
+            if os.path.exists(temp_save_path):
+                os.remove(temp_save_path)  # Удаляем временный файл
+            return True, f"Изображение успешно скачано и конвертировано в {os.path.basename(final_save_path)}"
+        except FileNotFoundError:  # На случай, если shutil.which обманул
+            _log_status(
+                "DOWNLOAD: Ошибка конвертации - команда 'magick'/'convert' не найдена (FileNotFoundError).",
+                status_callback,
+            )
+            if os.path.exists(temp_save_path):
+                os.remove(temp_save_path)
+            return False, "Ошибка конвертации: команда ImageMagick не найдена"
+        except subprocess.CalledProcessError as conv_err:
+            _log_status(
+                f"DOWNLOAD: Ошибка конвертации ImageMagick (код {conv_err.returncode}). Команда: {' '.join(command)}\nstdout:\n{conv_err.stdout}\nstderr:\n{conv_err.stderr}",
+                status_callback,
+            )
+            if os.path.exists(temp_save_path):
+                os.remove(temp_save_path)
+            if os.path.exists(final_save_path):
+                os.remove(final_save_path)  # Удаляем возможно частично созданный файл
+            return False, f"Ошибка конвертации ImageMagick: {conv_err.stderr[:200]}"
+        except subprocess.TimeoutExpired:
+            _log_status(
+                f"DOWNLOAD: Ошибка конвертации ImageMagick - превышен таймаут.",
+                status_callback,
+            )
+            if os.path.exists(temp_save_path):
+                os.remove(temp_save_path)
+            if os.path.exists(final_save_path):
+                os.remove(final_save_path)
+            return False, "Ошибка конвертации: превышен таймаут ImageMagick"
+        except Exception as conv_exc:  # Другие возможные ошибки
+            _log_status(
+                f"DOWNLOAD: Непредвиденная ошибка при конвертации: {conv_exc}",
+                status_callback,
+            )
+            if os.path.exists(temp_save_path):
+                os.remove(temp_save_path)
+            if os.path.exists(final_save_path):
+                os.remove(final_save_path)
+            return False, f"Непредвиденная ошибка при конвертации: {conv_exc}"
+
+    # --- Если конвертация не нужна ---
+    else:
+        _log_debug(status_callback, "DOWNLOAD: Конвертация не требуется. Переименование %s -> %s", temp_save_path, final_save_path)
+        try:
+            os.rename(temp_save_path, final_save_path)
+            return True, f"Изображение успешно сохранено как: {os.path.basename(final_save_path)}"
+        except OSError as rename_err:
+             _log_status(f"DOWNLOAD: Ошибка переименования временного файла: {rename_err}", status_callback)
+             if os.path.exists(temp_save_path): os.remove(temp_save_path) # Пытаемся удалить временный
+             if os.path.exists(final_save_path): os.remove(final_save_path) # И финальный, если вдруг создался
+             return False, f"Ошибка переименования файла: {rename_err}"
+
+
+def parse_target_size(value):
+    """Извлекает целевой размер (ширина, высота) из строки вида '..._296х296'. Возвращает None, если размера нет."""
+    if not value: return None
+    match = _TARGET_SIZE_RE.search(value.strip())
+    if not match: return None
+    width, height = int(match.group(1)), int(match.group(2))
+    return (width, height) if width > 0 and height > 0 else None
+
+
+def get_target_size(row_data):
+    """Целевой размер для строки CSV: 3-я колонка (если есть), иначе суффикс имени файла."""
+    if len(row_data) > 2:
+        size = parse_target_size(row_data[2])
+        if size: return size
+    return parse_target_size(row_data[1]) if len(row_data) > 1 else None
+
+
+def _fit_image(img, target_size, keep_alpha):
+    """Вписывает изображение в target_size с сохранением пропорций и дополняет полями до точного размера."""
+    has_alpha = img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info)
+    if keep_alpha and has_alpha:
+        img = img.convert('RGBA'); canvas = Image.new('RGBA', target_size, RESIZE_BACKGROUND + (0,))
+    else:
+        if has_alpha:
+            rgba = img.convert('RGBA'); img = Image.new('RGB', rgba.size, RESIZE_BACKGROUND); img.paste(rgba, mask=rgba.getchannel('A'))
+        else:
+            img = img.convert('RGB')
+        canvas = Image.new('RGB', target_size, RESIZE_BACKGROUND)
+    scale = min(target_size[0] / img.width, target_size[1] / img.height)
+    fitted_size = (max(1, round(img.width * scale)), max(1, round(img.height * scale)))
+    if fitted_size != img.size: img = img.resize(fitted_size, Image.LANCZOS)
+    offset = ((target_size[0] - img.width) // 2, (target_size[1] - img.height) // 2)
+    canvas.paste(img, offset, img if img.mode == 'RGBA' else None)
+    return canvas
+
+
+def resize_image_file(image_path, target_size, status_callback=None):
+    """Приводит сохраненное изображение к target_size (вписывание + поля). Ошибка не считается ошибкой строки."""
+    if not _pil_available:
+        _log_status(f"RESIZE: Pillow не установлен, изменение размера пропущено для {image_path}", status_callback)
+        return False
+    try:
+        is_png = image_path.lower().endswith('.png')
+        with Image.open(image_path) as img:
+            img.load()
+            fitted = _fit_image(img, target_size, keep_alpha=is_png)
+        if is_png: fitted.save(image_path, 'PNG', optimize=True)
+        else: fitted.save(image_path, 'JPEG', quality=90, optimize=True)
+        _log_status(f"RESIZE: {os.path.basename(image_path)} -> {target_size[0]}x{target_size[1]}", status_callback)
+        return True
+    except Exception as resize_err:
+        _log_status(f"RESIZE: Не удалось изменить размер {image_path}: {resize_err}", status_callback)
+        return False
+
+
+def _convert_image_with_pillow(data, final_save_path, status_callback=None, target_size=None):
+    """Декодирует изображение из памяти и сохраняет PNG. Возвращает (True, сообщение) или None, если Pillow не справился."""
+    if not _pil_available: return None
+    try:
+        with Image.open(io.BytesIO(data)) as img:
+            img.seek(0) # Для анимированных GIF/WebP берем первый кадр
+            if target_size:
+                img = _fit_image(img, target_size, keep_alpha=True)
+            elif img.mode not in ('RGB', 'RGBA', 'L', 'LA', 'P'):
+                img = img.convert('RGBA')
+            img.save(final_save_path, 'PNG')
+        _log_status(f"DOWNLOAD: Конвертация в памяти (Pillow) успешна: {final_save_path}", status_callback)
+        return True, f"Изображение успешно скачано и конвертировано в {os.path.basename(final_save_path)}"
+    except Exception as pil_err:
+        _log_status(f"DOWNLOAD: Pillow не смог конвертировать изображение ({pil_err}). Используется ImageMagick.", status_callback)
+        if os.path.exists(final_save_path): os.remove(final_save_path)
+        return None
+
+
+def convert_image_data(data, temp_save_path, final_save_path, status_callback=None, target_size=None):
+    """
+    Конвертирует скачанные байты в PNG: сначала в памяти через Pillow,
+    для необычных форматов — через временный файл и ImageMagick.
+    Если задан target_size, изображение сразу вписывается в этот размер.
+    Выполняется в CONVERSION_EXECUTOR.
+    """
+    result = _convert_image_with_pillow(data, final_save_path, status_callback, target_size)
+    if result is not None: return result
+    try:
+        with open(temp_save_path, 'wb') as f: f.write(data)
+    except OSError as write_err:
+        if os.path.exists(temp_save_path): os.remove(temp_save_path)
+        return False, f"Ошибка записи временного файла {temp_save_path}: {write_err}"
+    result = _finalize_image_file(temp_save_path, final_save_path, True, status_callback)
+    if result[0] and target_size: resize_image_file(final_save_path, target_size, status_callback)
+    return result
+
+
+def _save_and_resize(temp_save_path, final_save_path, status_callback=None, target_size=None):
+    """Переименовывает временный файл в финальный и при необходимости приводит его к target_size."""
+    result = _finalize_image_file(temp_save_path, final_save_path, False, status_callback)
+    if result[0] and target_size: resize_image_file(final_save_path, target_size, status_callback)
+    return result
+
+
+def _record_saved_file(result, final_save_path, row_info, sha256=None):
+    """
+    Запоминает путь сохраненного файла и SHA-256 его содержимого (если известен без перечитывания файла)
+    в row_info (если передан) и возвращает result без изменений.
+    """
+    if result[0] and row_info is not None:
+        row_info['path'] = final_save_path; row_info['sha256'] = sha256
+    return result
+
+
+def _open_sqlite(path, *schema):
+    """Открывает SQLite-базу (WAL, общая для потоков) и выполняет инструкции схемы."""
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    conn = sqlite3.connect(path, timeout=10, check_same_thread=False)
+    conn.execute('PRAGMA journal_mode=WAL')
+    for statement in schema: conn.execute(statement)
+    conn.commit()
+    return conn
+
+
+class ImageStore:
+    """
+    Хранилище готовых изображений, адресуемых по SHA-256 содержимого (blobs/<xx>/<hash><ext>).
+    Индекс связывает (URL изображения, размер) и (хэш исходных байтов, размер) с блобом,
+    а также хранит ETag/Last-Modified для условной перепроверки. Файлы результата — копии блоба,
+    а не жесткие ссылки: правка файла результата не должна менять хранилище и файлы других задач.
+    Таблица outputs помнит, какие файлы результата содержат блоб (путь, размер, mtime), чтобы при
+    повторном запуске в ту же папку найти готовый файл без чтения каталога и хэширования.
+    """
+    def __init__(self, root, max_age=IMAGE_STORE_MAX_AGE):
+        self.root = root; self.max_age = max_age
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def _connect(self):
+        if self._conn is None:
+            self._conn = _open_sqlite(
+                os.path.join(self.root, 'index.sqlite3'),
+                'CREATE TABLE IF NOT EXISTS images ('
+                ' url_key TEXT PRIMARY KEY, blob TEXT NOT NULL, etag TEXT, last_modified TEXT, checked_at REAL NOT NULL)',
+                'CREATE TABLE IF NOT EXISTS sources (source_key TEXT PRIMARY KEY, blob TEXT NOT NULL)',
+                'CREATE TABLE IF NOT EXISTS outputs ('
+                ' path TEXT PRIMARY KEY, blob TEXT NOT NULL, dir TEXT NOT NULL, size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL)',
+                'CREATE INDEX IF NOT EXISTS outputs_blob_dir ON outputs (blob, dir)',
+            )
+        return self._conn
+
+    @staticmethod
+    def _size_tag(target_size):
+        return f"{target_size[0]}x{target_size[1]}" if target_size else 'orig'
+
+    def blob_path(self, blob):
+        return os.path.join(self.root, 'blobs', blob[:2], blob)
+
+    @staticmethod
+    def blob_sha256(blob):
+        return os.path.splitext(blob)[0]
+
+    def lookup(self, image_url, target_size=None):
+        """Возвращает запись {'blob', 'etag', 'last_modified', 'checked_at', 'fresh'} для URL или None, если блоба нет."""
+        try:
+            with self._lock:
+                row = self._connect().execute('SELECT blob, etag, last_modified, checked_at FROM images WHERE url_key = ?',
+                                              (f"{self._size_tag(target_size)}|{image_url}",)).fetchone()
+        except sqlite3.Error:
+            return None
+        if not row or not os.path.exists(self.blob_path(row[0])): return None
+        return {'blob': row[0], 'etag': row[1], 'last_modified': row[2], 'checked_at': row[3],
+                'fresh': self.max_age > 0 and time.time() - row[3] < self.max_age}
+
+    @staticmethod
+    def conditional_headers(entry):
+        """Заголовки условного запроса для перепроверки сохраненного изображения."""
+        headers = {}
+        if entry.get('etag'): headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'): headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def find_source(self, source_hash, target_size=None):
+        """Ищет готовый блоб для уже встречавшихся исходных байтов (тот же файл по другому URL)."""
+        try:
+            with self._lock:
+                row = self._connect().execute('SELECT blob FROM sources WHERE source_key = ?',
+                                              (f"{self._size_tag(target_size)}|{source_hash}",)).fetchone()
+        except sqlite3.Error:
+            return None
+        return row[0] if row and os.path.exists(self.blob_path(row[0])) else None
+
+    def remember(self, image_url, target_size, blob, etag=None, last_modified=None, source_hash=None):
+        """Связывает URL (и хэш исходных байтов) с блобом и отмечает время проверки."""
+        size_tag = self._size_tag(target_size)
+        try:
+            with self._lock:
+                conn = self._connect()
+                conn.execute('INSERT OR REPLACE INTO images (url_key, blob, etag, last_modified, checked_at) VALUES (?, ?, ?, ?, ?)',
+                             (f"{size_tag}|{image_url}", blob, etag, last_modified, time.time()))
+                if source_hash:
+                    conn.execute('INSERT OR REPLACE INTO sources (source_key, blob) VALUES (?, ?)', (f"{size_tag}|{source_hash}", blob))
+                conn.commit()
+        except sqlite3.Error:
+            pass
+
+    def add_file(self, file_path):
+        """Помещает копию готового файла в хранилище и запоминает файл как результат. Возвращает имя блоба."""
+        blob = _file_sha256(file_path) + os.path.splitext(file_path)[1].lower()
+        blob_path = self.blob_path(blob)
+        if not os.path.exists(blob_path):
+            os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+            tmp_path = f"{blob_path}.{threading.get_ident()}.tmp"
+            shutil.copyfile(file_path, tmp_path)
+            os.replace(tmp_path, blob_path)
+        self._remember_output(blob, file_path)
+        return blob
+
+    def _remember_output(self, blob, file_path):
+        """Записывает файл результата с содержимым блоба (размер и mtime — чтобы заметить его правку)."""
+        path = os.path.abspath(file_path)
+        try:
+            stat = os.stat(path)
+            with self._lock:
+                conn = self._connect()
+                conn.execute('INSERT OR REPLACE INTO outputs (path, blob, dir, size, mtime_ns) VALUES (?, ?, ?, ?, ?)',
+                             (path, blob, os.path.dirname(path), stat.st_size, stat.st_mtime_ns))
+                conn.commit()
+        except (OSError, sqlite3.Error):
+            pass
+
+    def _find_existing_output(self, blob, save_path_base, extension):
+        """
+        Ищет среди записанных в outputs файлов этого блоба в папке результата save_path_base + extension
+        или его вариант _N (повторный запуск в ту же папку). Файл подходит, если его размер и mtime
+        не менялись с момента записи; устаревшие записи удаляются. Каталог не читается, файлы не хэшируются.
+        """
+        base = os.path.abspath(save_path_base); save_dir = os.path.dirname(base)
+        prefix = os.path.basename(base) + '_'
+        try:
+            with self._lock:
+                rows = self._connect().execute('SELECT path, size, mtime_ns FROM outputs WHERE blob = ? AND dir = ?',
+                                               (blob, save_dir)).fetchall()
+        except sqlite3.Error:
+            return None
+        stale = []; found = None
+        for path, size, mtime_ns in sorted(rows, key=lambda row: (row[0] != base + extension, row[0])):
+            name = os.path.basename(path)
+            if path != base + extension and not (name.startswith(prefix) and name.endswith(extension)
+                                                 and name[len(prefix):len(name) - len(extension)].isdigit()):
+                continue
+            try:
+                stat = os.stat(path)
+            except OSError:
+                stale.append(path); continue
+            if stat.st_size == size and stat.st_mtime_ns == mtime_ns: found = path; break
+            stale.append(path) # Файл изменили или заменили — он больше не копия блоба
+        if stale:
+            try:
+                with self._lock:
+                    conn = self._connect(); conn.executemany('DELETE FROM outputs WHERE path = ?', [(path,) for path in stale]); conn.commit()
+            except sqlite3.Error:
+                pass
+        return found
+
+    def materialize(self, blob, save_path_base, status_callback=None):
+        """
+        Создает файл результата (копию блоба). Если по базовому пути или среди его вариантов _N
+        лежит записанная в outputs неизмененная копия (повторный запуск в ту же папку), она используется без создания дубля.
+        Возвращает (True, сообщение, путь).
+        """
+        extension = os.path.splitext(blob)[1]
+        final_save_path = self._find_existing_output(blob, save_path_base, extension)
+        if not final_save_path:
+            final_save_path = _unique_save_path(save_path_base, extension)
+            shutil.copyfile(self.blob_path(blob), final_save_path)
+            self._remember_output(blob, final_save_path)
+        _log_status(f"STORE: Изображение взято из хранилища: {final_save_path}", status_callback)
+        return True, f"Изображение взято из хранилища как {os.path.basename(final_save_path)}", final_save_path
+
+
+def _file_sha256(file_path):
+    """SHA-256 содержимого файла (hex), читается блоками по 1 МБ."""
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''): digest.update(chunk)
+    return digest.hexdigest()
+
+
+IMAGE_STORE = ImageStore(IMAGE_STORE_DIR) if IMAGE_STORE_ENABLED else None
+
+
+def _reuse_stored_image(image_url, save_path_base, status_callback=None, target_size=None, row_info=None):
+    """
+    Проверяет IMAGE_STORE перед скачиванием. Возвращает (result, entry):
+    result — готовый результат, если запись свежая (без обращения к сети), иначе None;
+    entry — запись для условного запроса (или None).
+    """
+    entry = IMAGE_STORE.lookup(image_url, target_size) if IMAGE_STORE else None
+    if entry and entry['fresh']:
+        success, message, final_save_path = IMAGE_STORE.materialize(entry['blob'], save_path_base, status_callback)
+        return _record_saved_file((success, message), final_save_path, row_info, IMAGE_STORE.blob_sha256(entry['blob'])), entry
+    return None, entry
+
+
+def _stored_image_not_modified(image_url, entry, save_path_base, status_callback=None, target_size=None, row_info=None):
+    """Ответ 304 на условный запрос: обновляет время проверки и отдает файл из хранилища."""
+    _log_status(f"STORE: Изображение не изменилось (304): {image_url}", status_callback)
+    IMAGE_STORE.remember(image_url, target_size, entry['blob'], entry['etag'], entry['last_modified'])
+    success, message, final_save_path = IMAGE_STORE.materialize(entry['blob'], save_path_base, status_callback)
+    return _record_saved_file((success, message), final_save_path, row_info, IMAGE_STORE.blob_sha256(entry['blob']))
+
+
+def _reuse_stored_source(image_url, source_hash, headers, temp_save_path, save_path_base, status_callback=None, target_size=None, row_info=None):
+    """Те же исходные байты уже обрабатывались (другой URL): пропускает конвертацию и берет готовый блоб."""
+    blob = IMAGE_STORE.find_source(source_hash, target_size) if IMAGE_STORE else None
+    if not blob: return None
+    if temp_save_path and os.path.exists(temp_save_path): os.remove(temp_save_path)
+    IMAGE_STORE.remember(image_url, target_size, blob, headers.get('etag'), headers.get('last-modified'))
+    success, message, final_save_path = IMAGE_STORE.materialize(blob, save_path_base, status_callback)
+    return _record_saved_file((success, message), final_save_path, row_info, IMAGE_STORE.blob_sha256(blob))
+
+
+def _store_saved_image(result, image_url, final_save_path, source_hash, headers, target_size=None, status_callback=None):
+    """
+    Добавляет успешно сохраненный файл в IMAGE_STORE. Ошибки хранилища не влияют на результат строки.
+    Возвращает (result, SHA-256 файла результата или None, если файл не попал в хранилище).
+    """
+    if not (IMAGE_STORE and result[0]): return result, None
+    try:
+        blob = IMAGE_STORE.add_file(final_save_path)
+        IMAGE_STORE.remember(image_url, target_size, blob, headers.get('etag'), headers.get('last-modified'), source_hash)
+        return result, IMAGE_STORE.blob_sha256(blob)
+    except OSError as store_err:
+        _log_status(f"STORE: Не удалось добавить {final_save_path} в хранилище: {store_err}", status_callback)
+    return result, None
+
+
+def download_image(session, image_url, save_path_base, status_callback=None, target_size=None, row_info=None):
     """
     Скачивает изображение, определяет его РЕАЛЬНЫЙ формат (приоритет Content-Type),
-    сохраняет во временный файл, при необходимости конвертирует в стандартный формат (PNG)
-    с помощью ImageMagick и возвращает путь к финальному файлу.
+    сохраняет во временный файл, а форматы, требующие конвертации, получает в память
+    и конвертирует в PNG (Pillow, при неудаче — ImageMagick).
+    target_size — (ширина, высота) для вписывания результата; None — сохранить оригинал.
+    row_info — необязательный dict, куда записывается путь сохраненного файла ('path').
+    Повторные изображения берутся из IMAGE_STORE (с условной перепроверкой ETag/Last-Modified).
     """
-    temp_save_path = None # Путь к временному файлу
-    final_save_path = None # Путь к финальному файлу
+    temp_save_path = None; started = time.perf_counter() # Путь к временному файлу, начало скачивания
+    response = None
     try:
-        response = session.get(image_url, stream=True, timeout=20)
+        stored_result, entry = _reuse_stored_image(image_url, save_path_base, status_callback, target_size, row_info)
+        if stored_result: return stored_result
+        response = session.get(image_url, stream=True, timeout=20, headers=IMAGE_STORE.conditional_headers(entry) if entry else None)
+        if entry and response.status_code == 304:
+            return _stored_image_not_modified(image_url, entry, save_path_base, status_callback, target_size, row_info)
         response.raise_for_status()
         if response.headers.get('content-length') == '0':
             return False, f"Ошибка скачивания: Файл пустой для URL: {image_url}"
 
         # --- Определение исходного расширения (Приоритет Content-Type) ---
         content_type = response.headers.get('content-type', '').lower()
-        initial_extension = None
-        known_extensions = ['.jpg', '.jpeg', '.png', '.gif', '.webp', '.bmp', '.avif', '.tif', '.tiff']
-        _log_status(f"DOWNLOAD: URL={image_url}, Content-Type='{content_type}'", status_callback)
-
-        if 'jpeg' in content_type or 'jpg' in content_type: initial_extension = '.jpg'
-        elif 'png' in content_type: initial_extension = '.png'
-        elif 'gif' in content_type: initial_extension = '.gif'
-        elif 'webp' in content_type: initial_extension = '.webp'
-        elif 'bmp' in content_type: initial_extension = '.bmp'
-        elif 'avif' in content_type: initial_extension = '.avif'
-        elif 'tiff' in content_type: initial_extension = '.tiff'
-        elif content_type.startswith('image/'):
-             ext_part = content_type.split('/')[-1].split(';')[0]
-             if ext_part and len(ext_part) <= 4 and ext_part.isalnum() and ('.' + ext_part) in known_extensions:
-                  initial_extension = '.' + ext_part
-             else: _log_status(f"DOWNLOAD: Content-Type '{content_type}' дал неизвестное/неподдерживаемое расширение '{ext_part}'.", status_callback)
-        else: _log_status(f"DOWNLOAD: Не удалось определить тип по Content-Type '{content_type}'.", status_callback)
-
-        # Если Content-Type не помог, пробуем URL
-        if not initial_extension:
-            _log_status(f"DOWNLOAD: Попытка определить расширение по URL...", status_callback)
-            try:
-                path_part = urlparse(image_url).path
-                _, parsed_ext = os.path.splitext(os.path.basename(path_part))
-                parsed_ext = parsed_ext.lower()
-                if parsed_ext in known_extensions:
-                    initial_extension = parsed_ext
-                    _log_status(f"DOWNLOAD: Расширение взято из URL: {initial_extension}", status_callback)
-            except Exception: pass # Игнорируем ошибки парсинга URL
-
-        # Если совсем не удалось, fallback
-        if not initial_extension:
-            _log_status(f"DOWNLOAD: Не удалось определить исходное расширение. Используется fallback .jpg", status_callback)
-            initial_extension = '.jpg'
-        _log_status(f"DOWNLOAD: Исходное расширение определено как: {initial_extension}", status_callback)
+        initial_extension = _detect_image_extension(content_type, image_url, status_callback)
 
         # --- Определение целевого формата и путей ---
-        standard_formats = ['.jpg', '.jpeg', '.png']
-        needs_conversion = initial_extension not in standard_formats
-        target_extension = '.png' if needs_conversion else initial_extension # Конвертируем в PNG для сохранения качества
-        _log_status(f"DOWNLOAD: Целевое расширение: {target_extension} (Конвертация: {'Да' if needs_conversion else 'Нет'})", status_callback)
-
-        # Определяем финальный путь (с обработкой коллизий)
-        save_dir = os.path.dirname(save_path_base); os.makedirs(save_dir, exist_ok=True)
-        final_save_path_base = save_path_base # Используем исходную базу имени
-        final_save_path = final_save_path_base + target_extension
-        counter = 1
-        original_final_path = final_save_path
-        while os.path.exists(final_save_path):
-            final_save_path = f"{final_save_path_base}_{counter}{target_extension}"; counter += 1
-            if counter > 1000: return False, f"Слишком много файлов с похожим именем для {target_extension}. Пропуск: {original_final_path}"
-        _log_status(f"DOWNLOAD: Финальный путь: {final_save_path}", status_callback)
-
-        # Определяем временный путь
-        temp_save_path = final_save_path_base + "_temp" + initial_extension
-        _log_status(f"DOWNLOAD: Временный путь: {temp_save_path}", status_callback)
+        needs_conversion, final_save_path, temp_save_path = _prepare_image_paths(save_path_base, initial_extension, status_callback)
+
+        # --- Формат требует конвертации: скачиваем в память и конвертируем в пуле CONVERSION_EXECUTOR ---
+        if needs_conversion:
+            try:
+                buffer = io.BytesIO()
+                for chunk in response.iter_content(chunk_size=8192):
+                    if chunk: buffer.write(chunk)
+                if buffer.tell() == 0:
+                     raise ValueError("Скачанный файл пустой")
+                log_event(status_callback, logging.DEBUG, 'DOWNLOAD', "DOWNLOAD: Изображение получено в память (%d байт)", buffer.tell(), duration=time.perf_counter() - started)
+            except Exception as read_err:
+                 return False, f"Ошибка получения данных изображения {image_url}: {read_err}"
+            source_hash = hashlib.sha256(buffer.getbuffer()).hexdigest()
+            stored_result = _reuse_stored_source(image_url, source_hash, response.headers, None, save_path_base, status_callback, target_size, row_info)
+            if stored_result: return stored_result
+            result = _submit(CONVERSION_EXECUTOR, convert_image_data, buffer.getvalue(), temp_save_path, final_save_path, status_callback, target_size).result()
+            result, sha256 = _store_saved_image(result, image_url, final_save_path, source_hash, response.headers, target_size, status_callback)
+            return _record_saved_file(result, final_save_path, row_info, sha256)
 
         # --- Скачивание во временный файл ---
-        downloaded_size = 0
+        downloaded_size = 0; digest = hashlib.sha256()
         try:
             with open(temp_save_path, 'wb') as f:
                 for chunk in response.iter_content(chunk_size=8192):
-                    if chunk: f.write(chunk); downloaded_size += len(chunk)
+                    if chunk: f.write(chunk); digest.update(chunk); downloaded_size += len(chunk)
             if downloaded_size == 0:
                  raise ValueError("Скачанный файл пустой")
-            _log_status(f"DOWNLOAD: Временный файл сохранен: {temp_save_path} ({downloaded_size} байт)", status_callback)
+            log_event(status_callback, logging.DEBUG, 'DOWNLOAD', "DOWNLOAD: Временный файл сохранен: %s (%d байт)", temp_save_path, downloaded_size, duration=time.perf_counter() - started)
         except Exception as write_err:
              if os.path.exists(temp_save_path): os.remove(temp_save_path)
              return False, f"Ошибка записи временного файла {temp_save_path}: {write_err}"
 
-        # --- Конвертация (если нужна) ---
-        if needs_conversion:
-            # Проверяем наличие ImageMagick: сначала 'magick', затем запасной вариант 'convert'
-            convert_path = shutil.which('magick') or shutil.which('convert')
-            if not convert_path:
-                _log_status(
-                    f"DOWNLOAD: ImageMagick ('magick' или 'convert') не найден в PATH. Невозможно конвертировать {initial_extension} в {target_extension}.",
-                    status_callback,
-                )
-                if os.path.exists(temp_save_path):
-                    os.remove(temp_save_path)
-                return False, f"Ошибка: ImageMagick не найден для конвертации {initial_extension}"
-
-            exe_name = os.path.basename(convert_path)
-            _log_status(
-                f"DOWNLOAD: Запуск конвертации ({exe_name}): {temp_save_path} -> {final_save_path}",
-                status_callback,
-            )
-            command = [convert_path, temp_save_path, final_save_path]
-            try:
-                result = subprocess.run(
-                    command, check=True, capture_output=True, text=True, timeout=60
-                )  # Таймаут 60 сек
-                _log_status(
-                    f"DOWNLOAD: Конвертация успешна. stdout:\n{result.stdout}\nstderr:\n{result.stderr}",
-                    status_callback,
-                )
-                if os.path.exists(temp_save_path):
-                    os.remove(temp_save_path)  # Удаляем временный файл
-                return True, f"Изображение успешно скачано и конвертировано в {os.path.basename(final_save_path)}"
-            except FileNotFoundError:  # На случай, если shutil.which обманул
-                _log_status(
-                    "DOWNLOAD: Ошибка конвертации - команда 'magick'/'convert' не найдена (FileNotFoundError).",
-                    status_callback,
-                )
-                if os.path.exists(temp_save_path):
-                    os.remove(temp_save_path)
-                return False, "Ошибка конвертации: команда ImageMagick не найдена"
-            except subprocess.CalledProcessError as conv_err:
-                _log_status(
-                    f"DOWNLOAD: Ошибка конвертации ImageMagick (код {conv_err.returncode}). Команда: {' '.join(command)}\nstdout:\n{conv_err.stdout}\nstderr:\n{conv_err.stderr}",
-                    status_callback,
-                )
-                if os.path.exists(temp_save_path):
-                    os.remove(temp_save_path)
-                if os.path.exists(final_save_path):
-                    os.remove(final_save_path)  # Удаляем возможно частично созданный файл
-                return False, f"Ошибка конвертации ImageMagick: {conv_err.stderr[:200]}"
-            except subprocess.TimeoutExpired:
-                _log_status(
-                    f"DOWNLOAD: Ошибка конвертации ImageMagick - превышен таймаут.",
-                    status_callback,
-                )
-                if os.path.exists(temp_save_path):
-                    os.remove(temp_save_path)
-                if os.path.exists(final_save_path):
-                    os.remove(final_save_path)
-                return False, "Ошибка конвертации: превышен таймаут ImageMagick"
-            except Exception as conv_exc:  # Другие возможные ошибки
-                _log_status(
-                    f"DOWNLOAD: Непредвиденная ошибка при конвертации: {conv_exc}",
-                    status_callback,
-                )
-                if os.path.exists(temp_save_path):
-                    os.remove(temp_save_path)
-                if os.path.exists(final_save_path):
-                    os.remove(final_save_path)
-                return False, f"Непредвиденная ошибка при конвертации: {conv_exc}"
+        source_hash = digest.hexdigest()
+        stored_result = _reuse_stored_source(image_url, source_hash, response.headers, temp_save_path, save_path_base, status_callback, target_size, row_info)
+        if stored_result: return stored_result
 
-        # --- Если конвертация не нужна ---
+        # --- Переименование в финальный файл ---
+        if target_size: # Изменение размера — в пуле CONVERSION_EXECUTOR
+            result = _submit(CONVERSION_EXECUTOR, _save_and_resize, temp_save_path, final_save_path, status_callback, target_size).result()
         else:
-            _log_status(f"DOWNLOAD: Конвертация не требуется. Переименование {temp_save_path} -> {final_save_path}", status_callback)
-            try:
-                os.rename(temp_save_path, final_save_path)
-                return True, f"Изображение успешно сохранено как: {os.path.basename(final_save_path)}"
-            except OSError as rename_err:
-                 _log_status(f"DOWNLOAD: Ошибка переименования временного файла: {rename_err}", status_callback)
-                 if os.path.exists(temp_save_path): os.remove(temp_save_path) # Пытаемся удалить временный
-                 if os.path.exists(final_save_path): os.remove(final_save_path) # И финальный, если вдруг создался
-                 return False, f"Ошибка переименования файла: {rename_err}"
+            result = _finalize_image_file(temp_save_path, final_save_path, False, status_callback)
+        result, sha256 = _store_saved_image(result, image_url, final_save_path, source_hash, response.headers, target_size, status_callback)
+        # Без изменения размера файл результата — скачанные байты как есть, их хэш уже посчитан
+        return _record_saved_file(result, final_save_path, row_info, sha256 or (None if target_size else source_hash))
 
     # --- Обработка общих ошибок ---
     except requests.exceptions.Timeout:
@@ -768,174 +1698,1207 @@ def download_image(session, image_url, save_path_base, status_callback=None):
     except Exception as e:
         if temp_save_path and os.path.exists(temp_save_path): os.remove(temp_save_path)
         import traceback; return False, f"Непредвиденная ошибка при скачивании/обработке {image_url}: {e}\n{traceback.format_exc()}"
+    finally:
+        if response is not None: response.close() # Возвращаем соединение в пул сессии
+
+
+# --- Пул браузеров Selenium ---
+_chromedriver_path = None
+_chromedriver_lock = threading.Lock()
+
+def _build_chrome_options(headless):
+    """Собирает Options для Chrome (общие для всех браузеров пула)."""
+    options = Options();
+    options.page_load_strategy = SELENIUM_PAGE_LOAD_STRATEGY
+    if headless: options.add_argument('--headless=new')
+    options.add_argument('--no-sandbox'); options.add_argument('--disable-dev-shm-usage'); options.add_argument('--disable-gpu')
+    options.add_argument('--window-size=1920,1080'); options.add_argument(f'user-agent={random.choice(USER_AGENTS)}')
+    options.add_experimental_option("excludeSwitches", ["enable-automation"]); options.add_experimental_option('useAutomationExtension', False)
+    options.add_argument('--disable-blink-features=AutomationControlled'); options.add_argument('--disable-infobars')
+    options.add_argument('--disable-popup-blocking'); options.add_argument('--ignore-certificate-errors')
+    options.add_argument('--disable-extensions'); options.add_argument('--profile-directory=Default'); options.add_argument("--incognito")
+    options.add_argument("--disable-plugins-discovery")
+    # Применяем путь к бинарнику Chrome при наличии
+    if CHROME_BINARY:
+        options.binary_location = CHROME_BINARY
+    # Применяем дополнительные аргументы из переменной окружения (поддержка разделителей запятая/пробел)
+    if CHROME_ARGS:
+        for a in re.split(r'[\s,]+', CHROME_ARGS.strip()):
+            if a:
+                options.add_argument(a)
+    return options
+
+
+def _create_chrome_driver(headless):
+    """Запускает новый экземпляр Chrome. ChromeDriverManager().install() вызывается один раз на процесс."""
+    global _chromedriver_path
+    options = _build_chrome_options(headless)
+    if WEBDRIVER_PATH: driver = webdriver.Chrome(service=Service(WEBDRIVER_PATH), options=options)
+    else:
+        with _chromedriver_lock:
+            if _chromedriver_path is None:
+                try:
+                    from webdriver_manager.chrome import ChromeDriverManager
+                    _chromedriver_path = ChromeDriverManager().install()
+                except ImportError: _chromedriver_path = '' # Полагаемся на PATH
+        if _chromedriver_path: driver = webdriver.Chrome(service=Service(_chromedriver_path), options=options)
+        else: driver = webdriver.Chrome(options=options)
+    driver.set_page_load_timeout(60)
+    driver.execute_cdp_cmd('Page.addScriptToEvaluateOnNewDocument', {'source': "Object.defineProperty(navigator, 'webdriver', {get: () => undefined})"})
+    if SELENIUM_BLOCK_RESOURCES: # Профиль для извлечения: без картинок, шрифтов, медиа и аналитики
+        driver.execute_cdp_cmd('Network.enable', {})
+        driver.execute_cdp_cmd('Network.setBlockedURLs', {'urls': SELENIUM_BLOCKED_URLS})
+    return driver
+
+
+def _wait_for_page_content(driver, status_callback=None, timeout=SELENIUM_CONTENT_WAIT):
+    """
+    Одно общее ожидание вместо ожидания body + паузы: готовность DOM (readyState не 'loading').
+    Появление элементов по селекторам домена ждет уже _RESOLVE_SELECTORS_SCRIPT.
+    """
+    try:
+        WebDriverWait(driver, timeout).until(lambda d: d.execute_script('return document.readyState') != 'loading')
+    except TimeoutException:
+        _log_status(f"SELENIUM: За {timeout} с страница не дошла до готовности DOM.", status_callback)
 
 
-# --- Обновленная функция process_single_row ---
-def process_single_row(row_data, download_dir, headless, status_callback=None): # Добавлен status_callback
+class ChromeDriverPool:
     """
-    Обрабатывает одну строку CSV: сначала пытается быстрый парсинг (requests+BS),
-    при неудаче переключается на медленный (Selenium).
+    Пул «тёплых» браузеров Chrome, общий для всех строк и задач процесса.
+    Размер пула ограничивает число одновременно открытых страниц (как раньше SELENIUM_SEMAPHORE).
+    Браузер пересоздается после max_pages страниц или после сбоя.
     """
-    if not row_data or len(row_data) < 2: return False, "Пропущено: Некорректные данные строки"
-    product_url = row_data[0].strip(); desired_filename_base = row_data[1].strip()
-    _log_status(f"PROCESS_ROW: Начало обработки URL: {product_url}, Имя файла: {desired_filename_base}", status_callback) # <-- ЛОГ
-    safe_filename = desired_filename_base
-    max_filename_length = 100
-    safe_filename = safe_filename[:max_filename_length] if len(safe_filename) > max_filename_length else safe_filename
+    def __init__(self, size, max_pages=SELENIUM_MAX_PAGES_PER_DRIVER):
+        self.size = max(1, int(size))
+        self.max_pages = max(1, int(max_pages))
+        self._slots = threading.BoundedSemaphore(self.size)
+        self._lock = threading.Lock()
+        self._idle = [] # Свободные браузеры
+        self._info = {} # id(driver) -> {'headless': bool, 'pages': int}
+
+    def acquire(self, headless, timeout=300):
+        """Выдает браузер из пула (или запускает новый). Возвращает None по таймауту ожидания слота."""
+        if not self._slots.acquire(timeout=timeout): return None
+        try:
+            while True:
+                with self._lock:
+                    driver = self._idle.pop() if self._idle else None
+                if driver is None: break
+                if self._info.get(id(driver), {}).get('headless') == headless: return driver
+                self._discard(driver) # Браузер в другом режиме (headless/с окном) — пересоздаем
+            driver = _create_chrome_driver(headless)
+            with self._lock:
+                self._info[id(driver)] = {'headless': headless, 'pages': 0}
+            return driver
+        except Exception:
+            self._slots.release()
+            raise
+
+    def release(self, driver, broken=False):
+        """Возвращает браузер в пул. Сломанный или отработавший свой лимит браузер закрывается."""
+        try:
+            if driver is None: return
+            with self._lock:
+                info = self._info.get(id(driver))
+                if info: info['pages'] += 1
+            if broken or not info or info['pages'] >= self.max_pages:
+                self._discard(driver)
+                return
+            try:
+                # Сбрасываем состояние между строками (вместо нового incognito-профиля)
+                driver.execute_cdp_cmd('Network.clearBrowserCookies', {})
+                driver.get('about:blank')
+            except Exception:
+                self._discard(driver)
+                return
+            with self._lock:
+                self._idle.append(driver)
+        finally:
+            self._slots.release()
+
+    def _discard(self, driver):
+        with self._lock:
+            self._info.pop(id(driver), None)
+        try:
+            driver.quit()
+        except Exception:
+            pass
+
+    def close_all(self):
+        """Закрывает все свободные браузеры (при завершении процесса)."""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for driver in idle:
+            self._discard(driver)
+
+
+SELENIUM_POOL = ChromeDriverPool(SELENIUM_CONCURRENCY)
+atexit.register(SELENIUM_POOL.close_all)
+
+
+# --- Кэш разрешения URL товара в URL изображения ---
+def _is_tracking_param(name):
+    name = name.lower()
+    return name.startswith(TRACKING_QUERY_PREFIX) or name in TRACKING_QUERY_PARAMS
+
+def normalize_product_url(url):
+    """Нормализует URL товара для ключа кэша: регистр хоста, без фрагмента, трекинговых параметров и завершающего '/'."""
+    try:
+        parsed = urlparse(url.strip())
+        query = sorted((k, v) for k, v in parse_qsl(parsed.query, keep_blank_values=True)
+                       if not _is_tracking_param(k))
+        path = parsed.path.rstrip('/') or '/'
+        return f"{parsed.scheme.lower()}://{parsed.netloc.lower()}{path}" + (f"?{urlencode(query)}" if query else '')
+    except Exception:
+        return url.strip()
+
+
+class ResolutionCache:
+    """
+    Постоянный кэш (SQLite) «нормализованный URL товара -> URL изображения, стратегия, время».
+    Записи старше ttl не выдаются; при превышении max_entries удаляются давно не использованные.
+    Ошибки SQLite не прерывают обработку — кэш просто не срабатывает.
+    """
+    def __init__(self, path, ttl=RESOLUTION_CACHE_TTL, max_entries=RESOLUTION_CACHE_MAX_ENTRIES):
+        self.path = path; self.ttl = ttl; self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._conn = None
+        self._puts_since_evict = 0
+
+    def _connect(self):
+        if self._conn is None:
+            self._conn = _open_sqlite(
+                self.path,
+                'CREATE TABLE IF NOT EXISTS resolutions ('
+                ' product_url TEXT PRIMARY KEY, image_url TEXT NOT NULL, strategy TEXT,'
+                ' created_at REAL NOT NULL, last_used REAL NOT NULL)',
+                'CREATE INDEX IF NOT EXISTS idx_resolutions_last_used ON resolutions (last_used)',
+            )
+        return self._conn
+
+    def get(self, product_url):
+        """Возвращает {'image_url', 'strategy', 'created_at'} или None (нет записи или истек TTL)."""
+        key = normalize_product_url(product_url); now = time.time()
+        try:
+            with self._lock:
+                conn = self._connect()
+                row = conn.execute('SELECT image_url, strategy, created_at FROM resolutions WHERE product_url = ?', (key,)).fetchone()
+                if not row: return None
+                if self.ttl > 0 and now - row[2] > self.ttl:
+                    conn.execute('DELETE FROM resolutions WHERE product_url = ?', (key,)); conn.commit()
+                    return None
+                conn.execute('UPDATE resolutions SET last_used = ? WHERE product_url = ?', (now, key)); conn.commit()
+                return {'image_url': row[0], 'strategy': row[1], 'created_at': row[2]}
+        except sqlite3.Error:
+            return None
+
+    def put(self, product_url, image_url, strategy=None):
+        key = normalize_product_url(product_url); now = time.time()
+        try:
+            with self._lock:
+                conn = self._connect()
+                conn.execute('INSERT OR REPLACE INTO resolutions (product_url, image_url, strategy, created_at, last_used) VALUES (?, ?, ?, ?, ?)',
+                             (key, image_url, strategy, now, now))
+                self._puts_since_evict += 1
+                if self._puts_since_evict >= 100:
+                    self._evict(conn); self._puts_since_evict = 0
+                conn.commit()
+        except sqlite3.Error:
+            pass
+
+    def invalidate(self, product_url):
+        try:
+            with self._lock:
+                conn = self._connect()
+                conn.execute('DELETE FROM resolutions WHERE product_url = ?', (normalize_product_url(product_url),)); conn.commit()
+        except sqlite3.Error:
+            pass
+
+    def _evict(self, conn):
+        """Удаляет просроченные записи и самые давно использованные сверх max_entries."""
+        if self.ttl > 0:
+            conn.execute('DELETE FROM resolutions WHERE created_at < ?', (time.time() - self.ttl,))
+        excess = conn.execute('SELECT COUNT(*) FROM resolutions').fetchone()[0] - self.max_entries
+        if excess > 0:
+            conn.execute('DELETE FROM resolutions WHERE product_url IN (SELECT product_url FROM resolutions ORDER BY last_used ASC LIMIT ?)', (excess,))
+
+
+RESOLUTION_CACHE = ResolutionCache(RESOLUTION_CACHE_PATH) if RESOLUTION_CACHE_ENABLED else None
+
+
+def _remember_resolution(product_url, image_url, strategy):
+    """Сохраняет успешно скачанный URL изображения в RESOLUTION_CACHE."""
+    if RESOLUTION_CACHE: RESOLUTION_CACHE.put(product_url, image_url, strategy)
+
+
+# --- Маршрутизация по доменам ---
+class DomainRouter:
+    """
+    Статистика по доменам: сколько раз быстрый путь и Selenium дали изображение, сколько это заняло
+    и какая стратегия победила. Хранится в SQLite между запусками: save() (в конце run_parser) дописывает
+    приращения этого процесса к счетчикам в базе, поэтому несколько процессов-воркеров не затирают друг друга.
+    route() отправляет домен сразу в Selenium, если быстрый путь для него стабильно не срабатывает;
+    strategy_order() ставит первой стратегию, которая чаще всего находила изображение.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._stats = None # {(domain, method, strategy): [attempts, successes, total_seconds]}; strategy '' — итог по методу
+        self._pending = {} # Приращения с последнего save(), в том же формате
+
+    def _read(self):
+        """Счетчики из SQLite (пустой dict, если базы нет или она недоступна)."""
+        stats = {}
+        try:
+            conn = _open_sqlite(self.path, 'CREATE TABLE IF NOT EXISTS domain_stats ('
+                                ' domain TEXT, method TEXT, strategy TEXT, attempts INTEGER, successes INTEGER,'
+                                ' total_seconds REAL, updated_at REAL, PRIMARY KEY (domain, method, strategy))')
+            with conn:
+                for domain, method, strategy, attempts, successes, total_seconds in conn.execute(
+                        'SELECT domain, method, strategy, attempts, successes, total_seconds FROM domain_stats'):
+                    stats[(domain, method, strategy)] = [attempts, successes, total_seconds]
+            conn.close()
+        except sqlite3.Error:
+            pass
+        return stats
+
+    def _load(self):
+        if self._stats is None:
+            self._stats = self._read()
+            for key, increment in self._pending.items(): self._add(self._stats, key, increment)
+        return self._stats
+
+    @staticmethod
+    def _add(stats, key, increment):
+        entry = stats.setdefault(key, [0, 0, 0.0])
+        for index, value in enumerate(increment): entry[index] += value
+
+    def record(self, domain, method, success, elapsed, strategy=None):
+        """Учитывает попытку метода ('fast' или 'selenium') для домена; при успехе — и победившую стратегию."""
+        with self._lock:
+            stats = self._load()
+            keys = [(domain, method, '')] + ([(domain, method, strategy)] if success and strategy else [])
+            increment = (1, 1 if success else 0, elapsed)
+            for key in keys:
+                self._add(stats, key, increment); self._add(self._pending, key, increment)
+
+    def _rate(self, domain, method):
+        attempts, successes, _ = self._load().get((domain, method, ''), (0, 0, 0.0))
+        return attempts, (successes / attempts if attempts else 0.0)
+
+    def route(self, domain):
+        """Возвращает ('fast' | 'selenium', пояснение)."""
+        with self._lock:
+            fast_attempts, fast_rate = self._rate(domain, 'fast')
+            selenium_attempts, selenium_rate = self._rate(domain, 'selenium')
+        if fast_attempts < ROUTING_MIN_ATTEMPTS or fast_rate >= ROUTING_FAST_MIN_SUCCESS: return 'fast', None
+        if selenium_attempts and selenium_rate <= fast_rate: return 'fast', None
+        reason = f"быстрый путь успешен в {fast_rate:.0%} из {fast_attempts} попыток"
+        if random.random() < ROUTING_PROBE_RATE: return 'fast', f"{reason}, контрольная попытка"
+        return 'selenium', reason
+
+    def strategy_order(self, domain, method='fast'):
+        """Стратегии HTML_STRATEGIES, отсортированные по числу побед на домене (при равенстве — порядок по умолчанию)."""
+        with self._lock:
+            stats = self._load()
+            wins = {strategy: stats.get((domain, method, strategy), (0, 0, 0.0))[1] for strategy in HTML_STRATEGIES}
+        if max(wins.values()) < ROUTING_MIN_ATTEMPTS: return HTML_STRATEGIES
+        return tuple(sorted(HTML_STRATEGIES, key=lambda strategy: -wins[strategy]))
+
+    def stats(self, domain=None):
+        """Статистика для просмотра: список dict по (домен, метод, стратегия)."""
+        with self._lock:
+            items = sorted(self._load().items())
+        return [{'domain': d, 'method': m, 'strategy': s or None, 'attempts': a, 'successes': ok,
+                 'success_rate': round(ok / a, 3) if a else 0.0, 'avg_seconds': round(t / a, 3) if a else 0.0}
+                for (d, m, s), (a, ok, t) in items if domain is None or d == domain]
+
+    def save(self):
+        """
+        Прибавляет накопленные приращения к счетчикам в SQLite (upsert) и перечитывает итоги,
+        чтобы учесть попытки других процессов. При ошибке записи приращения остаются до следующего save().
+        """
+        with self._lock:
+            if not self._pending: return
+            pending = self._pending; self._pending = {}
+        rows = [key + tuple(increment) + (time.time(),) for key, increment in pending.items()]
+        try:
+            conn = _open_sqlite(self.path)
+            with conn:
+                conn.executemany('INSERT INTO domain_stats (domain, method, strategy, attempts, successes, total_seconds, updated_at)'
+                                 ' VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT (domain, method, strategy) DO UPDATE SET'
+                                 ' attempts = attempts + excluded.attempts, successes = successes + excluded.successes,'
+                                 ' total_seconds = total_seconds + excluded.total_seconds, updated_at = excluded.updated_at', rows)
+            conn.close()
+        except sqlite3.Error:
+            with self._lock:
+                for key, increment in pending.items(): self._add(self._pending, key, increment)
+            return
+        with self._lock:
+            self._stats = None # Следующее обращение перечитает базу (с приращениями, накопленными после записи)
+
+
+DOMAIN_ROUTER = DomainRouter(DOMAIN_STATS_PATH) if DOMAIN_ROUTING_ENABLED else None
+if DOMAIN_ROUTER: atexit.register(DOMAIN_ROUTER.save)
+
+
+def choose_route(domain, status_callback=None):
+    """Выбирает путь для строки: 'fast' (requests/httpx) или сразу 'selenium'."""
+    if EMBEDDED_STATE_ENABLED and domain in EMBEDDED_STATE_DOMAINS:
+        _log_status(f"PROCESS_ROW: Легкий режим для домена {domain} (встроенное состояние / product API), Selenium — только при неудаче", status_callback)
+    elif domain in FORCE_SELENIUM_DOMAINS:
+        _log_status(f"PROCESS_ROW: Принудительное использование Selenium для домена {domain}", status_callback)
+        return 'selenium'
+    if not (DOMAIN_ROUTER and _selenium_available): return 'fast'
+    route, reason = DOMAIN_ROUTER.route(domain)
+    if reason: _log_status(f"ROUTING: {domain}: {reason} -> {'Selenium' if route == 'selenium' else 'быстрый путь'}", status_callback)
+    return route
+
+
+def _html_strategy_order(domain):
+    order = DOMAIN_ROUTER.strategy_order(domain) if DOMAIN_ROUTER else HTML_STRATEGIES
+    if EMBEDDED_STATE_ENABLED and domain in EMBEDDED_STATE_DOMAINS: order = ('state',) + tuple(order)
+    return order
+
+
+def _find_image_url_via_product_api(session, product_url, status_callback=None):
+    """Легкий режим: запрашивает product API (если он известен для домена) и ищет в ответе главное изображение."""
+    api_url = product_api_url(product_url)
+    if not api_url: return None
+    _log_status(f"PRODUCT_API: Запрос {api_url}", status_callback)
+    try:
+        response = session.get(api_url, timeout=15, headers={'Accept': 'application/json'})
+        response.raise_for_status()
+        return find_image_url_from_product_api(response.text, product_url)
+    except requests.exceptions.RequestException as api_err:
+        _log_status(f"PRODUCT_API: Ошибка запроса для {product_url}: {api_err}", status_callback)
+        return None
+
+
+async def _find_image_url_via_product_api_async(client, product_url, status_callback=None):
+    """Асинхронный аналог _find_image_url_via_product_api на httpx.AsyncClient."""
+    api_url = product_api_url(product_url)
+    if not api_url: return None
+    _log_status(f"PRODUCT_API: Запрос {api_url}", status_callback)
+    try:
+        response = await client.get(api_url, timeout=15, headers={'Accept': 'application/json'})
+        response.raise_for_status()
+        return find_image_url_from_product_api(response.text, product_url)
+    except httpx.HTTPError as api_err:
+        _log_status(f"PRODUCT_API: Ошибка запроса для {product_url}: {api_err}", status_callback)
+        return None
+
+
+def _record_route(domain, method, success, started, strategy=None):
+    """Учитывает исход метода в DOMAIN_ROUTER (started — time.perf_counter() начала попытки)."""
+    if DOMAIN_ROUTER: DOMAIN_ROUTER.record(domain, method, success, time.perf_counter() - started, strategy)
+
+
+# --- Подготовка строки CSV ---
+def _row_target(row_data):
+    """(URL товара, имя файла без расширения) строки CSV."""
+    return row_data[0].strip(), row_data[1].strip()[:100]
+
+
+def _prepare_row(row_data, status_callback=None):
+    """Проверяет строку CSV. Возвращает (product_url, safe_filename, None) или (None, None, сообщение об ошибке)."""
+    product_url, safe_filename = _row_target(row_data)
+    _log_status(f"PROCESS_ROW: Начало обработки URL: {product_url}, Имя файла: {row_data[1].strip()}", status_callback) # <-- ЛОГ
     if not safe_filename:
         _log_status(f"PROCESS_ROW: Пропущено (пустое имя файла после очистки) для URL: {product_url}", status_callback)
-        return False, f"Пропущено: Пустое имя файла после очистки для URL: {product_url}"
+        return None, None, f"Пропущено: Пустое имя файла после очистки для URL: {product_url}"
     if not (product_url.lower().startswith('http://') or product_url.lower().startswith('https://')):
         _log_status(f"PROCESS_ROW: Пропущено (невалидный URL протокол) для URL: {product_url}", status_callback)
-        return False, f"Пропущено: Невалидный URL протокол '{product_url}'"
+        return None, None, f"Пропущено: Невалидный URL протокол '{product_url}'"
+    return product_url, safe_filename, None
+
+
+# --- Конвейер строки: поиск URL изображения (resolve_row) и скачивание (download_row) ---
+# image_url/strategy/method ('cache', 'fast', 'selenium') — при успехе поиска; message — причина неудачи;
+# оба None — быстрый путь не дал URL и строке нужен браузер. started — начало попытки (для DOMAIN_ROUTER).
+RowResolution = namedtuple('RowResolution', 'product_url save_path_base domain image_url strategy method message fast_parse_failed started')
+
 
+def _resolve_from_cache(product_url, save_path_base, domain, status_callback=None):
+    """RowResolution с URL изображения из RESOLUTION_CACHE или None (общая для обоих движков)."""
+    cached = RESOLUTION_CACHE.get(product_url) if RESOLUTION_CACHE else None
+    if not cached: return None
+    _log_status(f"CACHE: URL изображения найден в кэше (стратегия: {cached['strategy']}): {cached['image_url']}", status_callback)
+    return RowResolution(product_url, save_path_base, domain, cached['image_url'], cached['strategy'], 'cache', None, None, time.perf_counter())
+
+
+def resolve_image_url_fast(session, product_url, domain_for_check, status_callback=None):
+    """
+    Быстрый путь без скачивания: страница через requests и стратегии разбора, затем product API.
+    Возвращает (улучшенный URL изображения, стратегия) или (None, None). Ошибки сети пробрасываются.
+    """
+    image_url = None; strategy = None
+    try:
+        response = session.get(product_url, timeout=15, allow_redirects=True)
+        response.raise_for_status()
+        response.encoding = response.apparent_encoding if response.apparent_encoding else 'utf-8'
+        html_content = response.text; base_url = response.url
+        domain = get_domain(base_url)
+
+        image_url, strategy = resolve_image_url_from_html(html_content, domain, base_url, status_callback, _html_strategy_order(domain_for_check)) # Один парсинг на все стратегии
+    except requests.exceptions.RequestException as page_err:
+        if not product_api_url(product_url): raise
+        _log_status(f"PROCESS_ROW: Страница недоступна ({page_err}), пробуем product API", status_callback)
+    if image_url is None: # Легкий режим: тот же запрос к API, что делает страница
+        image_url = _find_image_url_via_product_api(session, product_url, status_callback); strategy = 'product_api'
+    if not image_url: return None, None
+    _log_status(f"PROCESS_ROW: Выбран URL для скачивания (быстрый парсинг): {image_url}", status_callback)
+    # Улучшаем URL перед скачиванием
+    image_url = improve_image_url(image_url, status_callback)
+    _log_debug(status_callback, "PROCESS_ROW: Улучшенный URL для скачивания: %s", image_url)
+    return image_url, strategy
+
+
+def resolve_image_url_with_selenium(product_url, headless, status_callback=None, session=None):
+    """
+    Медленный путь без скачивания: открывает страницу в браузере из SELENIUM_POOL и находит URL изображения.
+    Браузер возвращается в пул сразу после этого, скачивание идет уже без него.
+    Возвращает (улучшенный URL изображения, стратегия, None) или (None, None, сообщение об ошибке).
+    """
+    driver = None; driver_broken = False
+    try:
+        try:
+            driver = SELENIUM_POOL.acquire(headless, timeout=300)
+        except Exception as driver_init_err: return None, None, f"Ошибка инициализации ChromeDriver: {driver_init_err}."
+        if driver is None:
+            return None, None, "Selenium: таймаут ожидания свободного слота браузера. Уменьшите параллелизм."
+
+        # Ротация User-Agent для каждой строки без перезапуска браузера
+        driver.execute_cdp_cmd('Network.setUserAgentOverride', {'userAgent': random.choice(USER_AGENTS)})
+        # Навигация с повторной попыткой при таймауте
+        _nav_attempts = 2
+        for _attempt in range(_nav_attempts):
+            try:
+                if session is not None and getattr(session, 'limiter', None): # Страница в браузере — тоже запрос к хосту
+                    host = urlparse(product_url).hostname or ''; session.limiter.acquire(host)
+                    try: driver.get(product_url)
+                    finally: session.limiter.release(host)
+                else:
+                    driver.get(product_url)
+                break
+            except TimeoutException:
+                if _attempt + 1 == _nav_attempts:
+                    raise
+        if SELENIUM_PAGE_LOAD_STRATEGY == 'none': # driver.get вернулся до перехода — ждем документ новой страницы
+            WebDriverWait(driver, SELENIUM_CONTENT_WAIT).until(lambda d: d.execute_script('return location.href') != 'about:blank')
+        # Одно ожидание любого селектора домена (внутри скрипта поиска) вместо body + случайной паузы
+        base_url = driver.current_url; domain = get_domain(base_url)
+        if DOMAIN_SELECTORS.get(domain):
+            image_url = find_image_url_from_selenium_element(driver, domain, status_callback, timeout=SELENIUM_CONTENT_WAIT)
+        else:
+            _wait_for_page_content(driver, status_callback); image_url = None
+        strategy = 'selenium_element'
+        if image_url is None: # Fallback на парсинг source после Selenium
+             _log_status(f"SELENIUM: Не удалось найти URL через элементы Selenium для {product_url}. Попытка парсинга page_source...", status_callback)
+             html_content = driver.page_source
+             image_url, source_strategy = resolve_image_url_from_html(html_content, domain, base_url, status_callback)
+             strategy = f"selenium_{source_strategy}"
+
+        if not image_url: return None, None, f"Не удалось найти URL главного изображения для {product_url} после всех попыток (включая Selenium)."
+        _log_status(f"PROCESS_ROW: Выбран URL для скачивания (Selenium/page_source): {image_url}", status_callback)
+        # Улучшаем URL перед скачиванием
+        image_url = improve_image_url(image_url, status_callback)
+        _log_debug(status_callback, "PROCESS_ROW: Улучшенный URL для скачивания: %s", image_url)
+        return image_url, strategy, None
+    except TimeoutException: return None, None, f"Ошибка загрузки страницы Selenium (таймаут) для {product_url}"
+    except WebDriverException as e: driver_broken = True; err_msg = str(e); return None, None, f"Ошибка WebDriver при обработке {product_url}: {err_msg[:200]}"
+    except Exception as e: import traceback; return None, None, f"Непредвиденная ошибка при обработке {product_url} (Selenium): {e}\n{traceback.format_exc()}"
+    finally:
+        if driver: SELENIUM_POOL.release(driver, broken=driver_broken) # Браузер остается «тёплым» для следующих строк
+
+
+def resolve_row(row_data, download_dir, headless, status_callback=None, http_session=None, route=None, fast_parse_failed=None):
+    """
+    Стадия поиска: находит URL изображения строки, не скачивая его.
+    fast_parse_failed=None — первая попытка: RESOLUTION_CACHE, затем маршрут route (или choose_route);
+    быстрый путь, не давший URL, возвращает RowResolution без image_url и message — строку передают браузеру.
+    fast_parse_failed=True/False — быстрый путь уже пробовали (ошибка / URL не найден), сразу Selenium.
+    """
+    if fast_parse_failed is None:
+        product_url, safe_filename, error_message = _prepare_row(row_data, status_callback)
+        if error_message: return RowResolution(None, None, None, None, None, None, error_message, None, None)
+    else:
+        product_url, safe_filename = _row_target(row_data)
+    save_path_base = os.path.join(download_dir, safe_filename)
     domain_for_check = get_domain(product_url)
-    force_selenium_domains = ['rozetka.com.ua', 'bt.rozetka.com.ua', 'hard.rozetka.com.ua']
-    image_url = None; session = None; fast_parse_failed = False # Инициализация по умолчанию
-
-    # --- ПРОВЕРКА: Принудительный Selenium для Rozetka ---
-    if domain_for_check in force_selenium_domains:
-        _log_status(f"PROCESS_ROW: Принудительное использование Selenium для домена {domain_for_check}", status_callback)
-        fast_parse_failed = True # Устанавливаем флаг, чтобы пропустить быстрый парсинг и перейти к Selenium
-    # --- Конец проверки ---
-    else: # <-- Только если это НЕ Rozetka, пытаемся быстрый парсинг
-        # --- Попытка 1: Быстрый парсинг ---
-        try: # <-- Начало блока try с правильным отступом
-            session = requests.Session(); session.headers.update(BASE_HEADERS); session.headers['User-Agent'] = random.choice(USER_AGENTS)
-            response = session.get(product_url, timeout=15, allow_redirects=True)
-            response.raise_for_status()
-            response.encoding = response.apparent_encoding if response.apparent_encoding else 'utf-8'
-            html_content = response.text; base_url = response.url
-            domain = get_domain(base_url)
-
-            image_url = find_image_url_from_schema(html_content, base_url)
-            if image_url is None: image_url = find_image_url_from_og_image(html_content, base_url)
-            if image_url is None: image_url = find_image_url_from_css_selectors(html_content, domain, base_url, status_callback) # Передаем callback
-
-            if image_url:
-                 _log_status(f"PROCESS_ROW: Выбран URL для скачивания (быстрый парсинг): {image_url}", status_callback)
-                 # Улучшаем URL перед скачиванием
-                 image_url = improve_image_url(image_url, status_callback)
-                 _log_status(f"PROCESS_ROW: Улучшенный URL для скачивания: {image_url}", status_callback)
-                 save_path_base = os.path.join(download_dir, safe_filename)
-                 # Передаем status_callback в download_image
-                 download_success, message = download_image(session, image_url, save_path_base, status_callback)
-                 if download_success: return True, f"Быстрый парсинг успешен: {product_url} -> {message}"
-                 else: image_url = None; fast_parse_failed = True # Переходим к Selenium
-        except (requests.exceptions.Timeout, requests.exceptions.RequestException): # <-- Блок except с правильным отступом
-             image_url = None; fast_parse_failed = True
-        except Exception as e: # Ловим другие возможные ошибки BS/парсинга
-            _log_status(f"PROCESS_ROW: Ошибка при быстром парсинге {product_url}: {e}", status_callback)
-            image_url = None; fast_parse_failed = True # Отмечаем, что была ошибка
-        finally: # <-- Блок finally с правильным отступом
-            if session: session.close() # Закрываем сессию в любом случае после попытки requests
 
-    # --- Попытка 2: Медленный парсинг (Selenium) ---
-    # --- ИЗМЕНЕНО УСЛОВИЕ: Переходим к Selenium, если URL НЕ НАЙДЕН после быстрой попытки ---
-    if image_url is None:
-        if fast_parse_failed:
-             _log_status(f"PROCESS_ROW: Быстрый парсинг не удался (ошибка) для {product_url}. Попытка Selenium...", status_callback)
+    if fast_parse_failed is None:
+        # --- Кэш: повторный SKU сразу идет на скачивание ---
+        cached = _resolve_from_cache(product_url, save_path_base, domain_for_check, status_callback)
+        if cached: return cached
+
+        # --- Маршрут: принудительный Selenium (Rozetka) или по статистике домена ---
+        if (route or choose_route(domain_for_check, status_callback)) == 'selenium':
+            fast_parse_failed = True # Устанавливаем флаг, чтобы пропустить быстрый парсинг и перейти к Selenium
         else:
-             _log_status(f"PROCESS_ROW: URL не найден быстрым парсингом для {product_url}. Попытка Selenium...", status_callback) # <-- ЛОГ для случая, когда ошибок не было, но URL не найден
+            # --- Попытка 1: Быстрый парсинг ---
+            fast_started = time.perf_counter(); image_url = None; fast_parse_failed = False
+            try:
+                image_url, strategy = resolve_image_url_fast(http_session, product_url, domain_for_check, status_callback)
+            except requests.exceptions.RequestException:
+                fast_parse_failed = True
+            except Exception as e: # Ловим другие возможные ошибки BS/парсинга
+                _log_status(f"PROCESS_ROW: Ошибка при быстром парсинге {product_url}: {e}", status_callback)
+                fast_parse_failed = True # Отмечаем, что была ошибка
+            if image_url: return RowResolution(product_url, save_path_base, domain_for_check, image_url, strategy, 'fast', None, False, fast_started)
+            _record_route(domain_for_check, 'fast', False, fast_started)
+            return RowResolution(product_url, save_path_base, domain_for_check, None, None, None, None, fast_parse_failed, fast_started)
 
-        if not _selenium_available:
-            _log_status(f"PROCESS_ROW: Selenium недоступен для {product_url}", status_callback)
-            return False, f"Не удалось получить изображение быстрым методом, а Selenium недоступен для {product_url}"
-        driver = None; selenium_session = None
-        try:
-            options = Options();
-            options.page_load_strategy = 'eager'
-            if headless: options.add_argument('--headless=new')
-            options.add_argument('--no-sandbox'); options.add_argument('--disable-dev-shm-usage'); options.add_argument('--disable-gpu')
-            options.add_argument('--window-size=1920,1080'); options.add_argument(f'user-agent={random.choice(USER_AGENTS)}')
-            options.add_experimental_option("excludeSwitches", ["enable-automation"]); options.add_experimental_option('useAutomationExtension', False)
-            options.add_argument('--disable-blink-features=AutomationControlled'); options.add_argument('--disable-infobars')
-            options.add_argument('--disable-popup-blocking'); options.add_argument('--ignore-certificate-errors')
-            options.add_argument('--disable-extensions'); options.add_argument('--profile-directory=Default'); options.add_argument("--incognito")
-            options.add_argument("--disable-plugins-discovery")
-            # Применяем путь к бинарнику Chrome при наличии
-            if CHROME_BINARY:
-                options.binary_location = CHROME_BINARY
-            # Применяем дополнительные аргументы из переменной окружения (поддержка разделителей запятая/пробел)
-            if CHROME_ARGS:
-                for a in re.split(r'[\s,]+', CHROME_ARGS.strip()):
-                    if a:
-                        options.add_argument(a)
-
-            acquired = SELENIUM_SEMAPHORE.acquire(timeout=300)
-            if not acquired:
-                return False, "Selenium: таймаут ожидания свободного слота браузера. Уменьшите параллелизм."
-
-            if WEBDRIVER_PATH: service = Service(WEBDRIVER_PATH); driver = webdriver.Chrome(service=service, options=options)
+    # --- Попытка 2: Медленный парсинг (Selenium) ---
+    if fast_parse_failed:
+         _log_status(f"PROCESS_ROW: Быстрый парсинг не удался (ошибка) для {product_url}. Попытка Selenium...", status_callback)
+    else:
+         _log_status(f"PROCESS_ROW: URL не найден быстрым парсингом для {product_url}. Попытка Selenium...", status_callback) # <-- ЛОГ для случая, когда ошибок не было, но URL не найден
+    if not _selenium_available:
+        _log_status(f"PROCESS_ROW: Selenium недоступен для {product_url}", status_callback)
+        return RowResolution(product_url, save_path_base, domain_for_check, None, None, None,
+                             f"Не удалось получить изображение быстрым методом, а Selenium недоступен для {product_url}", fast_parse_failed, None)
+    started = time.perf_counter()
+    image_url, strategy, error_message = resolve_image_url_with_selenium(product_url, headless, status_callback, http_session)
+    if image_url: return RowResolution(product_url, save_path_base, domain_for_check, image_url, strategy, 'selenium', None, fast_parse_failed, started)
+    _record_route(domain_for_check, 'selenium', False, started)
+    return RowResolution(product_url, save_path_base, domain_for_check, None, None, None, error_message, fast_parse_failed, started)
+
+
+def _finish_download(resolution, download_success, message, status_callback=None, row_info=None):
+    """
+    Итог стадии скачивания: статистика домена, RESOLUTION_CACHE и сообщение строки.
+    Возвращает (success, message, fallback): fallback — 'resolve' (URL из кэша устарел, нужен обычный поиск),
+    'selenium' (быстрый путь нашел URL, но скачать не удалось) или None.
+    """
+    product_url = resolution.product_url
+    if resolution.method == 'cache':
+        if download_success: return True, f"URL из кэша: {product_url} -> {message}", None
+        _log_status(f"CACHE: Скачивание по URL из кэша не удалось ({message}). Запись удалена, выполняется обычный поиск.", status_callback)
+        RESOLUTION_CACHE.invalidate(product_url)
+        if row_info is not None: row_info.clear()
+        return False, message, 'resolve'
+    _record_route(resolution.domain, resolution.method, download_success, resolution.started, resolution.strategy)
+    if download_success:
+        _remember_resolution(product_url, resolution.image_url, resolution.strategy)
+        if resolution.method == 'fast': return True, f"Быстрый парсинг успешен: {product_url} -> {message}", None
+        return True, f"Selenium парсинг успешен: {product_url} -> {message}", None
+    if resolution.method == 'fast':
+        if row_info is not None: row_info.clear() # Сведения неудачного быстрого пути не относятся к результату Selenium
+        return False, message, 'selenium' # Переходим к Selenium
+    return False, f"Selenium парсинг (найден URL, но ошибка скачивания): {product_url} -> {message}", None
+
+
+def download_row(row_data, resolution, status_callback=None, http_session=None, resize=False, row_info=None):
+    """
+    Стадия скачивания: сохраняет изображение по URL из resolve_row (конвертация — в CONVERSION_EXECUTOR).
+    Возвращает (success, message, fallback), см. _finish_download.
+    """
+    if row_info is not None: row_info.update(method=resolution.method, image_url=resolution.image_url, strategy=resolution.strategy)
+    target_size = get_target_size(row_data) if resize else None
+    # Скачиваем через общую сессию запуска (keep-alive к CDN)
+    download_success, message = download_image(http_session, resolution.image_url, resolution.save_path_base, status_callback, target_size, row_info)
+    return _finish_download(resolution, download_success, message, status_callback, row_info)
+
+
+# --- Обновленная функция process_single_row ---
+def process_single_row(row_data, download_dir, headless, status_callback=None, http_session=None, resize=False, row_info=None, route=None): # Добавлен status_callback
+    """
+    Обрабатывает одну строку CSV: сначала пытается быстрый парсинг (requests+BS),
+    при неудаче переключается на медленный (Selenium). Стадии resolve_row и download_row
+    выполняются подряд в текущем потоке (run_parser выполняет их в отдельных пулах).
+    http_session — общая SharedHttpSession запуска; если не передана, создается временная.
+    resize — вписать изображение в размер из 3-й колонки или имени файла (см. get_target_size).
+    row_info — необязательный dict для сведений о результате: 'method', 'image_url', 'path'.
+    route — маршрут, уже выбранный планировщиком ('fast' или 'selenium'); по умолчанию — choose_route.
+    """
+    if not row_data or len(row_data) < 2: return False, "Пропущено: Некорректные данные строки"
+    if http_session is None:
+        with SharedHttpSession() as own_session:
+            return process_single_row(row_data, download_dir, headless, status_callback, own_session, resize, row_info, route)
+    fast_parse_failed = None
+    while True:
+        resolution = resolve_row(row_data, download_dir, headless, status_callback, http_session, route, fast_parse_failed)
+        if resolution.image_url is None:
+            if resolution.message is not None: return False, resolution.message
+            route, fast_parse_failed = 'selenium', resolution.fast_parse_failed; continue
+        success, message, fallback = download_row(row_data, resolution, status_callback, http_session, resize, row_info)
+        if fallback is None: return success, message
+        route, fast_parse_failed = (None, None) if fallback == 'resolve' else ('selenium', True)
+
+
+# --- Асинхронный движок (PARSER_ENGINE=asyncio) ---
+def _detect_html_encoding(content):
+    """Кодировка страницы без charset в Content-Type (аналог requests apparent_encoding)."""
+    try:
+        import charset_normalizer
+        best = charset_normalizer.from_bytes(content).best()
+        return best.encoding if best and best.encoding else 'utf-8'
+    except Exception:
+        return 'utf-8'
+
+
+if _httpx_available:
+    class HostLimitedTransport(httpx.AsyncHTTPTransport):
+        """Транспорт httpx с ограничениями HostLimiter: каждый запрос (и каждый редирект) ждет слот хоста, 429/503 повторяются."""
+        def __init__(self, limiter, **kwargs):
+            super().__init__(**kwargs); self.limiter = limiter
+
+        async def handle_async_request(self, request):
+            host = request.url.host
+            for attempt in range(HTTP_MAX_RETRIES + 1):
+                await self.limiter.acquire_async(host); response = None
+                try:
+                    response = await super().handle_async_request(request)
+                finally:
+                    self.limiter.release(host, response.status_code if response is not None else None,
+                                         response.headers.get('Retry-After') if response is not None else None)
+                if response.status_code not in HTTP_RETRY_STATUSES or attempt == HTTP_MAX_RETRIES: return response
+                await response.aclose()
+
+
+async def _rotate_user_agent(request):
+    """httpx event hook: случайный User-Agent из USER_AGENTS для каждого запроса."""
+    request.headers['User-Agent'] = random.choice(USER_AGENTS)
+
+
+def _find_image_url_in_response(response, status_callback=None, strategies=None):
+    """Декодирует страницу (httpx.Response) и ищет (URL изображения, стратегия). Выполняется в пуле потоков, не в event loop."""
+    html_content = response.text; base_url = str(response.url)
+    domain = get_domain(base_url)
+    return resolve_image_url_from_html(html_content, domain, base_url, status_callback, strategies)
+
+
+async def download_image_async(client, image_url, save_path_base, status_callback=None, cpu_executor=None, target_size=None, row_info=None):
+    """
+    Асинхронный аналог download_image на httpx.AsyncClient.
+    Скачивание идет в event loop, конвертация — в CONVERSION_EXECUTOR, переименование — в cpu_executor.
+    """
+    temp_save_path = None; started = time.perf_counter() # Путь к временному файлу, начало скачивания
+    loop = asyncio.get_running_loop()
+    try:
+        stored_result, entry = await _run_in_executor(loop, cpu_executor, _reuse_stored_image, image_url, save_path_base, status_callback, target_size, row_info)
+        if stored_result: return stored_result
+        async with client.stream('GET', image_url, timeout=20, headers=IMAGE_STORE.conditional_headers(entry) if entry else None) as response:
+            if entry and response.status_code == 304:
+                return await _run_in_executor(loop, cpu_executor, _stored_image_not_modified, image_url, entry, save_path_base, status_callback, target_size, row_info)
+            response.raise_for_status()
+            headers = response.headers
+            if response.headers.get('content-length') == '0':
+                return False, f"Ошибка скачивания: Файл пустой для URL: {image_url}"
+
+            content_type = response.headers.get('content-type', '').lower()
+            initial_extension = _detect_image_extension(content_type, image_url, status_callback)
+            needs_conversion, final_save_path, temp_save_path = _prepare_image_paths(save_path_base, initial_extension, status_callback)
+
+            # --- Формат требует конвертации: скачиваем в память ---
+            if needs_conversion:
+                try:
+                    buffer = io.BytesIO()
+                    async for chunk in response.aiter_bytes(chunk_size=8192):
+                        if chunk: buffer.write(chunk)
+                    if buffer.tell() == 0:
+                         raise ValueError("Скачанный файл пустой")
+                    log_event(status_callback, logging.DEBUG, 'DOWNLOAD', "DOWNLOAD: Изображение получено в память (%d байт)", buffer.tell(), duration=time.perf_counter() - started)
+                except Exception as read_err:
+                     return False, f"Ошибка получения данных изображения {image_url}: {read_err}"
+                source_hash = hashlib.sha256(buffer.getbuffer()).hexdigest()
+
+            # --- Скачивание во временный файл ---
             else:
+                downloaded_size = 0; digest = hashlib.sha256()
                 try:
-                    from webdriver_manager.chrome import ChromeDriverManager
-                    service = Service(ChromeDriverManager().install()); driver = webdriver.Chrome(service=service, options=options)
-                except ImportError: driver = webdriver.Chrome(options=options) # Полагаемся на PATH
-                except Exception as driver_init_err: return False, f"Ошибка инициализации ChromeDriver: {driver_init_err}."
-
-            driver.set_page_load_timeout(60)
-            driver.execute_cdp_cmd('Page.addScriptToEvaluateOnNewDocument', {'source': "Object.defineProperty(navigator, 'webdriver', {get: () => undefined})"})
-            # Навигация с повторной попыткой при таймауте
-            _nav_attempts = 2
-            for _attempt in range(_nav_attempts):
+                    with open(temp_save_path, 'wb') as f:
+                        async for chunk in response.aiter_bytes(chunk_size=8192):
+                            if chunk: f.write(chunk); digest.update(chunk); downloaded_size += len(chunk)
+                    if downloaded_size == 0:
+                         raise ValueError("Скачанный файл пустой")
+                    log_event(status_callback, logging.DEBUG, 'DOWNLOAD', "DOWNLOAD: Временный файл сохранен: %s (%d байт)", temp_save_path, downloaded_size, duration=time.perf_counter() - started)
+                except Exception as write_err:
+                     if os.path.exists(temp_save_path): os.remove(temp_save_path)
+                     return False, f"Ошибка записи временного файла {temp_save_path}: {write_err}"
+                source_hash = digest.hexdigest()
+
+        stored_result = await _run_in_executor(loop, cpu_executor, _reuse_stored_source, image_url, source_hash, headers,
+                                                     None if needs_conversion else temp_save_path, save_path_base, status_callback, target_size, row_info)
+        if stored_result: return stored_result
+        if needs_conversion:
+            result = await _run_in_executor(loop, CONVERSION_EXECUTOR, convert_image_data, buffer.getvalue(), temp_save_path, final_save_path, status_callback, target_size)
+        elif target_size:
+            result = await _run_in_executor(loop, CONVERSION_EXECUTOR, _save_and_resize, temp_save_path, final_save_path, status_callback, target_size)
+        else:
+            result = await _run_in_executor(loop, cpu_executor, _finalize_image_file, temp_save_path, final_save_path, False, status_callback)
+        result, sha256 = await _run_in_executor(loop, cpu_executor, _store_saved_image, result, image_url, final_save_path, source_hash, headers, target_size, status_callback)
+        return _record_saved_file(result, final_save_path, row_info, sha256 or (None if needs_conversion or target_size else source_hash))
+
+    except httpx.TimeoutException:
+        if temp_save_path and os.path.exists(temp_save_path): os.remove(temp_save_path)
+        return False, f"Ошибка скачивания: Превышен таймаут для {image_url}"
+    except httpx.HTTPError as e:
+        if temp_save_path and os.path.exists(temp_save_path): os.remove(temp_save_path)
+        return False, f"Ошибка скачивания изображения {image_url}: {e}"
+    except OSError as e:
+        if temp_save_path and os.path.exists(temp_save_path): os.remove(temp_save_path)
+        return False, f"Ошибка файловой системы при сохранении {save_path_base}: {e}"
+    except Exception as e:
+        if temp_save_path and os.path.exists(temp_save_path): os.remove(temp_save_path)
+        import traceback; return False, f"Непредвиденная ошибка при скачивании/обработке {image_url}: {e}\n{traceback.format_exc()}"
+
+
+async def process_single_row_async(row_data, download_dir, headless, status_callback, client, fetch_slots, cpu_executor, selenium_executor, http_session, resize=False, row_info=None, route=None):
+    """
+    Асинхронный аналог process_single_row: быстрый путь (страница + изображение) идет через httpx,
+    разбор HTML — в cpu_executor, строки для Selenium — в отдельной полосе selenium_executor.
+    """
+    if not row_data or len(row_data) < 2: return False, "Пропущено: Некорректные данные строки"
+    product_url, safe_filename, error_message = _prepare_row(row_data, status_callback)
+    if error_message: return False, error_message
+    target_size = get_target_size(row_data) if resize else None
+    save_path_base = os.path.join(download_dir, safe_filename)
+    domain_for_check = get_domain(product_url)
+
+    cached = _resolve_from_cache(product_url, save_path_base, domain_for_check, status_callback)
+    if cached:
+        success, message, fallback = await _download_resolution_async(client, cached, status_callback, cpu_executor, target_size, row_info)
+        if fallback is None: return success, message
+
+    if row_info is None: row_info = {}
+    loop = asyncio.get_running_loop()
+    fast_parse_failed = False
+
+    if (route or choose_route(domain_for_check, status_callback)) == 'selenium':
+        fast_parse_failed = True
+    else:
+        fast_started = time.perf_counter(); fast_recorded = False
+        try:
+            async with fetch_slots: # Ограничение числа строк в работе на быстром пути
+                image_url = None
                 try:
-                    driver.get(product_url)
-                    break
-                except TimeoutException:
-                    if _attempt + 1 == _nav_attempts:
-                        raise
-            WebDriverWait(driver, 20).until(EC.presence_of_element_located((By.TAG_NAME, "body"))); time.sleep(random.uniform(1, 3))
-            base_url = driver.current_url; domain = get_domain(base_url)
-
-            image_url = find_image_url_from_selenium_element(driver, domain, status_callback) # Передаем callback
-            if image_url is None: # Fallback на парсинг source после Selenium
-                 _log_status(f"SELENIUM: Не удалось найти URL через элементы Selenium для {product_url}. Попытка парсинга page_source...", status_callback)
-                 html_content = driver.page_source
-                 image_url = find_image_url_from_schema(html_content, base_url)
-                 if image_url is None: image_url = find_image_url_from_og_image(html_content, base_url)
-                 if image_url is None: image_url = find_image_url_from_css_selectors(html_content, domain, base_url, status_callback) # Передаем callback
-
-            if image_url:
-                _log_status(f"PROCESS_ROW: Выбран URL для скачивания (Selenium/page_source): {image_url}", status_callback)
-                # Улучшаем URL перед скачиванием
-                image_url = improve_image_url(image_url, status_callback)
-                _log_status(f"PROCESS_ROW: Улучшенный URL для скачивания: {image_url}", status_callback)
-                save_path_base = os.path.join(download_dir, safe_filename)
-                selenium_session = requests.Session(); selenium_session.headers.update(BASE_HEADERS); selenium_session.headers['User-Agent'] = random.choice(USER_AGENTS)
-                # Передаем status_callback в download_image
-                download_success, message = download_image(selenium_session, image_url, save_path_base, status_callback)
-                if download_success: return True, f"Selenium парсинг успешен: {product_url} -> {message}"
-                else: return False, f"Selenium парсинг (найден URL, но ошибка скачивания): {product_url} -> {message}"
-            else: return False, f"Не удалось найти URL главного изображения для {product_url} после всех попыток (включая Selenium)."
-        except TimeoutException: return False, f"Ошибка загрузки страницы Selenium (таймаут) для {product_url}"
-        except WebDriverException as e: err_msg = str(e); return False, f"Ошибка WebDriver при обработке {product_url}: {err_msg[:200]}"
-        except requests.exceptions.RequestException as e: return False, f"Ошибка запроса при скачивании после Selenium для {product_url}: {e}"
-        except Exception as e: import traceback; return False, f"Непредвиденная ошибка при обработке {product_url} (Selenium): {e}\n{traceback.format_exc()}"
+                    response = await client.get(product_url, timeout=15)
+                    response.raise_for_status()
+                    image_url, strategy = await _run_in_executor(loop, cpu_executor, _find_image_url_in_response, response, status_callback, _html_strategy_order(domain_for_check))
+                except httpx.HTTPError as page_err:
+                    if not product_api_url(product_url): raise
+                    _log_status(f"PROCESS_ROW: Страница недоступна ({page_err}), пробуем product API", status_callback)
+                if image_url is None:
+                    image_url = await _find_image_url_via_product_api_async(client, product_url, status_callback); strategy = 'product_api'
+
+                if image_url:
+                    _log_status(f"PROCESS_ROW: Выбран URL для скачивания (быстрый парсинг): {image_url}", status_callback)
+                    image_url = improve_image_url(image_url, status_callback)
+                    _log_debug(status_callback, "PROCESS_ROW: Улучшенный URL для скачивания: %s", image_url)
+                    resolution = RowResolution(product_url, save_path_base, domain_for_check, image_url, strategy, 'fast', None, False, fast_started)
+                    success, message, fallback = await _download_resolution_async(client, resolution, status_callback, cpu_executor, target_size, row_info)
+                    if fallback is None: return success, message
+                    fast_parse_failed = True; fast_recorded = True # Переходим к Selenium (исход быстрого пути учтен в _finish_download)
+        except httpx.HTTPError:
+            fast_parse_failed = True
+        except Exception as e:
+            _log_status(f"PROCESS_ROW: Ошибка при быстром парсинге {product_url}: {e}", status_callback)
+            fast_parse_failed = True
+        if not fast_recorded: _record_route(domain_for_check, 'fast', False, fast_started)
+        row_info.clear()
+
+    # --- Отдельная полоса для Selenium (не занимает слоты быстрого пути): браузер только ищет URL ---
+    resolution = await _run_in_executor(loop, selenium_executor, resolve_row, row_data, download_dir, headless, status_callback, http_session, 'selenium', fast_parse_failed)
+    if resolution.image_url is None: return False, resolution.message
+    # Скачивание — снова в event loop, браузер уже вернулся в пул
+    return (await _download_resolution_async(client, resolution, status_callback, cpu_executor, target_size, row_info))[:2]
+
+
+async def _download_resolution_async(client, resolution, status_callback=None, cpu_executor=None, target_size=None, row_info=None):
+    """Асинхронный аналог download_row: скачивание через httpx, итог — _finish_download (success, message, fallback)."""
+    if row_info is not None: row_info.update(method=resolution.method, image_url=resolution.image_url, strategy=resolution.strategy)
+    download_success, message = await download_image_async(client, resolution.image_url, resolution.save_path_base, status_callback, cpu_executor, target_size, row_info)
+    return _finish_download(resolution, download_success, message, status_callback, row_info)
+
+
+def _handle_row_result(row_data, result, row_info, status_callback=None, row_callback=None, row_id=None):
+    """
+    Логирует результат строки и передает его в row_callback(row_data, success, message, row_info).
+    result — кортеж (success, message) или исключение из потока. Возвращает success.
+    """
+    if isinstance(result, Exception):
+        success = False
+        message = f"Поток для URL '{row_data[0] if row_data else '???'}' вызвал исключение: {result}"
+    else:
+        success, message = result
+    if not success:
+        log_event(status_callback, logging.WARNING, 'ROW', message, duration=row_info.get('duration'), row_id=row_id)
+    elif "успешно сохранено" in message:
+        log_event(status_callback, logging.INFO, 'ROW', message, duration=row_info.get('duration'), row_id=row_id)
+    if row_callback:
+        if row_id is not None: row_info['row_id'] = row_id
+        flush = getattr(status_callback, 'flush', None)
+        if flush: flush() # События строки доставляются колбеку логов раньше, чем ее результат
+        try:
+            row_callback(row_data, success, message, row_info)
+        except Exception as cb_err:
+            _log_warning(f"Ошибка в обработчике результата строки: {cb_err}", status_callback)
+    return success
+
+
+ScheduledRow = namedtuple('ScheduledRow', 'lane host row_id row route')
+
+
+class RowScheduler:
+    """
+    Планировщик строк запуска: очереди по хостам в двух полосах — 'http' (быстрый путь) и 'browser'
+    (маршрут сразу в Selenium). Свободное место полосы занимает строка следующего по кругу хоста,
+    у которого есть свободный слот (HostLimiter.limits) и нет паузы, поэтому подряд идущие в CSV строки
+    одного домена не занимают все потоки, а строки для браузера не держат очередь быстрых.
+    rows — итератор пар (номер строки CSV, строка); в очередях не больше lookahead прочитанных строк.
+    """
+    def __init__(self, rows, lane_limits, limiter=None, lookahead=0, status_callback=None):
+        self._rows = iter(rows); self._exhausted = False
+        self.lane_limits = lane_limits; self.limiter = limiter; self.status_callback = status_callback
+        self.lookahead = max(lookahead, sum(lane_limits.values()))
+        self._queues = {lane: OrderedDict() for lane in lane_limits} # полоса -> {хост: deque(строк)}
+        self._buffered = 0
+        self._lane_busy = dict.fromkeys(lane_limits, 0); self._host_busy = {}
+
+    @property
+    def pending(self):
+        """Есть ли строки, которые еще не запущены (в очередях или не прочитаны)."""
+        return self._buffered > 0 or not self._exhausted
+
+    def _lane_of(self, row_id, row):
+        """(полоса, маршрут): в 'browser' — строки, которые choose_route сразу отправляет в Selenium (кроме найденных в кэше)."""
+        product_url = row[0].strip()
+        token = _CURRENT_ROW.set(row_id) # Логи выбора маршрута относятся к строке
+        try:
+            route = choose_route(get_domain(product_url), self.status_callback)
+            if route == 'selenium' and RESOLUTION_CACHE and RESOLUTION_CACHE.get(product_url): return 'http', None
+        finally:
+            _CURRENT_ROW.reset(token)
+        return ('browser' if route == 'selenium' and _selenium_available and 'browser' in self.lane_limits else 'http'), route
+
+    def _enqueue(self, row_id, row, lane, route, front=False):
+        host = urlparse(row[0].strip()).hostname or ''
+        queue = self._queues[lane].setdefault(host, deque()); item = ScheduledRow(lane, host, row_id, row, route)
+        queue.appendleft(item) if front else queue.append(item)
+        self._buffered += 1
+
+    def _fill(self):
+        while not self._exhausted and self._buffered < self.lookahead:
+            item = next(self._rows, None)
+            if item is None: self._exhausted = True; break
+            row_id, row = item
+            self._enqueue(row_id, row, *self._lane_of(row_id, row))
+
+    def push(self, row_id, row, route=None):
+        """
+        Возвращает строку в начало очереди ее хоста для следующей попытки поиска: route='selenium' —
+        в полосу браузера, None — маршрут выбирается заново.
+        """
+        if route is None: lane, route = self._lane_of(row_id, row)
+        else: lane = 'browser' if route == 'selenium' and _selenium_available and 'browser' in self.lane_limits else 'http'
+        self._enqueue(row_id, row, lane, route, front=True)
+
+    def _host_ready(self, host):
+        if self.limiter is None: return True
+        concurrency = self.limiter.limits(host)[1]
+        if concurrency and self._host_busy.get(host, 0) >= concurrency: return False
+        return not self.limiter.paused(host)
+
+    def _dispatch(self):
+        ready = []
+        for lane, queues in self._queues.items():
+            while self._lane_busy[lane] < self.lane_limits[lane]:
+                host = next((host for host in queues if self._host_ready(host)), None)
+                if host is None: break
+                queue = queues.pop(host); item = queue.popleft()
+                if queue: queues[host] = queue # Хост уходит в конец круга: следующей будет строка другого хоста
+                self._buffered -= 1; self._lane_busy[lane] += 1; self._host_busy[host] = self._host_busy.get(host, 0) + 1
+                ready.append(item)
+        return ready
+
+    def next_rows(self):
+        """Строки (ScheduledRow), которые можно запустить сейчас; после завершения каждой — done(item)."""
+        ready = []
+        while True:
+            self._fill(); batch = self._dispatch()
+            if not batch: return ready
+            ready += batch
+
+    def done(self, item):
+        self._lane_busy[item.lane] -= 1; self._host_busy[item.host] -= 1
+
+
+async def _run_rows_asyncio(data_rows, total_rows, download_dir, headless, status_callback, progress_callback, max_workers, http_session, resize=False, row_callback=None):
+    """
+    Обрабатывает строки в asyncio-движке. data_rows — итератор пар (номер строки CSV, строка), строки
+    раздает RowScheduler; total_rows — оценка для прогресса. Возвращает (completed_tasks, success_count, error_count).
+    """
+    completed_tasks = 0; success_count = 0; error_count = 0
+    lane_limits = {'browser': SELENIUM_POOL.size, 'http': ROW_WINDOW or ASYNC_MAX_CONNECTIONS * 2}
+    scheduler = RowScheduler(data_rows, lane_limits, http_session.limiter, ROW_LOOKAHEAD or 4 * sum(lane_limits.values()), status_callback)
+    fetch_slots = asyncio.Semaphore(ASYNC_MAX_CONNECTIONS)
+    limits = httpx.Limits(max_connections=ASYNC_MAX_CONNECTIONS, max_keepalive_connections=ASYNC_MAX_CONNECTIONS)
+    timeout = httpx.Timeout(20, pool=None) # Ожидание свободного соединения не ограничиваем — его ограничивает fetch_slots
+
+    async def run_row(item):
+        row_info = {}; started = time.perf_counter()
+        _CURRENT_ROW.set(item.row_id) # Контекст у каждой задачи свой
+        try:
+            return item, row_info, await process_single_row_async(
+                item.row, download_dir, headless, status_callback, client, fetch_slots, cpu_executor, selenium_executor, http_session, resize, row_info, item.route,
+            )
+        except Exception as exc:
+            return item, row_info, exc
         finally:
-            if driver:
+            row_info['duration'] = time.perf_counter() - started
+
+    with ThreadPoolExecutor(max_workers=max_workers) as cpu_executor, \
+         ThreadPoolExecutor(max_workers=SELENIUM_POOL.size) as selenium_executor:
+        transport = HostLimitedTransport(http_session.limiter, limits=limits) if http_session.limiter else None
+        async with httpx.AsyncClient(headers=BASE_HEADERS, follow_redirects=True, limits=limits, timeout=timeout, transport=transport,
+                                     default_encoding=_detect_html_encoding,
+                                     event_hooks={'request': [_rotate_user_agent]}) as client:
+            in_flight = set()
+            while True:
+                # Новые строки читаются только по мере освобождения мест в полосах
+                in_flight.update(asyncio.ensure_future(run_row(item)) for item in scheduler.next_rows())
+                if not in_flight:
+                    if not scheduler.pending: break
+                    await asyncio.sleep(SCHEDULER_POLL_INTERVAL); continue # Все хосты с очередью на паузе
+                done, in_flight = await asyncio.wait(in_flight, timeout=SCHEDULER_POLL_INTERVAL, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    item, row_info, result = task.result(); completed_tasks += 1; scheduler.done(item)
+                    if _handle_row_result(item.row, result, row_info, status_callback, row_callback, item.row_id): success_count += 1
+                    else: error_count += 1
+                    if progress_callback:
+                        progress_callback(completed_tasks, max(total_rows, completed_tasks))
+    return completed_tasks, success_count, error_count
+
+
+def _run_rows_threaded(data_rows, total_rows, download_dir, headless, status_callback, progress_callback, max_workers, http_session, resize=False, row_callback=None):
+    """
+    Обрабатывает строки конвейером из двух стадий. Поиск URL (resolve_row) идет в пулах полос RowScheduler:
+    max_workers потоков для быстрого пути и SELENIUM_POOL.size для браузера; скачивание (download_row) —
+    в своем пуле из DOWNLOAD_WORKERS потоков. Слот полосы (и браузер) освобождается, как только URL найден.
+    Очередь между стадиями ограничена DOWNLOAD_QUEUE_SIZE: пока она полна, новые строки не запускаются.
+    data_rows — итератор пар (номер строки CSV, строка), total_rows — оценка для прогресса.
+    Возвращает (completed_tasks, success_count, error_count).
+    """
+    completed_tasks = 0; success_count = 0; error_count = 0
+    lane_limits = {'browser': SELENIUM_POOL.size, 'http': ROW_WINDOW or max_workers}
+    scheduler = RowScheduler(data_rows, lane_limits, http_session.limiter, ROW_LOOKAHEAD or 4 * sum(lane_limits.values()), status_callback)
+    download_workers = DOWNLOAD_WORKERS or max_workers
+    download_limit = download_workers + (DOWNLOAD_QUEUE_SIZE or 2 * download_workers)
+    states = {} # номер строки -> {'row_info', 'started', 'fast_parse_failed'}, пока строка не завершена
+    with ThreadPoolExecutor(max_workers=max_workers) as executor, \
+         ThreadPoolExecutor(max_workers=SELENIUM_POOL.size) as browser_executor, \
+         ThreadPoolExecutor(max_workers=download_workers, thread_name_prefix='download') as download_executor:
+        futures = {}; downloads = 0
+        while True:
+            if downloads < download_limit: # Обратное давление: поиск не обгоняет скачивание больше, чем на очередь
+                for item in scheduler.next_rows():
+                    state = states.setdefault(item.row_id, {'row_info': {}, 'started': time.perf_counter(), 'fast_parse_failed': None})
+                    pool = browser_executor if item.lane == 'browser' else executor
+                    futures[pool.submit(_call_with_row, item.row_id, state['row_info'], resolve_row, item.row, download_dir, headless,
+                                        status_callback, http_session, item.route, state['fast_parse_failed'])] = ('resolve', item)
+            if not futures:
+                if not scheduler.pending: break
+                time.sleep(SCHEDULER_POLL_INTERVAL); continue # Все хосты с очередью на паузе
+            done, _ = wait(futures, timeout=SCHEDULER_POLL_INTERVAL, return_when=FIRST_COMPLETED)
+            for future in done:
+                stage, item = futures.pop(future); state = states[item.row_id]
                 try:
-                    driver.quit()
-                except Exception:
-                    pass
-            try:
-                SELENIUM_SEMAPHORE.release()
-            except Exception:
-                pass
-            if selenium_session: selenium_session.close()
+                    result = future.result()
+                except Exception as exc:
+                    result = exc
+                if stage == 'resolve':
+                    scheduler.done(item) # Слот полосы свободен, как только известен URL
+                    if not isinstance(result, Exception) and result.image_url:
+                        futures[download_executor.submit(_call_with_row, item.row_id, state['row_info'], download_row, item.row, result,
+                                                         status_callback, http_session, resize, state['row_info'])] = ('download', item)
+                        downloads += 1; continue
+                    if not isinstance(result, Exception) and result.message is None: # Быстрый путь не нашел URL — в полосу браузера
+                        state['fast_parse_failed'] = result.fast_parse_failed; scheduler.push(item.row_id, item.row, 'selenium'); continue
+                    if not isinstance(result, Exception): result = (False, result.message)
+                else:
+                    downloads -= 1
+                    if not isinstance(result, Exception):
+                        success, message, fallback = result
+                        if fallback == 'resolve': # URL из кэша устарел — обычный поиск
+                            scheduler.push(item.row_id, item.row); continue
+                        if fallback == 'selenium': # Быстрый путь нашел URL, но скачать не удалось
+                            state['fast_parse_failed'] = True; scheduler.push(item.row_id, item.row, 'selenium'); continue
+                        result = (success, message)
+                del states[item.row_id]; completed_tasks += 1
+                row_info = state['row_info']; row_info['duration'] = time.perf_counter() - state['started'] # Вся строка, а не последняя стадия
+                if _handle_row_result(item.row, result, row_info, status_callback, row_callback, item.row_id): success_count += 1
+                else: error_count += 1
+                if progress_callback:
+                    progress_callback(completed_tasks, max(total_rows, completed_tasks))
+    return completed_tasks, success_count, error_count
+
+
+def count_csv_rows(csv_path):
+    """Быстрая оценка числа строк для прогресса: непустые строки файла (без разбора CSV)."""
+    with open(csv_path, 'rb') as csvfile:
+        return sum(1 for line in csvfile if line.strip())
+
+
+def iter_csv_rows(csv_path, status_callback=None, file_encoding='utf-8-sig', with_line_numbers=False):
+    """
+    Лениво читает и проверяет CSV: отдает валидные строки (URL, имя файла[, размер]) по одной,
+    о пропущенных пишет в лог. Ошибка чтения посреди файла логируется и завершает чтение.
+    with_line_numbers=True — отдает пары (номер строки CSV, строка).
+    """
+    try:
+        with open(csv_path, 'r', encoding=file_encoding, errors='replace', newline='') as csvfile: # Используем utf-8-sig
+            # --- ИСПОЛЬЗУЕМ СТАНДАРТНЫЙ ДИАЛЕКТ (запятая, двойные кавычки) ---
+            reader = csv.reader(csvfile)
+            _log_status("Используется стандартный диалект CSV (разделитель - запятая, кавычки - двойные).", status_callback)
+            # --- Конец принудительного диалекта ---
 
-    if image_url is None and not fast_parse_failed: return False, f"Не удалось найти URL главного изображения для {product_url} (быстрый парсинг)."
-    return False, f"Неизвестный результат обработки для {product_url}."
+            # --- Цикл чтения и валидации строк с детальным логированием ---
+            line_number = 1 # Начинаем нумерацию с 1, т.к. заголовка нет
+            for row in reader:
+                 # --- Отладочный вывод КАЖДОЙ строки, которую вернул reader ---
+                 _log_debug(status_callback, "DEBUG [Строка %d]: Прочитано: %s", line_number, row)
+                 # --- Конец отладочного вывода ---
+
+                 if row and len(row) >= 2:
+                      first_col = row[0].strip() if row[0] else ""
+                      second_col = row[1].strip() if row[1] else ""
+                      is_valid_url = first_col and (first_col.lower().startswith('http://') or first_col.lower().startswith('https://'))
+                      is_valid_filename = bool(second_col)
+
+                      if is_valid_url and is_valid_filename:
+                           _log_debug(status_callback, "RUN_PARSER [Строка %d ВАЛИДНА]: URL='%s', Filename='%s'", line_number, row[0], row[1])
+                           yield (line_number, row[:3]) if with_line_numbers else row[:3] # 3-я колонка (необязательно) — целевой размер, например 296x296
+                      else:
+                           reason = []
+                           if not row: reason.append("Строка пустая (после reader)")
+                           elif len(row) < 2: reason.append(f"Меньше 2 столбцов ({len(row)})")
+                           else:
+                               if not first_col: reason.append("URL пустой")
+                               elif not is_valid_url: reason.append("URL не начинается с http/https")
+                               if not second_col: reason.append("Имя файла пустое")
+                           log_row_data = str(row)[:150] + ('...' if len(str(row)) > 150 else '')
+                           _log_status(f"[Строка {line_number} ПРОПУЩЕНА] Причина: {', '.join(reason)}. Данные: {log_row_data}", status_callback)
+                 elif row: # Если строка есть, но в ней меньше 2 элементов
+                      log_row_data = str(row)[:150] + ('...' if len(str(row)) > 150 else '')
+                      _log_status(f"[Строка {line_number} ПРОПУЩЕНА] Причина: Меньше 2 столбцов ({len(row)}). Данные: {log_row_data}", status_callback)
+                 line_number += 1
+            # --- Конец цикла чтения и валидации ---
+    except Exception as e:
+        _log_warning(f"Критическая ошибка при чтении CSV: {e}", status_callback)
+
+
+class RunManifest:
+    """
+    Манифест папки загрузки (MANIFEST_FILENAME): по JSON-строке на каждую завершенную строку CSV.
+    Строка дописывается одним write() в файл с O_APPEND, поэтому после падения в файле остаются только
+    целые записи (оборванная последняя строка при чтении пропускается).
+    """
+    def __init__(self, download_dir):
+        self.path = os.path.join(download_dir, MANIFEST_FILENAME)
+        self.download_dir = download_dir
+        self._fd = None
+        self._lock = threading.Lock()
+        self.skipped = 0 # Строк, пропущенных skip_finished
+
+    @staticmethod
+    def row_key(row_data):
+        """Ключ строки CSV: URL, имя файла и размер (если указан)."""
+        return "\t".join(cell.strip() for cell in row_data[:3])
+
+    def _read_records(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        yield json.loads(line)
+                    except ValueError:
+                        continue # Запись, оборванная при падении
+        except FileNotFoundError:
+            return
+
+    def finished(self):
+        """{ключ строки: число сохраненных файлов} по успешным записям, чьи файлы еще на диске."""
+        files = {}
+        for record in self._read_records():
+            if record.get('status') == 'ok' and record.get('file') and os.path.exists(os.path.join(self.download_dir, record['file'])):
+                files.setdefault(record.get('key'), set()).add(record['file'])
+        return {key: len(names) for key, names in files.items()}
+
+    def skip_finished(self, data_rows, finished, status_callback=None):
+        """
+        Отдает пары (номер, строка) из data_rows, кроме уже сохраненных. Повтор одной и той же строки в CSV пропускается
+        столько раз, сколько для нее есть файлов. Число пропущенных строк — в self.skipped.
+        """
+        seen = {}
+        for row_id, row in data_rows:
+            key = self.row_key(row)
+            if seen.get(key, 0) < finished.get(key, 0):
+                seen[key] = seen.get(key, 0) + 1; self.skipped += 1
+                _log_debug(status_callback, "RESUME: Строка %d уже сохранена, пропуск: %s", row_id, row[0])
+                continue
+            yield row_id, row
+
+    def record(self, row_data, success, message, row_info, status_callback=None):
+        """Дописывает запись о завершенной строке (вызывается до row_callback, пока файл на месте)."""
+        path = row_info.get('path') if success else None
+        # row — номер строки CSV: строки завершаются не в порядке файла, сортировка по нему восстанавливает порядок
+        entry = {'ts': round(time.time(), 3), 'row': row_info.get('row_id'), 'key': self.row_key(row_data), 'status': 'ok' if success else 'failed',
+                 'url': row_data[0].strip(), 'image_url': row_info.get('image_url'), 'file': None, 'bytes': None, 'sha256': None}
+        try:
+            if path and os.path.exists(path):
+                # Хэш посчитан при скачивании (или взят из IMAGE_STORE) — файл здесь не перечитывается
+                entry.update(file=os.path.relpath(path, self.download_dir), bytes=os.path.getsize(path), sha256=row_info.get('sha256'))
+            elif success:
+                entry['status'] = 'failed' # Успех без файла на диске повторяется при --resume
+            if not success: entry['error'] = message[:300]
+            line = (json.dumps(entry, ensure_ascii=False) + "\n").encode('utf-8')
+            with self._lock:
+                if self._fd is None:
+                    self._fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+                    # Дописываем с новой строки, если прошлый запуск оборвался посреди записи
+                    if os.fstat(self._fd).st_size and not self._ends_with_newline(): os.write(self._fd, b"\n")
+                os.write(self._fd, line)
+        except Exception as e:
+            _log_warning(f"RESUME: Не удалось записать манифест {self.path}: {e}", status_callback)
+
+    def _ends_with_newline(self):
+        with open(self.path, 'rb') as f:
+            f.seek(-1, os.SEEK_END)
+            return f.read(1) == b"\n"
+
+    def close(self):
+        with self._lock:
+            if self._fd is not None: os.close(self._fd); self._fd = None
 
 
 # --- Обновленная функция run_parser с детальным логированием пропущенных строк и принудительным стандартным диалектом ---
-def run_parser(csv_path, download_dir, status_callback, progress_callback, headless=True, max_workers=MAX_WORKERS):
+def run_parser(csv_path, download_dir, status_callback, progress_callback, headless=True, max_workers=MAX_WORKERS, engine=None, resize=None, row_callback=None, resume=False):
     """
     Запускает процесс парсинга изображений из CSV с использованием гибридного подхода (requests + Selenium).
     (Полная функция с исправленными отступами, детальным логированием и принудительным диалектом)
+    engine — 'threads' или 'asyncio' (по умолчанию PARSER_ENGINE).
+    resize — вписывать изображения в размер из имени файла/3-й колонки (по умолчанию RESIZE_TO_TARGET).
+    row_callback(row_data, success, message, row_info) — вызывается по завершении каждой строки
+    из потока run_parser (row_info['path'] — путь сохраненного файла, row_info['sha256'] — его хэш, если известен,
+    row_info['duration'] — время строки,
+    row_info['row_id'] — номер строки, тот же, что в LogEvent.row_id ее событий).
+    Каждая завершенная строка дописывается в манифест папки загрузки (RunManifest); resume=True пропускает
+    строки, файлы которых по манифесту уже сохранены, и повторяет только неудачные и необработанные.
+    Логи уходят в status_callback пачками через EventLog: status_callback.log_batch(events), если он есть,
+    иначе status_callback(message) на каждое событие не ниже LOG_LEVEL.
     """
+    if getattr(status_callback, 'emit', None) is not None: # Уже EventLog
+        return _run_parser(csv_path, download_dir, status_callback, progress_callback, headless, max_workers, engine, resize, row_callback, resume)
+    with EventLog(status_callback) as event_log:
+        return _run_parser(csv_path, download_dir, event_log, progress_callback, headless, max_workers, engine, resize, row_callback, resume)
+
+
+def _run_parser(csv_path, download_dir, status_callback, progress_callback, headless, max_workers, engine, resize, row_callback, resume=False):
+    """Тело run_parser: status_callback здесь — EventLog."""
     processed_count = 0; success_count = 0; error_count = 0
-    data_rows = []; total_rows = 0
+    total_rows = 0
 
     # --- Предварительная проверка CSV файла и чтение данных ---
     try:
@@ -969,56 +2932,9 @@ def run_parser(csv_path, download_dir, status_callback, progress_callback, headl
         # except Exception as e: _log_status(f"Ошибка определения кодировки: {e}. Используется UTF-8.", status_callback); file_encoding = 'utf-8'
         # --- Конец блока определения кодировки ---
 
-        # --- Блок чтения CSV файла ---
-        with open(csv_path, 'r', encoding=file_encoding, errors='replace', newline='') as csvfile: # Используем utf-8-sig
-            # --- ИСПОЛЬЗУЕМ СТАНДАРТНЫЙ ДИАЛЕКТ (запятая, двойные кавычки) ---
-            reader = csv.reader(csvfile)
-            _log_status("Используется стандартный диалект CSV (разделитель - запятая, кавычки - двойные).", status_callback)
-            # --- Конец принудительного диалекта ---
-
-            # --- УДАЛЕНО: Пропуск заголовка, т.к. его нет в файлах ---
-            # header = next(reader, None)
-            # if header:
-            #      try: _log_status(f"Пропущен заголовок: {header}", status_callback)
-            #      except Exception as log_e: _log_status(f"Не удалось отобразить заголовок: {log_e}", status_callback)
-            # --- Конец удаления ---
-
-            # --- Цикл чтения и валидации строк с детальным логированием ---
-            line_number = 1 # Начинаем нумерацию с 1, т.к. заголовок не пропускаем
-            for row in reader:
-                 # --- Отладочный вывод КАЖДОЙ строки, которую вернул reader ---
-                 _log_status(f"DEBUG [Строка {line_number}]: Прочитано: {row}", status_callback)
-                 # --- Конец отладочного вывода ---
-
-                 if row and len(row) >= 2:
-                      first_col = row[0].strip() if row[0] else ""
-                      second_col = row[1].strip() if row[1] else ""
-                      is_valid_url = first_col and (first_col.lower().startswith('http://') or first_col.lower().startswith('https://'))
-                      is_valid_filename = bool(second_col)
-
-                      if is_valid_url and is_valid_filename:
-                           _log_status(f"RUN_PARSER [Строка {line_number} ВАЛИДНА]: URL='{row[0]}', Filename='{row[1]}'", status_callback) # <-- ЛОГ
-                           data_rows.append(row[:2])
-                      else: # <-- Исправлен отступ здесь
-                           reason = []
-                           if not row: reason.append("Строка пустая (после reader)")
-                           elif len(row) < 2: reason.append(f"Меньше 2 столбцов ({len(row)})")
-                           else:
-                               if not first_col: reason.append("URL пустой")
-                               elif not is_valid_url: reason.append("URL не начинается с http/https")
-                               if not second_col: reason.append("Имя файла пустое")
-                           log_row_data = str(row)[:150] + ('...' if len(str(row)) > 150 else '')
-                           _log_status(f"[Строка {line_number} ПРОПУЩЕНА] Причина: {', '.join(reason)}. Данные: {log_row_data}", status_callback)
-                 elif row: # Если строка есть, но в ней меньше 2 элементов
-                      log_row_data = str(row)[:150] + ('...' if len(str(row)) > 150 else '')
-                      _log_status(f"[Строка {line_number} ПРОПУЩЕНА] Причина: Меньше 2 столбцов ({len(row)}). Данные: {log_row_data}", status_callback)
-                 # else: # Пустые строки можно не логировать
-                 #      _log_status(f"[Строка {line_number} ПРОПУЩЕНА] Причина: Пустая строка (после reader).", status_callback)
-                 line_number += 1
-            # --- Конец цикла чтения и валидации ---
-
-        total_rows = len(data_rows)
-        _log_status(f"Предварительный подсчет: найдено {total_rows} валидных строк для обработки.", status_callback)
+        # --- Оценка числа строк: CSV читается потоково (iter_csv_rows), в памяти только окно строк в работе ---
+        total_rows = count_csv_rows(csv_path)
+        _log_status(f"Предварительный подсчет: {total_rows} непустых строк в файле (валидность проверяется при чтении).", status_callback)
         # --- Конец блока чтения CSV файла ---
 
     # --- Обработка ошибок чтения файла ---
@@ -1028,44 +2944,82 @@ def run_parser(csv_path, download_dir, status_callback, progress_callback, headl
     # --- Конец обработки ошибок чтения файла ---
 
     if total_rows == 0: _log_status("В CSV файле не найдено валидных строк.", status_callback); progress_callback(0, 0); return 0, 0, 0
+    data_rows = iter_csv_rows(csv_path, status_callback, file_encoding, with_line_numbers=True)
 
     if not os.path.exists(download_dir):
         try: os.makedirs(download_dir); _log_status(f"Создана папка: {download_dir}", status_callback)
         except OSError as e: _log_status(f"Ошибка создания папки {download_dir}: {e}", status_callback); progress_callback(0, total_rows); return 0, 0, 0
 
-    _log_status(f"Начинается обработка {total_rows} строк ({max_workers} потоков)...", status_callback)
+    # --- Манифест: запись каждой завершенной строки, при resume — пропуск уже сохраненных ---
+    manifest = RunManifest(download_dir)
+    if resume:
+        finished = manifest.finished()
+        if finished:
+            done_files = sum(finished.values())
+            _log_status(f"RESUME: В манифесте {done_files} сохраненных строк, они будут пропущены.", status_callback)
+            total_rows = max(total_rows - done_files, 0)
+        data_rows = manifest.skip_finished(data_rows, finished, status_callback)
+    def manifest_row_callback(row_data, success, message, row_info):
+        manifest.record(row_data, success, message, row_info, status_callback)
+        if row_callback: row_callback(row_data, success, message, row_info)
+
+    _log_status(f"Начинается обработка до {total_rows} строк ({max_workers} потоков)...", status_callback)
     if _selenium_available: _log_status(f"Режим браузера (fallback): {'фоновый' if headless else 'с окном'}", status_callback)
     else: _log_status("Запасной метод (Selenium) недоступен.", status_callback)
     if progress_callback:
         progress_callback(0, total_rows)
 
-    with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        # Передаем status_callback в process_single_row
-        futures = {executor.submit(process_single_row, row, download_dir, headless, status_callback): row for row in data_rows}
-        completed_tasks = 0
-        for future in as_completed(futures):
-            row_data = futures[future]; completed_tasks += 1
-            try:
-                success, message = future.result()
-                if not success or "успешно сохранено" in message: _log_status(message, status_callback)
-                if success: success_count += 1
-                else: error_count += 1
-            except Exception as exc:
-                error_msg = f"Поток для URL '{row_data[0] if row_data else '???'}' вызвал исключение: {exc}"
-                _log_status(error_msg, status_callback); error_count += 1
-            if progress_callback:
-                progress_callback(completed_tasks, total_rows)
+    engine = (engine or PARSER_ENGINE).lower()
+    resize = RESIZE_TO_TARGET if resize is None else resize
+    if resize: _log_status("Изображения будут вписаны в размер из имени файла (например, 296х296).", status_callback)
+    if engine == 'asyncio' and not _httpx_available:
+        _log_status("Движок asyncio требует библиотеку httpx. Используется движок threads.", status_callback)
+        engine = 'threads'
+
+    # Одна HTTP-сессия (пул соединений) на весь запуск
+    # Ограничения по хостам общие для потоков, httpx и браузеров этого запуска
+    http_session = SharedHttpSession(pool_maxsize=max(HTTP_POOL_MAXSIZE, max_workers), limiter=HostLimiter(status_callback=status_callback))
+    with http_session:
+        try:
+            if engine == 'asyncio':
+                completed_tasks, success_count, error_count = asyncio.run(
+                    _run_rows_asyncio(data_rows, total_rows, download_dir, headless, status_callback, progress_callback, max_workers, http_session, resize, manifest_row_callback)
+                )
+            else:
+                completed_tasks, success_count, error_count = _run_rows_threaded(
+                    data_rows, total_rows, download_dir, headless, status_callback, progress_callback, max_workers, http_session, resize, manifest_row_callback
+                )
+        finally:
+            manifest.close()
+    if progress_callback and completed_tasks != total_rows:
+        progress_callback(completed_tasks, completed_tasks) # Оценка включала пропущенные строки — итог точный
+    if completed_tasks == 0 and not manifest.skipped: _log_status("В CSV файле не найдено валидных строк.", status_callback)
+
+    if DOMAIN_ROUTER: DOMAIN_ROUTER.save() # Статистика доменов для следующих запусков
 
     _log_status(f"\n--- Обработка завершена ---", status_callback)
     _log_status(f"Всего обработано строк: {completed_tasks}", status_callback)
+    if resume: _log_status(f"Пропущено уже сохраненных строк (resume): {manifest.skipped}", status_callback)
     _log_status(f"Успешно скачано изображений: {success_count}", status_callback)
     _log_status(f"Ошибок: {error_count}", status_callback)
     return completed_tasks, success_count, error_count
 
 
 # --- Консольный запуск ---
+def print_domain_stats(domain=None):
+    """Выводит накопленную статистику маршрутизации по доменам."""
+    rows = DOMAIN_ROUTER.stats(domain) if DOMAIN_ROUTER else []
+    if not rows: print("Статистика доменов пуста."); return
+    print(f"{'домен':<28} {'метод':<10} {'стратегия':<18} {'попыток':>8} {'успех':>7} {'ср. сек':>8}")
+    for row in rows:
+        print(f"{row['domain']:<28} {row['method']:<10} {row['strategy'] or '—':<18} {row['attempts']:>8} {row['success_rate']:>7.0%} {row['avg_seconds']:>8.2f}")
+
+
 if __name__ == "__main__":
-    print("Запуск парсера из командной строки...")
+    if len(sys.argv) > 1 and sys.argv[1] == '--domain-stats':
+        print_domain_stats(sys.argv[2] if len(sys.argv) > 2 else None); sys.exit(0)
+    resume_run = '--resume' in sys.argv[1:] # Продолжить прерванный запуск по манифесту папки загрузки
+    print("Запуск парсера из командной строки..." + (" (продолжение по манифесту)" if resume_run else ""))
     csv_file = DEFAULT_CSV_FILE_PATH
     download_folder = DEFAULT_DOWNLOAD_FOLDER
 
@@ -1093,7 +3047,7 @@ if __name__ == "__main__":
             if current == total: print()
         elif current == 0 and total == 0: print("Прогресс: 0/0 (0%)")
 
-    processed, success, errors = run_parser(csv_file, download_folder, _log_status, console_progress, headless=run_headless, max_workers=num_workers)
+    processed, success, errors = run_parser(csv_file, download_folder, _log_status, console_progress, headless=run_headless, max_workers=num_workers, resume=resume_run)
 
     print(f"\n--- Сводка ---")
     print(f"Обработано строк: {processed}")
@@ -1,12 +1,13 @@
 import tkinter as tk
 from tkinter import ttk, filedialog, scrolledtext, messagebox
 import threading
+import queue
 import os
 
 # --- Попытка импорта из локального файла с более широкой обработкой ошибок ---
 try:
     # Импортируем необходимые компоненты из image_parser
-    from image_parser import run_parser, DEFAULT_CSV_FILE_PATH, DEFAULT_DOWNLOAD_FOLDER, MAX_WORKERS
+    from image_parser import run_parser, DEFAULT_CSV_FILE_PATH, DEFAULT_DOWNLOAD_FOLDER, MAX_WORKERS, RESIZE_TO_TARGET
     # Убедимся, что импорт прошел успешно
     _parser_module_loaded = True
 except Exception as e:
@@ -19,6 +20,7 @@ except Exception as e:
     DEFAULT_CSV_FILE_PATH = ""
     DEFAULT_DOWNLOAD_FOLDER = ""
     MAX_WORKERS = 1 # Заглушка для настройки
+    RESIZE_TO_TARGET = False
 
     # Определяем заглушку для функции run_parser
     def run_parser(*args, **kwargs):
@@ -29,8 +31,14 @@ except Exception as e:
 
 
 class ImageParserApp:
+    LOG_DRAIN_INTERVAL_MS = 100 # Как часто очередь логов и прогресс переносятся в окно
+    LOG_MAX_LINES = 5000 # Сколько последних строк лога хранит текстовое поле
+
     def __init__(self, root):
         self.root = root
+        # Потоки парсера не обращаются к Tk: строки лога копятся в очереди, прогресс — последнее значение
+        self._log_queue = queue.SimpleQueue()
+        self._pending_progress = None
         self.root.title("Парсер изображений")
         self.root.geometry("600x600") # Увеличим немного размер окна
 
@@ -39,6 +47,8 @@ class ImageParserApp:
         self.download_dir_path = tk.StringVar(value=DEFAULT_DOWNLOAD_FOLDER)
         self.headless_mode = tk.BooleanVar(value=True) # Переменная для состояния чекбокса, по умолчанию True (фоновый режим)
         self.max_workers = tk.IntVar(value=MAX_WORKERS) # Переменная для количества потоков
+        self.resize_mode = tk.BooleanVar(value=RESIZE_TO_TARGET) # Вписывать изображения в размер из имени файла
+        self.resume_mode = tk.BooleanVar(value=False) # Пропускать строки, уже сохраненные по манифесту папки загрузки
 
         # --- Фрейм для выбора файлов ---
         file_frame = ttk.LabelFrame(root, text="Настройки путей", padding="10")
@@ -75,6 +85,18 @@ class ImageParserApp:
         self.workers_spinbox = ttk.Spinbox(settings_frame, from_=1, to=16, textvariable=self.max_workers, width=5) # Ограничим до 16
         self.workers_spinbox.grid(row=1, column=1, padx=5, pady=5, sticky="w")
 
+        # Переключатель изменения размера
+        self.resize_checkbox = ttk.Checkbutton(settings_frame,
+                                               text="Вписывать изображения в размер из имени файла (например, 296х296)",
+                                               variable=self.resize_mode)
+        self.resize_checkbox.grid(row=2, column=0, columnspan=2, padx=5, pady=5, sticky="w")
+
+        # Переключатель продолжения прерванного запуска
+        self.resume_checkbox = ttk.Checkbutton(settings_frame,
+                                               text="Продолжить прерванный запуск (пропустить уже сохраненные строки)",
+                                               variable=self.resume_mode)
+        self.resume_checkbox.grid(row=3, column=0, columnspan=2, padx=5, pady=5, sticky="w")
+
 
         # --- Кнопка запуска ---
         self.start_button = ttk.Button(root, text="Начать парсинг", command=self.start_parsing)
@@ -108,6 +130,7 @@ class ImageParserApp:
             # Отключить кнопку старта, если модуль парсера не загружен
             self.start_button.config(state="disabled")
 
+        self.root.after(self.LOG_DRAIN_INTERVAL_MS, self._drain_ui)
 
     def browse_csv(self):
         """Открывает диалог выбора CSV файла."""
@@ -131,20 +154,45 @@ class ImageParserApp:
             self.download_dir_path.set(dir_path)
 
     def update_status(self, message):
-        """Обновляет текстовое поле лога (безопасно для потоков)."""
-        def _update():
-            if not self.root.winfo_exists(): return # Проверяем, существует ли еще окно
+        """Добавляет строку в лог (безопасно для потоков: строка попадает в окно по таймеру)."""
+        self._log_queue.put(message + "\n")
+
+    def update_status_batch(self, events):
+        """Добавляет пачку событий парсера (LogEvent) одним элементом очереди."""
+        self._log_queue.put(''.join(event.format() + "\n" for event in events))
+
+    def update_progress(self, current, total):
+        """Запоминает прогресс (безопасно для потоков); в окно попадает только последнее значение за тик."""
+        self._pending_progress = (current, total)
+
+    def _drain_ui(self):
+        """Таймер главного потока: переносит накопленное в окно и планирует следующий тик."""
+        if not self.root.winfo_exists(): return
+        self._flush_ui()
+        self.root.after(self.LOG_DRAIN_INTERVAL_MS, self._drain_ui)
+
+    def _flush_ui(self):
+        """Вставляет все накопленные строки лога одной операцией и применяет последний прогресс."""
+        chunks = []
+        try:
+            while True: chunks.append(self._log_queue.get_nowait())
+        except queue.Empty:
+            pass
+        if chunks:
+            text = ''.join(chunks)
+            lines = text.splitlines(keepends=True)
+            if len(lines) > self.LOG_MAX_LINES: text = ''.join(lines[-self.LOG_MAX_LINES:])
             self.log_area.config(state='normal')
-            self.log_area.insert(tk.END, message + "\n")
+            self.log_area.insert(tk.END, text)
+            # Кольцевой буфер: лишние старые строки удаляются с начала
+            excess = int(self.log_area.index('end-1c').split('.')[0]) - 1 - self.LOG_MAX_LINES # Последняя строка поля — пустая
+            if excess > 0: self.log_area.delete('1.0', f'{excess + 1}.0')
             self.log_area.see(tk.END) # Автопрокрутка вниз
             self.log_area.config(state='disabled')
-        if self.root.winfo_exists():
-            self.root.after(0, _update)
 
-    def update_progress(self, current, total):
-        """Обновляет прогресс-бар (безопасно для потоков)."""
-        def _update():
-            if not self.root.winfo_exists(): return
+        progress, self._pending_progress = self._pending_progress, None
+        if progress is not None:
+            current, total = progress
             if total > 0:
                 percentage = int((current / total) * 100)
                 self.progress_bar['value'] = percentage
@@ -152,8 +200,6 @@ class ImageParserApp:
             else:
                 self.progress_bar['value'] = 0
                 self.stats_label.config(text="Нет данных для обработки")
-        if self.root.winfo_exists():
-            self.root.after(0, _update)
 
     def on_parsing_complete(self, result):
         """Вызывается после завершения парсинга."""
@@ -162,6 +208,7 @@ class ImageParserApp:
         processed, success, errors = result
         self.update_status("\n===================================")
         self.update_status(f"Завершено. Обработано: {processed}, Успешно: {success}, Ошибки: {errors}")
+        self._flush_ui() # Остаток лога и прогресса — до итоговой надписи
         self.stats_label.config(text=f"Завершено! Успешно: {success}, Ошибки: {errors}")
         self.start_button.config(state="normal") # Включаем кнопку обратно
         self.copy_log_button.config(state="normal") # Включаем кнопку копирования логов
@@ -190,6 +237,8 @@ class ImageParserApp:
         download_dir = self.download_dir_path.get()
         headless = self.headless_mode.get() # Получаем состояние чекбокса
         max_workers = self.max_workers.get() # Получаем количество потоков
+        resize = self.resize_mode.get() # Получаем состояние чекбокса размера
+        resume = self.resume_mode.get() # Получаем состояние чекбокса продолжения
 
         if not csv_path or not os.path.isfile(csv_path):
             messagebox.showerror("Ошибка", f"CSV файл не найден или путь не указан:\n{csv_path}")
@@ -215,16 +264,18 @@ class ImageParserApp:
         thread_download_dir = str(download_dir)
         thread_headless = bool(headless)
         thread_max_workers = int(max_workers)
+        thread_resize = bool(resize)
+        thread_resume = bool(resume)
 
 
         self.parser_thread = threading.Thread(
             target=self.run_parser_thread,
-            args=(thread_csv_path, thread_download_dir, thread_headless, thread_max_workers),
+            args=(thread_csv_path, thread_download_dir, thread_headless, thread_max_workers, thread_resize, thread_resume),
             daemon=True
         )
         self.parser_thread.start()
 
-    def run_parser_thread(self, csv_path, download_dir, headless, max_workers):
+    def run_parser_thread(self, csv_path, download_dir, headless, max_workers, resize=False, resume=False):
         """Функция, выполняемая в отдельном потоке."""
         result = (0, 0, 0)
         try:
@@ -238,7 +289,9 @@ class ImageParserApp:
                     return
 
             # Передаем настройки в run_parser
-            result = run_parser(csv_path, download_dir, self.update_status, self.update_progress, headless=headless, max_workers=max_workers)
+            def status_callback(message): self.update_status(message)
+            status_callback.log_batch = self.update_status_batch # run_parser отдает логи пачками
+            result = run_parser(csv_path, download_dir, status_callback, self.update_progress, headless=headless, max_workers=max_workers, resize=resize, resume=resume)
 
         except Exception as e:
             # Ловим любые ошибки, которые могли возникнуть в run_parser
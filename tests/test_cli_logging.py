@@ -0,0 +1,18 @@
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_cli_prints_row_failures_with_warning_level(tmp_path):
+    """Консольный запуск с LOG_LEVEL=WARNING печатает ошибки строк (а не только итоговую сводку)."""
+    # Порт 9 (discard) на localhost закрыт: строка падает сразу, без сети
+    (tmp_path / 'SuperGraContent Sheet1.csv').write_text('http://127.0.0.1:9/missing.html,bad_1\n', encoding='utf-8')
+    env = dict(os.environ, LOG_LEVEL='WARNING', PYTHONIOENCODING='utf-8', HTTP_MAX_RETRIES='0',
+               IMAGE_STORE_ENABLED='false', RESOLUTION_CACHE_ENABLED='false', DOMAIN_ROUTING_ENABLED='false')
+    result = subprocess.run([sys.executable, os.path.join(ROOT, 'image_parser.py')], cwd=tmp_path, env=env,
+                            input='\n\n', capture_output=True, text=True, encoding='utf-8', timeout=300)
+    assert result.returncode == 0, result.stderr
+    assert 'Ошибок: 1' in result.stdout
+    assert 'http://127.0.0.1:9/missing.html' in result.stdout
@@ -0,0 +1,247 @@
+"""
+Очередь задач веб-парсера в SQLite.
+
+HTTP-процессы (app.py) ставят задачи в очередь и читают их состояние, процессы worker.py
+забирают задачи, пишут прогресс, последние сообщения и индекс логов строк. Общего состояния
+в памяти процессов нет, поэтому gunicorn можно запускать с несколькими воркерами,
+а задачи переживают перезапуск.
+"""
+import os
+import sys
+import shutil
+import sqlite3
+import threading
+import time
+import uuid
+from datetime import datetime
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from image_parser import _open_sqlite
+
+JOB_DB_PATH = os.environ.get('JOB_DB_PATH', 'jobs.sqlite3')
+JOB_LOGS_FOLDER = os.environ.get('JOB_LOGS_FOLDER', 'logs')
+JOB_RECENT_MESSAGES = int(os.environ.get('JOB_RECENT_MESSAGES', 200))  # Сообщений задачи в базе для /api/status
+JOB_HEARTBEAT_INTERVAL = float(os.environ.get('JOB_HEARTBEAT_INTERVAL', 5))
+JOB_STALE_SECONDS = float(os.environ.get('JOB_STALE_SECONDS', 120))  # Задача без heartbeat дольше — возвращается в очередь
+
+FINISHED_STATUSES = ('completed', 'failed')
+
+
+class JobStore:
+    """
+    Задачи (jobs), последние сообщения (job_messages) и индекс логов строк CSV (job_rows).
+    Статусы: queued -> running -> completed / failed. Задача, чей воркер перестал
+    обновлять heartbeat_at, снова выдается claim() другому воркеру.
+    """
+    def __init__(self, path=JOB_DB_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def _connect(self):
+        if self._conn is None:
+            self._conn = _open_sqlite(
+                self.path,
+                'CREATE TABLE IF NOT EXISTS jobs ('
+                ' job_id TEXT PRIMARY KEY, filename TEXT NOT NULL, csv_path TEXT NOT NULL, download_dir TEXT NOT NULL,'
+                ' status TEXT NOT NULL, completed INTEGER NOT NULL DEFAULT 0, total INTEGER NOT NULL DEFAULT 0,'
+                ' zip_path TEXT, worker TEXT, attempts INTEGER NOT NULL DEFAULT 0,'
+                ' created_at REAL NOT NULL, started_at REAL, finished_at REAL, heartbeat_at REAL)',
+                'CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status, created_at)',
+                'CREATE TABLE IF NOT EXISTS job_messages ('
+                ' id INTEGER PRIMARY KEY AUTOINCREMENT, job_id TEXT NOT NULL, job_level INTEGER NOT NULL, line TEXT NOT NULL)',
+                'CREATE INDEX IF NOT EXISTS idx_job_messages_job ON job_messages (job_id, id)',
+                'CREATE TABLE IF NOT EXISTS job_rows ('
+                ' job_id TEXT NOT NULL, row_id INTEGER NOT NULL, offset INTEGER NOT NULL, length INTEGER NOT NULL,'
+                ' success INTEGER NOT NULL, url TEXT, filename TEXT, PRIMARY KEY (job_id, row_id))',
+            )
+        return self._conn
+
+    def _execute(self, sql, params=()):
+        with self._lock:
+            conn = self._connect()
+            cursor = conn.execute(sql, params); conn.commit()
+            return cursor.rowcount
+
+    def _query(self, sql, params=()):
+        with self._lock:
+            cursor = self._connect().execute(sql, params)
+            columns = [column[0] for column in cursor.description]
+            return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+    # --- HTTP-процесс ---
+    def create_job(self, filename, csv_path, download_dir, job_id=None):
+        job_id = job_id or str(uuid.uuid4())[:8]
+        self._execute('INSERT INTO jobs (job_id, filename, csv_path, download_dir, status, created_at) VALUES (?, ?, ?, ?, ?, ?)',
+                      (job_id, filename, os.path.abspath(csv_path), os.path.abspath(download_dir), 'queued', time.time()))
+        return job_id
+
+    def get_job(self, job_id):
+        """Задача как dict (с progress и created_at: datetime) или None."""
+        rows = self._query('SELECT * FROM jobs WHERE job_id = ?', (job_id,))
+        if not rows: return None
+        job = rows[0]
+        job['progress'] = {'completed': job['completed'], 'total': job['total']}
+        job['created_at'] = datetime.fromtimestamp(job['created_at'])
+        return job
+
+    def recent_messages(self, job_id, count):
+        rows = self._query('SELECT line FROM job_messages WHERE job_id = ? ORDER BY id DESC LIMIT ?', (job_id, count))
+        return [row['line'] for row in reversed(rows)]
+
+    def messages_after(self, job_id, last_id=None, limit=200):
+        """
+        Сообщения с id больше last_id как [(id, line)] — для SSE с продолжением по Last-Event-ID.
+        Без last_id — последние 10 сообщений, как в /api/status.
+        """
+        if last_id is None:
+            rows = self._query('SELECT id, line FROM job_messages WHERE job_id = ? ORDER BY id DESC LIMIT 10', (job_id,))
+            return [(row['id'], row['line']) for row in reversed(rows)]
+        rows = self._query('SELECT id, line FROM job_messages WHERE job_id = ? AND id > ? ORDER BY id LIMIT ?', (job_id, last_id, limit))
+        return [(row['id'], row['line']) for row in rows]
+
+    def job_lines(self, job_id):
+        """Сообщения задачи вне строк CSV (начало и итог запуска)."""
+        return [row['line'] for row in self._query('SELECT line FROM job_messages WHERE job_id = ? AND job_level = 1 ORDER BY id', (job_id,))]
+
+    def row_index(self, job_id):
+        return self._query('SELECT row_id, offset, length, success, url, filename FROM job_rows WHERE job_id = ? ORDER BY row_id', (job_id,))
+
+    def queue_position(self, job_id):
+        """Число задач в очереди перед этой (0 — следующая)."""
+        rows = self._query("SELECT COUNT(*) AS ahead FROM jobs WHERE status = 'queued'"
+                           " AND created_at < (SELECT created_at FROM jobs WHERE job_id = ?)", (job_id,))
+        return rows[0]['ahead']
+
+    def delete_job(self, job_id):
+        with self._lock:
+            conn = self._connect()
+            for table in ('job_rows', 'job_messages', 'jobs'):
+                conn.execute(f'DELETE FROM {table} WHERE job_id = ?', (job_id,))
+            conn.commit()
+
+    # --- Процесс worker.py ---
+    def claim(self, worker):
+        """
+        Забирает самую старую задачу из очереди (или зависшую без heartbeat) и помечает ее running.
+        Возвращает dict задачи или None. BEGIN IMMEDIATE не дает двум воркерам взять одну задачу.
+        """
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            try:
+                conn.execute('BEGIN IMMEDIATE')
+                row = conn.execute("SELECT job_id FROM jobs WHERE status = 'queued' OR (status = 'running' AND heartbeat_at < ?)"
+                                   " ORDER BY created_at LIMIT 1", (now - JOB_STALE_SECONDS,)).fetchone()
+                if row:
+                    conn.execute("UPDATE jobs SET status = 'running', worker = ?, attempts = attempts + 1, started_at = ?, heartbeat_at = ?,"
+                                 " completed = 0 WHERE job_id = ?", (worker, now, now, row[0]))
+                    conn.execute('DELETE FROM job_rows WHERE job_id = ?', (row[0],))
+                conn.commit()
+            except sqlite3.Error:
+                conn.rollback(); raise
+        return self.get_job(row[0]) if row else None
+
+    def update_progress(self, job_id, completed, total):
+        self._execute('UPDATE jobs SET completed = ?, total = ?, heartbeat_at = ? WHERE job_id = ?', (completed, total, time.time(), job_id))
+
+    def heartbeat(self, job_id):
+        self._execute('UPDATE jobs SET heartbeat_at = ? WHERE job_id = ?', (time.time(), job_id))
+
+    def finish_job(self, job_id, status, zip_path=None):
+        self._execute('UPDATE jobs SET status = ?, zip_path = ?, finished_at = ?, heartbeat_at = ? WHERE job_id = ?',
+                      (status, zip_path, time.time(), time.time(), job_id))
+
+    def add_messages(self, job_id, lines):
+        """lines — список (job_level, line). Сообщения строк сверх JOB_RECENT_MESSAGES удаляются."""
+        with self._lock:
+            conn = self._connect()
+            conn.executemany('INSERT INTO job_messages (job_id, job_level, line) VALUES (?, ?, ?)',
+                             [(job_id, int(job_level), line) for job_level, line in lines])
+            conn.execute('DELETE FROM job_messages WHERE job_id = ? AND job_level = 0 AND id <= '
+                         '(SELECT id FROM job_messages WHERE job_id = ? AND job_level = 0 ORDER BY id DESC LIMIT 1 OFFSET ?)',
+                         (job_id, job_id, JOB_RECENT_MESSAGES))
+            conn.commit()
+
+    def add_row(self, job_id, row_id, offset, length, success, url, filename):
+        self._execute('INSERT OR REPLACE INTO job_rows (job_id, row_id, offset, length, success, url, filename) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                      (job_id, row_id, offset, length, int(success), url, filename))
+
+
+class JobEventStore:
+    """
+    Логи задачи. В памяти воркера — только строки еще не завершенных строк CSV; последние
+    сообщения уходят в job_messages (для /api/status). Завершенная строка CSV дописывается одним
+    блоком в файл logs/<job_id>.log, в job_rows остаются смещение блока, результат, URL и имя файла.
+    """
+    def __init__(self, job_id, store):
+        self.job_id = job_id; self.store = store
+        self.path = os.path.join(JOB_LOGS_FOLDER, f"{job_id}.log")
+        self._pending = {}  # row_id -> строки лога, пока строка CSV в работе
+        self._file = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _line(message, ts=None):
+        return f"{datetime.fromtimestamp(ts) if ts else datetime.now():%H:%M:%S}: {message}"
+
+    def add(self, message, row_id=None, ts=None):
+        return self.add_events([(message, row_id, ts)])[0]
+
+    def add_events(self, events):
+        """events — LogEvent или кортежи (message, row_id, ts). Одна запись в базу на пачку."""
+        lines = []
+        with self._lock:
+            for event in events:
+                message, row_id, ts = (event.format(), event.row_id, event.ts) if hasattr(event, 'format') else event
+                line = self._line(message, ts); lines.append((row_id is None, line))
+                if row_id is not None: self._pending.setdefault(row_id, []).append(line)
+        self.store.add_messages(self.job_id, lines)
+        return [line for _job_level, line in lines]
+
+    def finish_row(self, row_id, row_data, success):
+        """Переносит строки лога завершенной строки CSV из памяти в файл задачи."""
+        with self._lock:
+            lines = self._pending.pop(row_id, [])
+            if self._file is None: self._file = open(self.path, 'ab')
+            block = ''.join(line + "\n" for line in lines).encode('utf-8')
+            offset = self._file.tell(); self._file.write(block); self._file.flush()
+        url = row_data[0].strip() if row_data else ''
+        filename = row_data[1].strip() if row_data and len(row_data) > 1 else ''
+        self.store.add_row(self.job_id, row_id, offset, len(block), success, url, filename)
+
+    def reset(self):
+        """Новая попытка задачи: лог предыдущей попытки больше не индексируется."""
+        if os.path.exists(self.path): os.remove(self.path)
+
+    def close(self):
+        """Дописывает строки, так и не получившие результата, и закрывает файл."""
+        for row_id in list(self._pending):
+            self.finish_row(row_id, None, False)
+        with self._lock:
+            if self._file is not None: self._file.close(); self._file = None
+
+
+def iter_job_report(store, job, header_lines):
+    """
+    Отчет для /logs по строкам CSV в исходном порядке: для успешной — одна строка-резюме,
+    для ошибки — ее блок лога, прочитанный из файла задачи по смещению.
+    """
+    yield "\n".join(header_lines + store.job_lines(job['job_id'])) + "\n\n"
+    rows = store.row_index(job['job_id'])
+    log_path = os.path.join(JOB_LOGS_FOLDER, f"{job['job_id']}.log")
+    if not rows or not os.path.exists(log_path): return
+    with open(log_path, 'rb') as log_file:
+        for row in rows:
+            if row['success']:
+                yield f"УСПЕХ: {row['url']} -> {row['filename']}\n\n"; continue
+            log_file.seek(row['offset'])
+            yield f"ОШИБКА: {row['url']} -> {row['filename']}\n" + log_file.read(row['length']).decode('utf-8', errors='replace') + "\n"
+
+
+def remove_job_files(job):
+    """Удаляет CSV, папку скачивания, ZIP и лог задачи."""
+    for path in (job.get('csv_path'), job.get('zip_path'), os.path.join(JOB_LOGS_FOLDER, f"{job['job_id']}.log")):
+        if path and os.path.exists(path): os.remove(path)
+    if job.get('download_dir') and os.path.exists(job['download_dir']):
+        shutil.rmtree(job['download_dir'])
@@ -0,0 +1,180 @@
+"""
+Процессы-исполнители задач веб-парсера.
+
+Каждый процесс забирает задачи из очереди JobStore (SQLite), запускает run_parser и пишет
+в базу прогресс, сообщения и индекс логов строк. Число процессов — JOB_WORKERS или --workers.
+
+    python worker.py               # JOB_WORKERS процессов (по умолчанию 1)
+    python worker.py --workers 3
+"""
+import os
+import sys
+import time
+import socket
+import zipfile
+import logging
+import argparse
+import threading
+import multiprocessing
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from image_parser import run_parser
+from job_store import JobStore, JobEventStore, JOB_LOGS_FOLDER, JOB_HEARTBEAT_INTERVAL
+
+MAX_WORKERS = int(os.environ.get('MAX_WORKERS', 4))  # Потоков run_parser на одну задачу
+SELENIUM_HEADLESS = os.environ.get('SELENIUM_HEADLESS', 'true').lower() == 'true'
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 1))
+JOB_POLL_INTERVAL = float(os.environ.get('JOB_POLL_INTERVAL', 1))
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger('worker')
+
+# Форматы, которые уже сжаты: повторное сжатие в ZIP только тратит CPU
+ZIP_STORED_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.webp', '.gif', '.avif'}
+
+class IncrementalZipWriter:
+    """
+    ZIP архив задачи, который пополняется по мере готовности строк
+    (вызывается из row_callback run_parser). Уже сжатые форматы пишутся как ZIP_STORED,
+    исходный файл после добавления удаляется, чтобы не хранить две копии на диске.
+    """
+    def __init__(self, job_id):
+        self.zip_path = os.path.abspath(os.path.join('downloads', f"images_{job_id}.zip"))
+        self._zipf = zipfile.ZipFile(self.zip_path, 'w', zipfile.ZIP_DEFLATED)
+        self._names = set()
+        self._lock = threading.Lock()
+        self.count = 0
+
+    def _unique_arcname(self, arcname):
+        base, ext = os.path.splitext(arcname); counter = 1
+        while arcname in self._names:
+            arcname = f"{base}_{counter}{ext}"; counter += 1
+        return arcname
+
+    def add_file(self, file_path):
+        ext = os.path.splitext(file_path)[1].lower()
+        compress_type = zipfile.ZIP_STORED if ext in ZIP_STORED_EXTENSIONS else zipfile.ZIP_DEFLATED
+        with self._lock:
+            arcname = self._unique_arcname(os.path.basename(file_path))
+            self._zipf.write(file_path, arcname, compress_type=compress_type)
+            self._names.add(arcname); self.count += 1
+        os.remove(file_path)
+
+    def row_callback(self, row_data, success, message, row_info):
+        if success and row_info.get('path') and os.path.exists(row_info['path']):
+            self.add_file(row_info['path'])
+
+    def close(self):
+        with self._lock:
+            self._zipf.close()
+        return self.zip_path
+
+def status_callback(job_id, events):
+    def callback(message):
+        events.add(message)
+        logger.info(f"[{job_id}] {message}")
+
+    def log_batch(batch):
+        # Пачка событий run_parser: одна транзакция в базе и одна запись в лог процесса
+        lines = events.add_events(batch)
+        logger.log(max(event.level for event in batch), "[%s] %s", job_id, "\n".join(lines))
+    callback.log_batch = log_batch
+    return callback
+
+def progress_callback(job_id, store):
+    last_write = [0.0]
+    def callback(*args):
+        # Поддержка вызовов progress_callback(completed) и progress_callback(completed, total)
+        completed = int(args[0]) if args else 0
+        total = int(args[1]) if len(args) >= 2 else store.get_job(job_id)['total']
+        # В базу — не чаще раза в секунду, но первое и последнее значения всегда
+        if completed in (0, total) or time.monotonic() - last_write[0] >= 1:
+            store.update_progress(job_id, completed, total); last_write[0] = time.monotonic()
+    return callback
+
+def _heartbeat_loop(store, job_id, stop):
+    while not stop.wait(JOB_HEARTBEAT_INTERVAL):
+        try:
+            store.heartbeat(job_id)
+        except Exception as e:
+            logger.error(f"Ошибка heartbeat задачи {job_id}: {e}")
+
+def run_job(store, job):
+    """Выполняет одну задачу: run_parser с ZIP архивом и логами строк, итоговый статус — в базу."""
+    job_id = job['job_id']
+    events = JobEventStore(job_id, store)
+    if job['attempts'] > 1:
+        events.reset(); events.add(f"Задача перезапущена (попытка {job['attempts']})")
+    stop = threading.Event()
+    threading.Thread(target=_heartbeat_loop, args=(store, job_id, stop), daemon=True).start()
+    try:
+        os.makedirs(job['download_dir'], exist_ok=True)
+        # ZIP архив собирается по мере обработки строк, лог строки уходит в файл задачи
+        zip_writer = IncrementalZipWriter(job_id)
+        def row_callback(row_data, success, message, row_info):
+            events.finish_row(row_info.get('row_id'), row_data, success)
+            zip_writer.row_callback(row_data, success, message, row_info)
+        try:
+            # Запуск парсера
+            completed, success, errors = run_parser(
+                csv_path=job['csv_path'],
+                download_dir=job['download_dir'],
+                status_callback=status_callback(job_id, events),
+                progress_callback=progress_callback(job_id, store),
+                headless=SELENIUM_HEADLESS,
+                max_workers=MAX_WORKERS,
+                row_callback=row_callback
+            )
+        finally:
+            zip_path = zip_writer.close()
+            events.close()
+        logger.info(f"ZIP архив {zip_path}: {zip_writer.count} файлов")
+
+        if success > 0 and zip_writer.count > 0:
+            events.add(f"Завершено: {success} успешно, {errors} ошибок")
+            store.finish_job(job_id, 'completed', zip_path)
+        elif success > 0:
+            events.add("Ошибка создания ZIP архива")
+            store.finish_job(job_id, 'failed')
+        else:
+            events.add("Не удалось скачать ни одного изображения")
+            store.finish_job(job_id, 'failed')
+
+    except Exception as e:
+        events.add(f"Критическая ошибка: {str(e)}")
+        store.finish_job(job_id, 'failed')
+        logger.error(f"Ошибка в задаче {job_id}: {e}")
+    finally:
+        stop.set()
+
+def worker_loop(worker_name):
+    """Цикл одного процесса: забрать задачу, выполнить, повторить."""
+    store = JobStore()
+    for folder in ['downloads', 'temp', JOB_LOGS_FOLDER]:
+        os.makedirs(folder, exist_ok=True)
+    logger.info(f"Воркер {worker_name} запущен")
+    while True:
+        try:
+            job = store.claim(worker_name)
+        except Exception as e:
+            logger.error(f"Воркер {worker_name}: ошибка очереди: {e}"); job = None
+        if job is None:
+            time.sleep(JOB_POLL_INTERVAL); continue
+        logger.info(f"Воркер {worker_name} взял задачу {job['job_id']} ({job['filename']})")
+        run_job(store, job)
+
+def main():
+    parser = argparse.ArgumentParser(description="Процессы-исполнители задач веб-парсера")
+    parser.add_argument('--workers', type=int, default=JOB_WORKERS, help="Число процессов")
+    args = parser.parse_args()
+    prefix = f"{socket.gethostname()}:{os.getpid()}"
+    if args.workers <= 1:
+        worker_loop(f"{prefix}:0"); return
+    # spawn: у каждого процесса свои соединения SQLite, HTTP-сессии и браузеры
+    context = multiprocessing.get_context('spawn')
+    processes = [context.Process(target=worker_loop, args=(f"{prefix}:{index}",), daemon=True) for index in range(args.workers)]
+    for process in processes: process.start()
+    for process in processes: process.join()
+
+if __name__ == '__main__':
+    main()